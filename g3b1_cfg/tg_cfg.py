@@ -3,7 +3,7 @@ import importlib
 import logging
 from _ast import FunctionDef
 from functools import cache
-from typing import Any
+from typing import Any, Optional
 
 from sqlalchemy import MetaData, create_engine, Table, delete, select, insert, asc
 from sqlalchemy.engine import Connection, CursorResult, Row, Engine
@@ -12,8 +12,11 @@ from telegram.ext import CallbackContext
 
 from constants import env_g3b1_dir, env_g3b1_code, g3b1_dir_files
 from elements import EleTy
+from g3b1_data import change_log, db_registry
+from g3b1_data.db_profile import apply_profile
 from g3b1_data.entities import EntTy
 from g3b1_data.model import G3Command, G3Module, G3Arg, script_by_file_str, G3Func
+from g3b1_data.schema_cache import LazyMetaData
 from g3b1_log.log import cfg_logger
 from generic_mdl import get_ele_ty_li, get_ent_ty_li
 from py_meta import read_functions, read_function, build_module_str
@@ -21,8 +24,9 @@ from py_meta import read_functions, read_function, build_module_str
 logger = cfg_logger(logging.getLogger(__name__), logging.WARN)
 
 db_file_cfg = rf'{env_g3b1_dir}\g3b1_cfg.db'
-md_cfg = MetaData()
 eng_cfg = create_engine(f"sqlite:///{db_file_cfg}")
+apply_profile(eng_cfg)
+md_cfg = LazyMetaData(eng_cfg)
 
 
 class G3Ctx:
@@ -227,6 +231,25 @@ def sel_g3_m(g3_m_str: str) -> G3Module:
     return g3_m
 
 
+def on_cfg_change(db: str, tbl_name: str, key_li: Optional[list[tuple]]):
+    """Drops the modules and element classes cached when another process has written the command registry"""
+    if db != db_registry.db_key(db_file_cfg):
+        return
+    if tbl_name == 'ele_ty':
+        sel_ele_ty_cls.cache_clear()
+    else:
+        sel_g3_m.cache_clear()
+
+
+def watch_cfg():
+    """Invalidates sel_g3_m and sel_ele_ty_cls on the writes of other processes, e.g. a bot (re)initializing its
+    module. Any change clears the whole cache, the tables have no key columns in the change log."""
+    tbl_key_dct: dict[str, list[str]] = {'g3_m': [], 'g3_cmd': [], 'g3_cmd_arg': [], 'ele_ty': []}
+    for tbl_name in tbl_key_dct.keys():
+        change_log.subscribe(tbl_name, on_cfg_change)
+    change_log.watch(eng_cfg, tbl_key_dct)
+
+
 def del_db_cfg():
     con: Connection
     with eng_cfg.begin() as con:
@@ -320,4 +343,4 @@ def init_db_cfg():
         con.execute(g3_m_create)
         con.execute(g3_cmd_create)
         con.execute(g3_cmd_arg_create)
-    md_cfg.reflect(bind=eng_cfg)
+    # md_cfg reflects the tables on first access
@@ -0,0 +1,94 @@
+"""asyncio facade of the synchronous data layer modules, e.g. await tg_db.aio.read_latest_message(...).
+
+await facade.fn(...) runs module.fn(...) on the executor of the DB fn works on and returns its result, the
+event loop keeps running meanwhile. Each DB has an executor of its own with AIO_WORKERS threads at most,
+never more than the pool size of its engine: the calls of a DB reuse the pooled connections of the DB and
+never wait for one, and a busy DB, e.g. g3b1_tg.db during an archive run, does not hold up the others.
+
+G3Ctx is process wide, by the time a worker runs it may hold the update of another handler. Functions reading
+G3Ctx are resolved on the event loop by the facade of the module, as settings.aio.read_setng, or not offered."""
+import asyncio
+import functools
+import inspect
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import ModuleType
+from typing import Callable, Any
+
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from g3b1_data import db_registry
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.WARN)
+
+AIO_WORKERS = 4
+
+_lock = threading.Lock()
+# db file key -> executor
+_executor_dct: dict[str, ThreadPoolExecutor] = {}
+
+
+def executor(eng: Engine) -> ThreadPoolExecutor:
+    """The executor of the DB of eng, created on first request"""
+    key = db_registry.db_key(eng.url.database)
+    if ex := _executor_dct.get(key):
+        return ex
+    with _lock:
+        if key not in _executor_dct:
+            worker_count = AIO_WORKERS
+            if isinstance(eng.pool, QueuePool):
+                worker_count = min(worker_count, eng.pool.size())
+            logger.debug(f'Create executor of {worker_count} workers for {eng.url.database}')
+            _executor_dct[key] = ThreadPoolExecutor(
+                max_workers=worker_count, thread_name_prefix=f'aio_{os.path.basename(eng.url.database)}')
+        return _executor_dct[key]
+
+
+async def run(eng: Engine, fn: Callable, *args, **kwargs) -> Any:
+    """fn(*args, **kwargs) on the executor of the DB of eng"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor(eng), functools.partial(fn, *args, **kwargs))
+
+
+def shutdown(wait: bool = True):
+    """Shuts the executors down, the next call creates a new one"""
+    with _lock:
+        ex_li = list(_executor_dct.values())
+        _executor_dct.clear()
+    for ex in ex_li:
+        ex.shutdown(wait)
+
+
+class AioFacade:
+    """The functions of modu as coroutine functions.
+    eng_of gets the bound arguments of a call by parameter name and returns the engine of the DB it works on.
+    A Connection passed to a function is used by the worker, pass the Engine instead.
+    The functions of ctx_fn_li read G3Ctx, the facade does not offer them unless it overrides them."""
+
+    def __init__(self, modu: ModuleType, eng_of: Callable[[dict[str, Any]], Engine],
+                 ctx_fn_li: list[str] = None) -> None:
+        super().__init__()
+        self.modu = modu
+        self.eng_of = eng_of
+        self.ctx_fn_li = ctx_fn_li or []
+
+    def __getattr__(self, name: str):
+        fn = getattr(self.modu, name, None)
+        if name.startswith('_') or not inspect.isfunction(fn):
+            raise AttributeError(f'{self.modu.__name__} has no function {name}')
+        if name in self.ctx_fn_li:
+            raise AttributeError(f'{self.modu.__name__}.{name} reads G3Ctx, it has no aio variant')
+        sig = inspect.signature(fn)
+
+        async def afn(*args, **kwargs):
+            eng = self.eng_of(sig.bind(*args, **kwargs).arguments)
+            return await run(eng, fn, *args, **kwargs)
+
+        functools.update_wrapper(afn, fn)
+        # next time found without __getattr__
+        setattr(self, name, afn)
+        return afn
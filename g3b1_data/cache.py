@@ -0,0 +1,260 @@
+"""In-process caches of the data layer"""
+import copy
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Union
+
+from sqlalchemy import event
+from sqlalchemy.engine import Connection, Engine
+
+from g3b1_data.entities import EntTy
+
+UPSERT_CACHE_SIZE = 20000
+ENT_CACHE_SIZE = 5000
+LAST_MSG_CACHE_SIZE = 10000
+SETNG_CACHE_SIZE = 10000
+
+
+def after_commit(con: Union[Connection, Engine], fn: Callable[[], None]):
+    """fn() once the transaction of con has committed, at once outside a transaction, never on rollback"""
+    if not (isinstance(con, Connection) and con.in_transaction()):
+        fn()
+        return
+
+    # the listeners can not be removed while dispatched, the first one to run disarms the other
+    f_done = []
+
+    # noinspection PyUnusedLocal
+    def on_commit(conn):
+        if not f_done:
+            f_done.append(True)
+            fn()
+
+    # noinspection PyUnusedLocal
+    def on_rollback(conn):
+        f_done.append(True)
+
+    event.listen(con, 'commit', on_commit, once=True)
+    event.listen(con, 'rollback', on_rollback, once=True)
+
+
+class LruCache:
+    """Thread-safe dictionary with least recently used eviction and hit/miss counters"""
+
+    def __init__(self, maxsize: int) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+        self.hit_count = 0
+        self.miss_count = 0
+        self._dct: OrderedDict[Hashable, Any] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._dct)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._dct
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._dct:
+                self.miss_count += 1
+                return default
+            self.hit_count += 1
+            self._dct.move_to_end(key)
+            return self._dct[key]
+
+    def put(self, key: Hashable, val: Any):
+        with self._lock:
+            self._dct[key] = val
+            self._dct.move_to_end(key)
+            while len(self._dct) > self.maxsize:
+                self._dct.popitem(last=False)
+
+    def put_if_absent(self, key: Hashable, val: Any) -> Any:
+        """Keeps the value of a concurrent put, e.g. if val has been read from the DB before it was written.
+        Returns the value cached."""
+        with self._lock:
+            if key not in self._dct:
+                self.put(key, val)
+            return self._dct[key]
+
+    def key_li(self) -> list[Hashable]:
+        with self._lock:
+            return list(self._dct.keys())
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            return self._dct.pop(key, default)
+
+    def pop_if(self, key_filter: Callable[[Hashable], bool]) -> int:
+        """Removes all entries whose key matches key_filter. Returns the number of entries removed."""
+        with self._lock:
+            key_li = [k for k in self._dct.keys() if key_filter(k)]
+            for k in key_li:
+                del self._dct[k]
+            return len(key_li)
+
+    def clear(self):
+        with self._lock:
+            self._dct.clear()
+
+    def hit_ratio(self) -> float:
+        count = self.hit_count + self.miss_count
+        if not count:
+            return 0.0
+        return self.hit_count / count
+
+    def stats_str(self) -> str:
+        return f'size: {len(self)}/{self.maxsize}, hits: {self.hit_count}, misses: {self.miss_count}, ' \
+               f'ratio: {self.hit_ratio():.2f}'
+
+
+class UpsertCache:
+    """Fingerprints of the values last upserted per (db, table, key, columns).
+    An upsert with the same fingerprint can not change the row and is skipped.
+    A hit is a skipped write, a miss is a write executed."""
+
+    def __init__(self, maxsize: int = UPSERT_CACHE_SIZE) -> None:
+        super().__init__()
+        self.lru = LruCache(maxsize)
+
+    @staticmethod
+    def _key(db: str, tbl_name: str, key_tup: tuple, values: dict) -> tuple:
+        return db, tbl_name, key_tup, tuple(sorted(values.keys()))
+
+    @staticmethod
+    def _fingerprint(values: dict) -> int:
+        return hash(tuple(sorted(values.items())))
+
+    def is_unchanged(self, db: str, tbl_name: str, key_tup: tuple, values: dict) -> bool:
+        return self.lru.get(self._key(db, tbl_name, key_tup, values)) == self._fingerprint(values)
+
+    def remember(self, db: str, tbl_name: str, key_tup: tuple, values: dict):
+        """To be called once the upsert has been executed"""
+        self.lru.put(self._key(db, tbl_name, key_tup, values), self._fingerprint(values))
+
+    def invalidate(self, db: str, tbl_name: str, key_tup: tuple = None) -> int:
+        """Forget the fingerprints of a row or, if key_tup is None, of the whole table"""
+        return self.lru.pop_if(lambda k: k[0] == db and k[1] == tbl_name and (key_tup is None or k[2] == key_tup))
+
+    def invalidate_li(self, db: str, tbl_name: str, key_tup_li: list[tuple]) -> int:
+        """Forget the fingerprints of the rows of key_tup_li"""
+        key_tup_set = set(key_tup_li)
+        return self.lru.pop_if(lambda k: k[0] == db and k[1] == tbl_name and k[2] in key_tup_set)
+
+    def stats_str(self) -> str:
+        return f'Upsert cache {self.lru.stats_str()}'
+
+
+upsert_cache = UpsertCache()
+
+
+class EntCache:
+    """Entities loaded with their whole graph by (EntTy, id), with the secondary index (EntTy, scope, bkey) -> id.
+    The scope of a bkey is the g3_bot_id or the chat id the bkey is unique for.
+    The cache keeps a copy of the graph put and each get returns a copy of its own: a caller may change its
+    entities, changes not written with upd_ent_ty stay with the caller, as does the snapshot of ent_dirty_dct.
+    As in SetngCache, a graph read before an invalidation is not cached, the generation has changed meanwhile."""
+
+    def __init__(self, maxsize: int = ENT_CACHE_SIZE) -> None:
+        super().__init__()
+        self.lru = LruCache(maxsize)
+        self.bkey_lru = LruCache(maxsize)
+        self.gen = 0
+        # EntTy -> [hits, misses]
+        self.count_dct: dict[EntTy, list[int]] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, ent_ty: EntTy, ent: Any) -> Any:
+        with self._lock:
+            count_li = self.count_dct.setdefault(ent_ty, [0, 0])
+            count_li[0 if ent is not None else 1] += 1
+        if ent is None:
+            return None
+        return copy.deepcopy(ent)
+
+    def get(self, ent_ty: EntTy, id_: int) -> Any:
+        return self._count(ent_ty, self.lru.get((ent_ty, id_)))
+
+    def get_by_bkey(self, ent_ty: EntTy, scope: tuple, bkey: str) -> Any:
+        ent = None
+        if (id_ := self.bkey_lru.get((ent_ty, scope, bkey))) is not None:
+            ent = self.lru.get((ent_ty, id_))
+            if ent is not None and getattr(ent, 'bkey', bkey) != bkey:
+                # bkey changed since the entity was cached
+                ent = None
+        return self._count(ent_ty, ent)
+
+    def put(self, ent_ty: EntTy, ent: Any, scope: tuple = None, bkey: str = None, gen: int = None):
+        """gen: the generation before the entity has been read, None to put it anyway"""
+        id_ = EntTy.ent_id(ent)
+        ent = copy.deepcopy(ent)
+        with self._lock:
+            if gen is not None and gen != self.gen:
+                return
+            self.lru.put((ent_ty, id_), ent)
+            if bkey is not None:
+                self.bkey_lru.put((ent_ty, scope, bkey), id_)
+
+    def invalidate(self, ent_ty: EntTy, id_: int = None) -> int:
+        """Drop an entity or, if id_ is None, all entities of the type"""
+        with self._lock:
+            self.gen += 1
+            return self.lru.pop_if(lambda k: k[0] == ent_ty and (id_ is None or k[1] == id_))
+
+    def cached_ent_ty_li(self) -> list[EntTy]:
+        return list({k[0] for k in self.lru.key_li()})
+
+    def hit_ratio(self, ent_ty: EntTy) -> float:
+        hit_count, miss_count = self.count_dct.get(ent_ty, [0, 0])
+        if not hit_count + miss_count:
+            return 0.0
+        return hit_count / (hit_count + miss_count)
+
+    def stats_str(self) -> str:
+        line_li = [f'Entity cache size: {len(self.lru)}/{self.lru.maxsize}']
+        for ent_ty, (hit_count, miss_count) in list(self.count_dct.items()):
+            line_li.append(f'  {ent_ty.id}: hits: {hit_count}, misses: {miss_count}, '
+                           f'ratio: {self.hit_ratio(ent_ty):.2f}')
+        return '\n'.join(line_li)
+
+
+ent_cache = EntCache()
+
+# tg_chat.ext_id -> last_msg_id, see tg_db.upd_chat_last_msg
+last_msg_cache = LruCache(LAST_MSG_CACHE_SIZE)
+
+
+class SetngCache:
+    """Whole rows of the settings tables by (db, table, tg_chat_id, tg_user_id), {} if the row is missing.
+    0 stands for the chat or user of a table without that key, see settings.chat_user_setng_params.
+    A row read before an invalidation is not cached, the generation has changed meanwhile."""
+
+    def __init__(self, maxsize: int = SETNG_CACHE_SIZE) -> None:
+        super().__init__()
+        self.lru = LruCache(maxsize)
+        self.gen = 0
+        self._lock = threading.Lock()
+
+    def get_row(self, db: str, tbl_name: str, chat_id: int, user_id: int) -> Optional[dict[str, Any]]:
+        return self.lru.get((db, tbl_name, chat_id, user_id))
+
+    def put_row(self, db: str, tbl_name: str, chat_id: int, user_id: int, row_dct: dict[str, Any], gen: int):
+        """gen: the generation before the row has been read"""
+        with self._lock:
+            if gen == self.gen:
+                self.lru.put((db, tbl_name, chat_id, user_id), row_dct)
+
+    def invalidate(self, db: str, tbl_name: str = None, chat_id: int = None, user_id: int = None) -> int:
+        """Drop a row or, if None, the rows of any table, chat or user of the db"""
+        with self._lock:
+            self.gen += 1
+            return self.lru.pop_if(lambda k: k[0] == db and tbl_name in (None, k[1]) and chat_id in (None, k[2])
+                                   and user_id in (None, k[3]))
+
+    def stats_str(self) -> str:
+        return f'Settings cache {self.lru.stats_str()}'
+
+
+setng_cache = SetngCache()
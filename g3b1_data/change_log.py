@@ -0,0 +1,290 @@
+"""Invalidation of the in-process caches on writes of other processes, e.g. the trans, money and subscribe bots
+sharing the DB files.
+
+Triggers on the watched tables log the key of each row inserted, updated or deleted in g3_change_log with an
+ever increasing seq. A watcher per DB keeps a connection of its own and polls PRAGMA data_version every
+CHG_POLL_MS: it changes when any other connection has committed, the change log is only read then. The keys
+logged since the last poll are passed to the subscribers of their table, see subscribe.
+
+The writers of this process invalidate their caches themselves. A TEMP trigger on the pooled connections of the
+engine watched stamps their rows with the pid, the watcher skips them: an echo of the own writes would, e.g.,
+drop the upsert_cache fingerprints of tg_chat with each message. Writes of other engines of the same file
+count as foreign. A watcher falling behind the pruned log, i.e. more than CHG_LOG_KEEP rows, notifies all
+of its tables."""
+import logging
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Callable, Optional
+from urllib.request import pathname2url
+
+from sqlalchemy import text, event
+from sqlalchemy.engine import Engine
+
+from g3b1_data import db_registry
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.INFO)
+
+CHG_POLL_MS = 500
+# rows kept in g3_change_log by the pruning of the watchers
+CHG_LOG_KEEP = 10000
+
+TBL_CHG_LOG = 'g3_change_log'
+
+SQL_CREATE_CHG_LOG = f'CREATE TABLE IF NOT EXISTS {TBL_CHG_LOG} (' \
+                     'seq integer PRIMARY KEY AUTOINCREMENT, ' \
+                     'tbl_name text NOT NULL, ' \
+                     'key_1 integer, ' \
+                     'key_2 integer, ' \
+                     'pid integer)'
+# created on the connections of this process, temp triggers only fire for the connection which created them
+SQL_CREATE_OWN_TRG = f'CREATE TEMP TRIGGER IF NOT EXISTS g3_chg_own AFTER INSERT ON main.{TBL_CHG_LOG} BEGIN ' \
+                     f'UPDATE {TBL_CHG_LOG} SET pid = {os.getpid()} WHERE seq = new.seq; END'
+
+# db file key, table name, the keys changed or None for all rows of the table
+ChgCallback = Callable[[str, str, Optional[list[tuple]]], None]
+
+_lock = threading.Lock()
+# table name -> callbacks
+_sub_dct: dict[str, list[ChgCallback]] = {}
+# db file key -> watcher
+_watcher_dct: dict[str, "ChangeWatcher"] = {}
+_thread: threading.Thread = None
+_f_stop = threading.Event()
+
+
+def trigger_ddl_li(tbl_key_dct: dict[str, list[str]]) -> list[str]:
+    """g3_change_log and its triggers on the tables of tbl_key_dct, which maps the table name to its key columns,
+    one or two. A table with no key columns logs NULL keys, i.e. any change notifies the whole table."""
+    sql_li = [SQL_CREATE_CHG_LOG]
+    for tbl_name, key_col_li in tbl_key_dct.items():
+        def key_sql(row: str) -> str:
+            col_li = [f'{row}.{col}' for col in key_col_li] + ['NULL'] * (2 - len(key_col_li))
+            return f"INSERT INTO {TBL_CHG_LOG} (tbl_name, key_1, key_2) VALUES ('{tbl_name}', {', '.join(col_li)});"
+
+        key_changed = ' OR '.join(f'new.{col} IS NOT old.{col}' for col in key_col_li) or '0'
+        sql_li += [
+            f'CREATE TRIGGER IF NOT EXISTS g3_chg_{tbl_name}_ai AFTER INSERT ON {tbl_name} BEGIN '
+            f'{key_sql("new")} END',
+            f'CREATE TRIGGER IF NOT EXISTS g3_chg_{tbl_name}_ad AFTER DELETE ON {tbl_name} BEGIN '
+            f'{key_sql("old")} END',
+            f'CREATE TRIGGER IF NOT EXISTS g3_chg_{tbl_name}_au AFTER UPDATE ON {tbl_name} BEGIN '
+            f'{key_sql("old")} END',
+            # a changed key is logged twice, the row moved
+            f'CREATE TRIGGER IF NOT EXISTS g3_chg_{tbl_name}_auk AFTER UPDATE ON {tbl_name} '
+            f'WHEN {key_changed} BEGIN {key_sql("new")} END'
+        ]
+    return sql_li
+
+
+def install(eng: Engine, tbl_key_dct: dict[str, list[str]]) -> list[str]:
+    """Creates g3_change_log and the triggers missing on the existing tables of tbl_key_dct.
+    A table lacking a key column gets no triggers, they would fail each write.
+    Returns the names of the tables which have got their triggers now."""
+    with eng.begin() as con:
+        trg_name_set = {row[0] for row in con.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'"))}
+        tbl_key_dct = {tbl_name: key_col_li for tbl_name, key_col_li in tbl_key_dct.items()
+                       if f'g3_chg_{tbl_name}_ai' not in trg_name_set}
+        for tbl_name, key_col_li in list(tbl_key_dct.items()):
+            col_name_set = {row[1] for row in con.execute(text(f'PRAGMA table_info({tbl_name})'))}
+            if not col_name_set:
+                del tbl_key_dct[tbl_name]
+            elif missing_li := [col for col in key_col_li if col not in col_name_set]:
+                logger.warning(f'{eng.url.database}: {tbl_name} has no {", ".join(missing_li)}, no change log')
+                del tbl_key_dct[tbl_name]
+        for sql in trigger_ddl_li(tbl_key_dct):
+            con.execute(text(sql))
+    if tbl_key_dct:
+        logger.info(f'{eng.url.database}: change log of {", ".join(tbl_key_dct.keys())}')
+    return list(tbl_key_dct.keys())
+
+
+def subscribe(tbl_name: str, callback: ChgCallback):
+    """callback(db, tbl_name, key_li) is called by the poll thread for the changes of tbl_name in any DB watched.
+    key_li holds the keys of the table's key columns, (key_1,) or (key_1, key_2), None stands for any row."""
+    with _lock:
+        _sub_dct.setdefault(tbl_name, []).append(callback)
+
+
+@dataclass
+class ChangeStats:
+    poll_count: int = 0
+    # polls with a new data_version
+    change_count: int = 0
+    row_count: int = 0
+    # notifications of a whole table
+    all_count: int = 0
+
+
+class ChangeWatcher:
+    """Polls the change log of the DB of eng, with a read-only connection of its own:
+    data_version only compares the commits of the other connections with the same connection's last value"""
+
+    def __init__(self, eng: Engine) -> None:
+        super().__init__()
+        self.eng = eng
+        self.db = db_registry.db_key(eng.url.database)
+        self.stats = ChangeStats()
+        self._conn: sqlite3.Connection = None
+        self._data_version: int = None
+        self._seq = 0
+        self._prune_seq = 0
+
+    def _connect(self):
+        uri = f'file:{pathname2url(os.path.abspath(self.eng.url.database))}?mode=ro'
+        self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        self._data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        # the caches are filled after start, the changes logged before are of no interest
+        self._seq = self._conn.execute(f'SELECT IFNULL(MAX(seq), 0) FROM {TBL_CHG_LOG}').fetchone()[0]
+        self._prune_seq = self._seq
+
+    def close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+    def poll(self) -> int:
+        """Notifies the subscribers of the changes logged since the last poll. Returns the number of rows read."""
+        if not self._conn:
+            self._connect()
+            return 0
+        self.stats.poll_count += 1
+        data_version = self._conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return 0
+        self._data_version = data_version
+        self.stats.change_count += 1
+        # one statement, one snapshot: the min seq and the rows after the last seq read
+        row_li = self._conn.execute(f'SELECT seq, tbl_name, key_1, key_2, (SELECT MIN(seq) FROM {TBL_CHG_LOG}), '
+                                    f'pid FROM {TBL_CHG_LOG} WHERE seq > ? ORDER BY seq', (self._seq,)).fetchall()
+        if not row_li:
+            return 0
+        # key_li None: any row
+        tbl_dct: dict[str, Optional[list[tuple]]] = {}
+        if row_li[0][4] > self._seq + 1:
+            # pruned before read
+            with _lock:
+                tbl_dct = dict.fromkeys(_sub_dct.keys())
+            self.stats.all_count += 1
+        else:
+            pid = os.getpid()
+            for seq, tbl_name, key_1, key_2, min_seq, row_pid in row_li:
+                if row_pid == pid:
+                    continue
+                if key_1 is None and key_2 is None:
+                    tbl_dct[tbl_name] = None
+                elif (key_li := tbl_dct.setdefault(tbl_name, [])) is not None:
+                    key_li.append((key_1, key_2))
+        self._seq = row_li[-1][0]
+        self.stats.row_count += len(row_li)
+        self._notify(tbl_dct)
+        if self._seq - self._prune_seq > CHG_LOG_KEEP:
+            self.prune()
+        return len(row_li)
+
+    def _notify(self, tbl_dct: dict[str, Optional[list[tuple]]]):
+        for tbl_name, key_li in tbl_dct.items():
+            if key_li is not None:
+                key_li = list(dict.fromkeys(key_li))
+            with _lock:
+                callback_li = list(_sub_dct.get(tbl_name, []))
+            for callback in callback_li:
+                try:
+                    callback(self.db, tbl_name, key_li)
+                except Exception as e:
+                    logger.error(f'{self.db}: invalidation of {tbl_name} failed: {e}')
+
+    def prune(self):
+        with self.eng.begin() as con:
+            con.execute(text(f'DELETE FROM {TBL_CHG_LOG} WHERE seq <= :seq'), seq=self._seq - CHG_LOG_KEEP)
+        self._prune_seq = self._seq
+
+    def stats_str(self) -> str:
+        return f'{os.path.basename(self.db)}: seq {self._seq}, {self.stats.poll_count} polls, ' \
+               f'{self.stats.change_count} changed, {self.stats.row_count} rows, ' \
+               f'{self.stats.all_count} whole tables'
+
+
+def watch(eng: Engine, tbl_key_dct: dict[str, list[str]] = None) -> ChangeWatcher:
+    """Polls the change log of the DB of eng from now on, once per DB. The triggers of tbl_key_dct are installed."""
+    if tbl_key_dct:
+        install(eng, tbl_key_dct)
+    key = db_registry.db_key(eng.url.database)
+    with _lock:
+        if f_new := key not in _watcher_dct:
+            _watcher_dct[key] = ChangeWatcher(eng)
+        watcher = _watcher_dct[key]
+    if f_new:
+        listen_own(eng)
+    # connect now, the changes from now on are read by the first poll
+    poll_all([watcher])
+    return watcher
+
+
+def listen_own(eng: Engine):
+    """Stamps the rows logged by the pooled connections of eng with the pid of this process"""
+
+    # noinspection PyUnusedLocal
+    def on_checkout(dbapi_con, con_record, con_proxy):
+        if con_record.info.get('g3_chg_own'):
+            return
+        try:
+            dbapi_con.execute(SQL_CREATE_OWN_TRG)
+            con_record.info['g3_chg_own'] = True
+        except sqlite3.OperationalError:
+            # no change log yet
+            pass
+
+    event.listen(eng, 'checkout', on_checkout)
+
+
+def poll_all(watcher_li: list[ChangeWatcher] = None) -> int:
+    """Polls the watchers, by default all. Returns the number of change log rows read."""
+    if watcher_li is None:
+        with _lock:
+            watcher_li = list(_watcher_dct.values())
+    row_count = 0
+    for watcher in watcher_li:
+        try:
+            row_count += watcher.poll()
+        except sqlite3.Error as e:
+            logger.warning(f'{watcher.db}: change log poll failed: {e}')
+    return row_count
+
+
+def _run():
+    while not _f_stop.wait(CHG_POLL_MS / 1000):
+        poll_all()
+
+
+def start():
+    """Starts the poll thread"""
+    global _thread
+    with _lock:
+        if _thread:
+            return
+        _f_stop.clear()
+        _thread = threading.Thread(target=_run, name='change_log', daemon=True)
+        _thread.start()
+
+
+def stop():
+    global _thread
+    with _lock:
+        thread = _thread
+        _thread = None
+        _f_stop.set()
+    if thread:
+        thread.join()
+    with _lock:
+        watcher_li = list(_watcher_dct.values())
+    for watcher in watcher_li:
+        logger.info(watcher.stats_str())
+        watcher.close()
+
+
+def stats_str() -> str:
+    with _lock:
+        return '\n'.join(f'Change log {watcher.stats_str()}' for watcher in _watcher_dct.values())
@@ -0,0 +1,82 @@
+"""Connection pool metrics per engine, read-write (rw) and read-only (ro) engines of a DB are counted apart"""
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from time import perf_counter
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.INFO)
+
+_lock = threading.Lock()
+_eng_stats_dct: dict[Engine, "PoolStats"] = {}
+
+
+@dataclass
+class PoolStats:
+    db_file: str
+    mode: str
+    connect_count: int = 0
+    checkout_count: int = 0
+    # connections checked out now and at most
+    checked_out: int = 0
+    max_checked_out: int = 0
+    # time from checkout to checkin
+    hold_ms: float = 0.0
+    max_hold_ms: float = 0.0
+
+    def stats_str(self) -> str:
+        avg_hold_ms = self.hold_ms / self.checkout_count if self.checkout_count else 0.0
+        return f'{os.path.basename(self.db_file)} {self.mode}: {self.connect_count} connects, ' \
+               f'{self.checkout_count} checkouts, {self.checked_out} checked out (max {self.max_checked_out}), ' \
+               f'hold avg {avg_hold_ms:.1f} ms max {self.max_hold_ms:.1f} ms'
+
+
+def listen_pool_stats(eng: Engine, mode: str) -> PoolStats:
+    """Counts the connections of eng from now on, once per engine"""
+    with _lock:
+        if stats := _eng_stats_dct.get(eng):
+            return stats
+        stats = PoolStats(eng.url.database, mode)
+        _eng_stats_dct[eng] = stats
+
+    # noinspection PyUnusedLocal
+    def on_connect(dbapi_con, con_record):
+        with _lock:
+            stats.connect_count += 1
+
+    # noinspection PyUnusedLocal
+    def on_checkout(dbapi_con, con_record, con_proxy):
+        con_record.info['g3_checkout'] = perf_counter()
+        with _lock:
+            stats.checkout_count += 1
+            stats.checked_out += 1
+            stats.max_checked_out = max(stats.max_checked_out, stats.checked_out)
+
+    # noinspection PyUnusedLocal
+    def on_checkin(dbapi_con, con_record):
+        if (start := con_record.info.pop('g3_checkout', None)) is None:
+            return
+        hold_ms = (perf_counter() - start) * 1000
+        with _lock:
+            stats.checked_out -= 1
+            stats.hold_ms += hold_ms
+            stats.max_hold_ms = max(stats.max_hold_ms, hold_ms)
+
+    event.listen(eng, 'connect', on_connect)
+    event.listen(eng, 'checkout', on_checkout)
+    event.listen(eng, 'checkin', on_checkin)
+    return stats
+
+
+def pool_stats_li() -> list[PoolStats]:
+    with _lock:
+        return sorted(_eng_stats_dct.values(), key=lambda stats: (stats.db_file, stats.mode))
+
+
+def pool_stats_str() -> str:
+    return '\n'.join(stats.stats_str() for stats in pool_stats_li())
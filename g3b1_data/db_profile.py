@@ -0,0 +1,138 @@
+"""Named SQLite connection profiles, applied per engine by a connect listener.
+
+foreign_keys is set for every engine by tg_db_sqlite.set_sqlite_pragma, the profiles tune the rest.
+The profile of an engine is passed to apply_profile, e.g. by db_registry.create_eng, or configured per DB file
+by the environment variable g3b1_db_profile_{file name without extension}, e.g. g3b1_db_profile_g3b1_tg=wal_full.
+Otherwise it is the one of FILE_PROFILE_dct, wal for g3b1_tg.db: the readers of the bot's messages use the
+read-only engine of db_registry.ro_eng, which requires WAL. The other DBs get DB_PROFILE, the SQLite defaults unless
+set by the environment variable g3b1_db_profile."""
+import logging
+import os
+import re
+import sqlite3
+import threading
+from dataclasses import dataclass
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.INFO)
+
+
+@dataclass(frozen=True)
+class DbProfile:
+    name: str
+    journal_mode: str = 'DELETE'
+    synchronous: str = 'FULL'
+    # bytes
+    mmap_size: int = 0
+    # pages if positive, KiB if negative
+    cache_size: int = -2000
+    temp_store: str = 'DEFAULT'
+    # ms
+    busy_timeout: int = 0
+
+    def pragma_li(self, read_only: bool = False) -> list[str]:
+        """A read-only connection can not set the journal_mode, it is the one of the DB file"""
+        # busy_timeout first, switching the journal_mode may have to wait for other connections
+        pragma_li = [f'PRAGMA busy_timeout = {self.busy_timeout}']
+        if not read_only:
+            pragma_li.append(f'PRAGMA journal_mode = {self.journal_mode}')
+        return pragma_li + [f'PRAGMA synchronous = {self.synchronous}',
+                            f'PRAGMA mmap_size = {self.mmap_size}',
+                            f'PRAGMA cache_size = {self.cache_size}',
+                            f'PRAGMA temp_store = {self.temp_store}']
+
+    def is_wal(self) -> bool:
+        return self.journal_mode.upper() == 'WAL'
+
+
+PROFILE_DCT: dict[str, DbProfile] = {profile.name: profile for profile in [
+    # SQLite defaults, readers block the writer
+    DbProfile('default'),
+    # readers and the writer run concurrently, a commit is durable after the next checkpoint
+    DbProfile('wal', journal_mode='WAL', synchronous='NORMAL', mmap_size=256 * 1024 * 1024,
+              cache_size=-32000, temp_store='MEMORY', busy_timeout=5000),
+    # as wal, each commit is durable
+    DbProfile('wal_full', journal_mode='WAL', synchronous='FULL', mmap_size=256 * 1024 * 1024,
+              cache_size=-32000, temp_store='MEMORY', busy_timeout=5000),
+    # bulk imports and benchmarks only, a power loss may lose the latest commits
+    DbProfile('bulk', journal_mode='WAL', synchronous='OFF', mmap_size=256 * 1024 * 1024,
+              cache_size=-128000, temp_store='MEMORY', busy_timeout=5000),
+]}
+
+DB_PROFILE = os.environ.get('g3b1_db_profile', 'default')
+# file name without extension -> profile, unless configured by the environment
+FILE_PROFILE_dct: dict[str, str] = {'g3b1_tg': 'wal'}
+
+REPORT_PRAGMA_li = ['journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store', 'busy_timeout',
+                    'foreign_keys', 'page_size']
+
+_lock = threading.Lock()
+_eng_profile_dct: dict[Engine, DbProfile] = {}
+# engines of read-only connections
+_ro_eng_set: set[Engine] = set()
+
+
+def exec_profile(dbapi_con: sqlite3.Connection, profile: DbProfile, read_only: bool = False):
+    cursor = dbapi_con.cursor()
+    try:
+        for pragma in profile.pragma_li(read_only):
+            try:
+                cursor.execute(pragma)
+            except sqlite3.OperationalError as e:
+                # e.g. the journal_mode can not be changed while another process reads
+                logger.warning(f'{pragma}: {e}')
+    finally:
+        cursor.close()
+
+
+def profile_name_of(db_file: str) -> str:
+    """The profile configured for the DB file, the one of FILE_PROFILE_dct or DB_PROFILE by default"""
+    # the paths are Windows paths, whatever the OS
+    stem = os.path.splitext(re.split(r'[\\/]', db_file or '')[-1])[0]
+    return os.environ.get(f'g3b1_db_profile_{stem}', FILE_PROFILE_dct.get(stem, DB_PROFILE))
+
+
+def apply_profile(eng: Engine, name: str = None, read_only: bool = False) -> DbProfile:
+    """Connections of eng are opened with the profile, by default the one configured for its DB file.
+    Connections already pooled are discarded. read_only for an engine of mode=ro connections."""
+    profile = PROFILE_DCT[name or profile_name_of(eng.url.database)]
+    with _lock:
+        f_new = eng not in _eng_profile_dct
+        _eng_profile_dct[eng] = profile
+        if read_only:
+            _ro_eng_set.add(eng)
+    if f_new:
+        # noinspection PyUnusedLocal
+        def on_connect(dbapi_con, con_record):
+            exec_profile(dbapi_con, _eng_profile_dct[eng], eng in _ro_eng_set)
+
+        event.listen(eng, 'connect', on_connect)
+    else:
+        eng.dispose()
+    return profile
+
+
+def profile_of(eng: Engine) -> DbProfile:
+    return _eng_profile_dct.get(eng)
+
+
+def pragma_report(eng: Engine) -> dict[str,]:
+    """The pragmas in effect for a new connection of eng"""
+    with eng.connect() as con:
+        return {pragma: con.execute(f'PRAGMA {pragma}').scalar() for pragma in REPORT_PRAGMA_li}
+
+
+def pragma_report_str(eng: Engine) -> str:
+    profile = profile_of(eng)
+    pragma_str = ', '.join(f'{k}={v}' for k, v in pragma_report(eng).items())
+    mode = ' ro' if eng in _ro_eng_set else ''
+    return f'{eng.url.database} [{profile.name if profile else "-"}{mode}]: {pragma_str}'
+
+
+def log_pragma_report(eng_li: list[Engine]):
+    for eng in eng_li:
+        logger.info(pragma_report_str(eng))
@@ -0,0 +1,116 @@
+"""Process-wide registry of the engine and MetaData per database file.
+
+In WAL mode each DB has a second engine of read-only connections (mode=ro) for the pure reads, see ro_eng.
+Readers there work on a snapshot and neither wait for the writers nor hold them up. g3b1_tg.db is in WAL mode by
+default, see db_profile.FILE_PROFILE_dct; the reads of a DB in another journal mode use its read-write engine."""
+import importlib
+import logging
+import os
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+from sqlalchemy import MetaData, create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from g3b1_data.db_metrics import listen_pool_stats
+from g3b1_data.db_profile import apply_profile, profile_of
+from g3b1_data.schema_cache import LazyMetaData
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.WARN)
+
+POOL_SIZE = 5
+
+_lock = threading.Lock()
+# db file key -> (engine, meta data)
+_db_dct: dict[str, tuple[Engine, MetaData]] = {}
+# db file key -> read-only engine
+_ro_dct: dict[str, Engine] = {}
+# g3_m_str -> db file key
+_g3m_dct: dict[str, str] = {}
+
+
+def db_key(db_file: str) -> str:
+    return os.path.normcase(os.path.abspath(db_file))
+
+
+def create_eng(db_file: str, profile: str = None) -> Engine:
+    """Engine with a connection pool, SQLAlchemy defaults to NullPool for SQLite files.
+    profile: the name of its connection profile, by default the one configured for the file, see db_profile"""
+    eng = create_engine(f"sqlite:///{db_file}", poolclass=QueuePool, pool_size=POOL_SIZE,
+                        connect_args={'check_same_thread': False})
+    apply_profile(eng, profile)
+    listen_pool_stats(eng, 'rw')
+    return eng
+
+
+def create_ro_eng(db_file: str) -> Engine:
+    """Engine of read-only connections to an existing DB file, opened with a mode=ro URI"""
+    uri = f'file:{pathname2url(os.path.abspath(db_file))}?mode=ro'
+    return create_engine(f"sqlite:///{db_file}", poolclass=QueuePool, pool_size=POOL_SIZE,
+                         creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False))
+
+
+def ro_eng(eng: Engine) -> Engine:
+    """The read-only engine of the DB of eng for pure reads, created on first request.
+    Falls back to eng itself if the connection profile of eng is not in WAL mode, readers block the writers anyway
+    then, or if the DB file does not exist yet, a mode=ro connection can not create it."""
+    key = db_key(eng.url.database) if eng.url.database else None
+    if ro := _ro_dct.get(key):
+        return ro
+    profile = profile_of(eng)
+    if not key or not profile or not profile.is_wal() or not os.path.exists(eng.url.database):
+        return eng
+    with _lock:
+        if key not in _ro_dct:
+            logger.debug(f'Create read-only engine for {eng.url.database}')
+            ro = create_ro_eng(eng.url.database)
+            apply_profile(ro, profile.name, read_only=True)
+            listen_pool_stats(ro, 'ro')
+            _ro_dct[key] = ro
+        return _ro_dct[key]
+
+
+def register(eng: Engine, md: MetaData, profile: str = None) -> tuple[Engine, MetaData]:
+    """Register the engine of a module's data package. It replaces an entry created lazily for the same file.
+    The engine gets the connection profile passed or, unless it has one, the one configured for the file."""
+    if profile or not profile_of(eng):
+        apply_profile(eng, profile)
+    listen_pool_stats(eng, 'rw')
+    key = db_key(eng.url.database)
+    with _lock:
+        _db_dct[key] = (eng, md)
+        return _db_dct[key]
+
+
+def eng_md_by_file(db_file: str) -> tuple[Engine, MetaData]:
+    """Engine and MetaData of the DB, created on first request. Tables are reflected on first access."""
+    key = db_key(db_file)
+    if entry := _db_dct.get(key):
+        return entry
+    with _lock:
+        if key not in _db_dct:
+            logger.debug(f'Create engine for {db_file}')
+            eng = create_eng(db_file)
+            _db_dct[key] = (eng, LazyMetaData(eng))
+        return _db_dct[key]
+
+
+def eng_md_by_g3m(g3_m_str: str) -> tuple[Engine, MetaData]:
+    """Engine eng_{G3M} and MetaData md_{G3M} of the package {g3_m_str}.data"""
+    if key := _g3m_dct.get(g3_m_str):
+        return _db_dct[key]
+    modu = importlib.import_module(f'{g3_m_str}.data')
+    eng: Engine = getattr(modu, f'eng_{g3_m_str.upper()}')
+    md: MetaData = getattr(modu, f'md_{g3_m_str.upper()}')
+    entry = register(eng, md)
+    _g3m_dct[g3_m_str] = db_key(eng.url.database)
+    return entry
+
+
+def eng_li() -> list[Engine]:
+    """The registered engines and the read-only engines created so far"""
+    with _lock:
+        return [eng for eng, md in _db_dct.values()] + list(_ro_dct.values())
@@ -1,9 +1,12 @@
 import importlib
+from functools import cache
 from typing import Optional, TypeVar, Generic, Callable, Union, Any
 
 from sqlalchemy import MetaData
 from sqlalchemy.engine import Engine
 
+from g3b1_data import db_registry
+
 G3_M_TRANS = 'trans'
 G3_M_MONEY = 'money'
 G3_M_SUBSCRIBE = 'subscribe'
@@ -25,6 +28,13 @@ class EntTy(Generic[ET]):
         else:
             return ent.id_
 
+    @classmethod
+    def set_ent_id(cls, ent: Any, id_: int):
+        if hasattr(ent, 'id'):
+            ent.id = id_
+        else:
+            ent.id_ = id_
+
     @classmethod
     def from_ent(cls, ent: Any):
         if hasattr(ent, 'id'):
@@ -92,6 +102,10 @@ class EntTy(Generic[ET]):
     def __hash__(self) -> int:
         return hash(self.id)
 
+    def __deepcopy__(self, memo: dict) -> "EntTy":
+        # a type, the copies of an entity share it, see cache.EntCache
+        return self
+
 
 print('initializing ENT_TY_LI')
 ENT_TY_li = []
@@ -111,14 +125,30 @@ class EntId(Generic[ET]):
         return EntId(ent.ent_ty(), ent.id)
 
 
+class LoadPlan:
+    """Relations and columns of an entity to load.
+    rel_dct maps attributes of EntTy.it_ent_ty_dct to the plan for the child entities,
+    relations missing in rel_dct are not loaded. col_li restricts the columns selected,
+    the id and the column referencing the parent are always selected."""
+
+    def __init__(self, rel_dct: dict[str, "LoadPlan"] = None, col_li: list[str] = None) -> None:
+        super().__init__()
+        self.rel_dct: dict[str, LoadPlan] = rel_dct if rel_dct else {}
+        self.col_li: list[str] = col_li
+
+    @classmethod
+    def full(cls, ent_ty: EntTy, depth: int = -1) -> "LoadPlan":
+        """All columns and all relations, depth levels deep, -1 for the whole entity graph"""
+        if depth == 0:
+            return cls()
+        return cls({k: cls.full(v, depth - 1) for k, v in ent_ty.it_ent_ty_dct.items()})
+
+
+@cache
+def from_row_any_by_g3m(g3_m_str: str) -> Callable:
+    return getattr(importlib.import_module(f'{g3_m_str}.data.integrity'), 'from_row_any')
+
+
 def get_meta_attr(ent_ty: EntTy) -> (Callable, MetaData, Engine):
-    from_row_any: Callable = getattr(
-        importlib.import_module(f'{ent_ty.g3_m_str}.data.integrity'), 'from_row_any'
-    )
-    md: MetaData = getattr(
-        importlib.import_module(f'{ent_ty.g3_m_str}.data'), f'md_{ent_ty.g3_m_str.upper()}'
-    )
-    eng: Engine = getattr(
-        importlib.import_module(f'{ent_ty.g3_m_str}.data'), f'eng_{ent_ty.g3_m_str.upper()}'
-    )
-    return from_row_any, md, eng
+    eng, md = db_registry.eng_md_by_g3m(ent_ty.g3_m_str)
+    return from_row_any_by_g3m(ent_ty.g3_m_str), md, eng
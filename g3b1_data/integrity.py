@@ -1,4 +1,3 @@
-import importlib
 import inspect
 import logging
 from functools import wraps
@@ -10,12 +9,17 @@ from sqlalchemy.engine import Row, CursorResult, Engine, Result
 from sqlalchemy.sql import Select
 
 from g3b1_cfg.tg_cfg import G3Ctx
+from g3b1_data import db_registry
 from g3b1_data.entities import EntTy
+from g3b1_data.py_meta import ent_snapshot
 from g3b1_log.log import cfg_logger
 from generic_mdl import ent_ty_by_tbl_name
 
 logger = cfg_logger(logging.getLogger(__name__), logging.DEBUG)
 
+# Max. number of ids per IN-query
+IN_CHUNK = 500
+
 
 def ref_cascade(ent_r) -> list[Table]:
     tbl_li: list[Table] = []
@@ -26,26 +30,18 @@ def ref_cascade(ent_r) -> list[Table]:
 
 
 def engine_by_ent_ty(ent_ty: EntTy) -> Engine:
-    engine: Engine = getattr(
-        importlib.import_module(f'{ent_ty.g3_m_str}.data'), f'eng_{ent_ty.g3_m_str.upper()}'
-    )
-    return engine
+    return db_registry.eng_md_by_g3m(ent_ty.g3_m_str)[0]
 
 
 def meta_by_ent_ty(ent_ty: EntTy) -> MetaData:
-    meta_data: MetaData = getattr(
-        importlib.import_module(f'{ent_ty.g3_m_str}.data'), f'md_{ent_ty.g3_m_str.upper()}'
-    )
-    return meta_data
+    return db_registry.eng_md_by_g3m(ent_ty.g3_m_str)[1]
 
 
 def ref_tbl_dct(ent_ty: EntTy) -> dict[Table, list[str]]:
     if ent_ty.ref_tbl_dct is not None:
         return ent_ty.ref_tbl_dct
         # noinspection PyAttributeOutsideInit
-    md: MetaData = getattr(
-        importlib.import_module(f'{ent_ty.g3_m_str}.data'), f'md_{ent_ty.g3_m_str.upper()}'
-    )
+    md: MetaData = meta_by_ent_ty(ent_ty)
     ent_ty.ref_tbl_dct = {}
     col_sfx = f'{ent_ty.tbl_name}_id'
     for t in md.tables:
@@ -88,33 +84,77 @@ def ref(ent_r) -> list[Table]:
 def orm(con: Connection, tbl: Table, row: Row, from_row_any: Callable, repl_dct=None) -> dict[str, Any]:
     if repl_dct is None:
         repl_dct = {}
+    if row is None:
+        logger.error(f'row is None. Info: Tbl: {tbl}')
+        return repl_dct
+    repl_dct.update(orm_li(con, tbl, [row], from_row_any, repl_dct)[0])
+    return repl_dct
+
+
+def fk_tbl_dct(tbl: Table, skip_col_li: list[str]) -> dict[str, Table]:
+    """Columns of tbl referencing the id of another table, mapped to the referenced table"""
+    fk_dct: dict[str, Table] = {}
     col: Column
     for col_id, col in tbl.columns.items():
-        if col_id in repl_dct.keys() or col_id in ['act_ty', 'sus_bkey', 'crcy']:
+        if col_id in skip_col_li or col_id in ['act_ty', 'sus_bkey', 'crcy']:
             continue
         fk: ForeignKey
         for fk in col.foreign_keys:
             if fk.column.key != 'id':
                 logger.error(f'foreign key ({fk}) target is not a column with the name "id"')
                 continue
-            fk_tbl: Table = fk.column.table
-            row.keys()
-            if row is None:
-                logger.error(f'row is None. Info: Tbl: {tbl} - FK: {fk}')
-                continue
-            fk_ref_col_val = row[col_id]
-            if not fk_ref_col_val:
-                repl_dct[col_id] = None
-                break
+            fk_dct[col_id] = fk.column.table
+            break
+    return fk_dct
+
 
-            if not isinstance(fk_ref_col_val, int):
-                break
+def orm_li(con: Connection, tbl: Table, row_li: list[Row], from_row_any: Callable, repl_dct: dict = None,
+           ent_req_dct: dict[tuple[str, int], Any] = None) -> list[dict[str, Any]]:
+    """Resolves the foreign keys of all rows. The distinct ids per referenced table are loaded with one IN-query.
 
+    Args:
+        repl_dct: Values for all rows, their columns are not resolved.
+        ent_req_dct: (table name, id) -> entity already hydrated. Pass the same dict for all calls of one request.
+    Returns:
+        The repl_dct per row
+    """
+    if repl_dct is None:
+        repl_dct = {}
+    if ent_req_dct is None:
+        ent_req_dct = {}
+    fk_dct = fk_tbl_dct(tbl, list(repl_dct.keys()))
+    if row_li:
+        # the columns not selected, e.g. by the col_li of a LoadPlan, are not resolved
+        fk_dct = {col_id: fk_tbl for col_id, fk_tbl in fk_dct.items() if col_id in row_li[0].keys()}
+
+    id_set_dct: dict[Table, set[int]] = {}
+    for row in row_li:
+        for col_id, fk_tbl in fk_dct.items():
+            fk_ref_col_val = row[col_id]
+            if fk_ref_col_val and isinstance(fk_ref_col_val, int) and (fk_tbl.name, fk_ref_col_val) not in ent_req_dct:
+                id_set_dct.setdefault(fk_tbl, set()).add(fk_ref_col_val)
+
+    for fk_tbl, id_set in id_set_dct.items():
+        ent_ty = ent_ty_by_tbl_name(fk_tbl.name, [G3Ctx.g3_m_str, 'subscribe'])
+        id_li = list(id_set)
+        for idx in range(0, len(id_li), IN_CHUNK):
             sql_stmnt: Select = select(fk_tbl)
-            sql_stmnt = sql_stmnt.where(fk_tbl.columns.id == int(fk_ref_col_val))
+            sql_stmnt = sql_stmnt.where(fk_tbl.columns.id.in_(id_li[idx:idx + IN_CHUNK]))
             rs: CursorResult = con.execute(sql_stmnt)
-            fk_ref_row: Row = rs.first()
-            ent_ty = ent_ty_by_tbl_name(fk_tbl.name, [G3Ctx.g3_m_str, 'subscribe'])
-            repl_dct[col_id] = from_row_any(ent_ty, fk_ref_row, {})
-            break
-    return repl_dct
+            fk_ref_row: Row
+            for fk_ref_row in rs.fetchall():
+                ent = from_row_any(ent_ty, fk_ref_row, {})
+                ent_snapshot(ent)
+                ent_req_dct[(fk_tbl.name, fk_ref_row['id'])] = ent
+
+    repl_dct_li: list[dict[str, Any]] = []
+    for row in row_li:
+        row_repl_dct = dict(repl_dct)
+        for col_id, fk_tbl in fk_dct.items():
+            fk_ref_col_val = row[col_id]
+            if not fk_ref_col_val:
+                row_repl_dct[col_id] = None
+            elif isinstance(fk_ref_col_val, int):
+                row_repl_dct[col_id] = ent_req_dct.get((fk_tbl.name, fk_ref_col_val))
+        repl_dct_li.append(row_repl_dct)
+    return repl_dct_li
@@ -0,0 +1,77 @@
+"""Periodic maintenance jobs of the bot process, e.g. the archiving of tg_message, see tg_db.
+
+The jobs run one after the other on a thread of their own, at start and then every MAINT_INTERVAL_S seconds.
+A job must be idempotent and cheap if there is nothing to do: each bot process sharing the DB files runs it.
+A failing job is logged, the others and the next run are not affected."""
+import logging
+import threading
+from time import perf_counter
+from typing import Callable
+
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.INFO)
+
+# the archive periods are months, a daily run moves the messages of a period shortly after its end
+MAINT_INTERVAL_S = 24 * 60 * 60
+
+_lock = threading.Lock()
+# job name -> job
+_job_dct: dict[str, Callable[[], object]] = {}
+_thread: threading.Thread = None
+_f_stop = threading.Event()
+
+
+def schedule(name: str, job: Callable[[], object]):
+    """job() is run by the maintenance thread, a job of the same name is replaced"""
+    with _lock:
+        _job_dct[name] = job
+
+
+def run_all() -> dict[str, object]:
+    """Runs the jobs now. Returns the result of each job, the exception for a failed one."""
+    with _lock:
+        job_li = list(_job_dct.items())
+    result_dct: dict[str, object] = {}
+    for name, job in job_li:
+        if _f_stop.is_set() and _thread:
+            # stop() waits for the thread, the jobs left are skipped
+            break
+        start = perf_counter()
+        try:
+            result_dct[name] = job()
+        except Exception as e:
+            logger.exception(e)
+            result_dct[name] = e
+        logger.info(f'Maintenance {name} done in {(perf_counter() - start) * 1000:.0f} ms')
+    return result_dct
+
+
+def _run(interval_s: float):
+    while True:
+        run_all()
+        if _f_stop.wait(interval_s):
+            return
+
+
+def start(interval_s: float = MAINT_INTERVAL_S):
+    """Starts the maintenance thread, its first run is now"""
+    global _thread
+    with _lock:
+        if _thread:
+            return
+        _f_stop.clear()
+        _thread = threading.Thread(target=_run, args=(interval_s,), name='maint', daemon=True)
+        _thread.start()
+
+
+def stop():
+    """Stops the maintenance thread, waits for the job running to end"""
+    global _thread
+    with _lock:
+        thread = _thread
+        _f_stop.set()
+    if thread:
+        thread.join()
+    with _lock:
+        _thread = None
@@ -0,0 +1,35 @@
+"""Versioned schema migrations of the SQLite DBs based on PRAGMA user_version"""
+import logging
+
+from sqlalchemy.engine import Engine, Connection
+
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.INFO)
+
+
+def db_version(con: Connection) -> int:
+    return con.execute('PRAGMA user_version').scalar()
+
+
+def migrate(eng: Engine, mig_li: list[tuple[int, list[str]]]) -> int:
+    """Executes all migrations with a version above the user_version of the DB, in the order of mig_li.
+    Each migration runs in its own transaction, together with setting the new user_version.
+    Statements should be idempotent (IF NOT EXISTS...), another process might migrate at the same time.
+
+    Returns:
+        The user_version of the DB after migration
+    """
+    with eng.connect() as con:
+        version = db_version(con)
+    for mig_version, sql_li in mig_li:
+        if mig_version <= version:
+            continue
+        with eng.begin() as con:
+            for sql in sql_li:
+                logger.debug(f'{eng.url.database} v{mig_version}: {sql}')
+                con.execute(sql)
+            con.execute(f'PRAGMA user_version = {mig_version}')
+        logger.info(f'{eng.url.database} migrated to v{mig_version}')
+        version = mig_version
+    return version
@@ -16,6 +16,8 @@ from g3b1_log.log import cfg_logger
 
 logger = cfg_logger(logging.getLogger(__name__), logging.DEBUG)
 
+SNAPSHOT_ATTR = '_g3_snapshot'
+
 
 def by_row_initializer(func):
     names, varargs, keywords, defaults, kwonlyargs, kwonlydefaults, annotations = inspect.getfullargspec(func)
@@ -78,7 +80,8 @@ def ent_as_dict_sql(ent: Any, col_li: list[str] = None) -> dict[str, ]:
 
 
 def ent_as_dict(ent: Any) -> dict[str,]:
-    val_dct = vars(ent)
+    # copy, popping from vars(ent) would delete the attribute of the entity
+    val_dct = {k: v for k, v in vars(ent).items() if not k.startswith('_')}
     new_val_dct = {}
     if 'id_' in val_dct:
         new_val_dct['id'] = val_dct['id_']
@@ -96,6 +99,20 @@ def ent_as_dict(ent: Any) -> dict[str,]:
     return new_val_dct
 
 
+def ent_snapshot(ent: Any) -> None:
+    """Remember the column values of the entity as loaded from or written to the DB"""
+    setattr(ent, SNAPSHOT_ATTR, ent_as_dict_sql(ent))
+
+
+def ent_dirty_dct(ent: Any) -> dict[str,]:
+    """Column values changed since the last ent_snapshot, all values if there is no snapshot"""
+    val_dct = ent_as_dict_sql(ent)
+    snapshot_dct: dict = getattr(ent, SNAPSHOT_ATTR, None)
+    if snapshot_dct is None:
+        return val_dct
+    return {k: v for k, v in val_dct.items() if k not in snapshot_dct or snapshot_dct[k] != v}
+
+
 def build_module_str(py_file: str) -> str:
     return os.path.normpath(
         py_file.replace(env_g3b1_code, '')[1:].replace(f'.py', '').replace(os.sep, '.')). \
@@ -0,0 +1,169 @@
+"""MetaData reflecting its tables lazily, backed by an on-disk cache of the reflected schema.
+
+The cache file of a DB holds the tables reflected by previous runs together with the PRAGMA schema_version
+they were reflected at. It is used only while the schema_version of the DB matches, any DDL invalidates it.
+Tables missing in the cache are reflected on first access and added to the cache at exit."""
+import atexit
+import hashlib
+import logging
+import os
+import pickle
+import threading
+
+from sqlalchemy import MetaData, Table, util
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import NoSuchTableError
+
+from constants import env_g3b1_dir
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.WARN)
+
+SCHEMA_CACHE_DIR = f'{env_g3b1_dir}{os.sep}schema_cache'
+
+
+def cache_file(db_file: str) -> str:
+    db_hash = hashlib.sha1(os.path.normcase(os.path.abspath(db_file)).encode()).hexdigest()[:10]
+    return os.path.join(SCHEMA_CACHE_DIR, f'{os.path.basename(db_file)}.{db_hash}.schema')
+
+
+def schema_version(eng: Engine) -> int:
+    with eng.connect() as con:
+        return con.execute('PRAGMA schema_version').scalar()
+
+
+def load_cache(db_file: str, version: int) -> MetaData:
+    """The cached MetaData if it has been reflected at the schema version, otherwise None"""
+    try:
+        with open(cache_file(db_file), 'rb') as f:
+            cache_version, md = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f'Schema cache of {db_file} not readable: {e}')
+        return None
+    if cache_version != version:
+        logger.debug(f'Schema cache of {db_file} outdated: v{cache_version}, DB v{version}')
+        return None
+    return md
+
+
+def save_cache(db_file: str, version: int, md: MetaData):
+    os.makedirs(SCHEMA_CACHE_DIR, exist_ok=True)
+    file = cache_file(db_file)
+    # replace, a concurrent reader sees the old or the new file
+    with open(f'{file}.tmp', 'wb') as f:
+        pickle.dump((version, md), f)
+    os.replace(f'{file}.tmp', file)
+
+
+class _LazyTableDict(util.FacadeDict):
+    """tables of LazyMetaData, md.tables[name] loads a missing table.
+    Iterating the tables loads all tables of the DB first."""
+
+    def __new__(cls, md: "LazyMetaData"):
+        new = dict.__new__(cls)
+        object.__setattr__(new, '_md', md)
+        return new
+
+    # noinspection PyUnusedLocal
+    def __init__(self, md: "LazyMetaData") -> None:
+        dict.__init__(self)
+
+    def __missing__(self, key: str) -> Table:
+        return self._md.load_table(key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        self._md.load_all()
+        return dict.__iter__(self)
+
+    def __len__(self) -> int:
+        self._md.load_all()
+        return dict.__len__(self)
+
+    def keys(self):
+        self._md.load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._md.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self._md.load_all()
+        return dict.items(self)
+
+
+class LazyMetaData(MetaData):
+    """MetaData of the DB of eng. md.tables[name] takes the table from the schema cache or reflects it,
+    together with the tables referenced by its foreign keys.
+    `name in md.tables` is True for the tables loaded so far only."""
+
+    def __init__(self, eng: Engine) -> None:
+        super().__init__()
+        self.tables = _LazyTableDict(self)
+        self.eng = eng
+        self.db_file = eng.url.database
+        self._lock = threading.RLock()
+        self._f_all = False
+        self._version = schema_version(eng)
+        self._cache_md = load_cache(self.db_file, self._version)
+        # tables reflected, not taken from the cache
+        self._reflect_count = 0
+        atexit.register(self.save)
+
+    def load_table(self, key: str) -> Table:
+        with self._lock:
+            if dict.__contains__(self.tables, key):
+                return dict.__getitem__(self.tables, key)
+            if self._cache_md is not None and key in self._cache_md.tables:
+                tbl = self._cache_md.tables[key].to_metadata(self)
+                for fk in tbl.foreign_keys:
+                    # referenced tables are loaded with the table, as by reflection.
+                    # [schema.]table.column, fk.column would look the table up before it is loaded
+                    self.tables.get(fk.target_fullname.split('.')[-2])
+                return tbl
+            try:
+                tbl = Table(key, self, autoload_with=self.eng)
+            except NoSuchTableError:
+                raise KeyError(key)
+            self._reflect_count += 1
+            return tbl
+
+    def load_all(self):
+        if self._f_all:
+            return
+        with self._lock:
+            with self.eng.connect() as con:
+                name_li = [row[0] for row in
+                           con.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                                       "AND name NOT LIKE 'sqlite_%'")]
+            self._f_all = True
+            for name in name_li:
+                self.load_table(name)
+
+    def save(self):
+        """Write the tables loaded to the cache, if tables have been reflected and the schema is unchanged"""
+        with self._lock:
+            if not self._reflect_count or schema_version(self.eng) != self._version:
+                return
+            md = MetaData()
+            if self._cache_md is not None:
+                for tbl in self._cache_md.tables.values():
+                    tbl.to_metadata(md)
+            for key in dict.keys(self.tables):
+                if key not in md.tables:
+                    dict.__getitem__(self.tables, key).to_metadata(md)
+            try:
+                save_cache(self.db_file, self._version, md)
+            except Exception as e:
+                logger.warning(f'Schema cache of {self.db_file} not written: {e}')
+                return
+            self._cache_md = md
+            self._reflect_count = 0
@@ -1,17 +1,20 @@
 import logging
-from typing import Callable, Any, Union
+import sys
+from typing import Callable, Any, Union, Optional
 
-from sqlalchemy import MetaData, select
+from sqlalchemy import MetaData, select, event, text
 from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.engine import Connection, Engine
-from sqlalchemy.engine import Result
+from sqlalchemy.engine import Result, CursorResult
 from sqlalchemy.sql import Select
-from sqlalchemy.sql.schema import Table
+from sqlalchemy.sql.schema import Table, Column
 
 from decorator import ele_ty_converter
 from elements import EleVal
 from g3b1_cfg.tg_cfg import G3Ctx
-from g3b1_data import integrity
+from g3b1_data import integrity, db_registry, change_log
+from g3b1_data.aio import AioFacade, run as aio_run
+from g3b1_data.cache import upsert_cache, setng_cache
 from g3b1_data.elements import EleTy, EleVal
 from g3b1_data.entities import EntTy, EntId
 from g3b1_data.model import G3Result
@@ -20,6 +23,11 @@ from generic_mdl import ele_ty_by_ent_ty
 
 logger = cfg_logger(logging.getLogger(__name__), logging.WARN)
 
+# settings table -> its key columns
+SETNG_KEY_COL_dct: dict[str, list[str]] = {'user_chat_settings': ['tg_chat_id', 'tg_user_id'],
+                                           'chat_settings': ['tg_chat_id'], 'user_settings': ['tg_user_id']}
+SETNG_TBL_li = list(SETNG_KEY_COL_dct.keys())
+
 
 def chat_setting(
         chat_id: int, ele_ty: EleTy, ele_val: str = None) -> dict[str, ...]:
@@ -73,38 +81,53 @@ def ins_init_setng(user_id=0):
     if not user_id:
         user_id = G3Ctx.for_user_id()
     chat_id = G3Ctx.upd.effective_chat.id
+    db = db_registry.db_key(G3Ctx.eng.url.database)
 
-    with G3Ctx.eng.begin() as con:
-        ext_tg_chat: Table = G3Ctx.md.tables['ext_tg_chat']
-        values = dict(id=chat_id)
-        ext_insert: insert = insert(ext_tg_chat).values(values).on_conflict_do_update(
-            index_elements=['id'],
-            set_=values
-        )
-        con.execute(ext_insert)
-
-        ext_tg_user: Table = G3Ctx.md.tables['ext_tg_user']
-        values = dict(id=user_id)
-        ext_insert: insert = insert(ext_tg_user).values(values).on_conflict_do_update(
-            index_elements=['id'],
-            set_=values
-        )
-        con.execute(ext_insert)
+    # (table name, key, values) of the ext rows, idempotent: skipped if upserted by this process already
+    row_li: list[tuple[str, tuple, dict]] = [
+        ('ext_tg_chat', (chat_id,), dict(id=chat_id)),
+        ('ext_tg_user', (user_id,), dict(id=user_id))
+    ]
+    row_li = [row for row in row_li if not upsert_cache.is_unchanged(db, *row)]
 
+    with G3Ctx.eng.begin() as con:
+        for tbl_name, key_tup, values in row_li:
+            tbl: Table = G3Ctx.md.tables[tbl_name]
+            ins_stmnt: insert = insert(tbl).values(values).on_conflict_do_update(
+                index_elements=values.keys(),
+                set_=values
+            )
+            con.execute(ins_stmnt)
+        # the settings row is created if missing and left as it is otherwise
         tbl: Table = G3Ctx.md.tables['user_chat_settings']
-        values = {'tg_user_id': user_id, 'tg_chat_id': chat_id}
-        ins_stmnt: insert = insert(tbl).values(values).on_conflict_do_update(
-            index_elements=values.keys(),
-            set_=values
-        )
-        con.execute(ins_stmnt)
+        ins_stmnt: insert = insert(tbl).values({'tg_user_id': user_id, 'tg_chat_id': chat_id}). \
+            on_conflict_do_nothing(index_elements=['tg_user_id', 'tg_chat_id'])
+        rs: CursorResult = con.execute(ins_stmnt)
+    for row in row_li:
+        upsert_cache.remember(db, *row)
+    if rs.rowcount:
+        setng_cache.invalidate(db, 'user_chat_settings', chat_id, user_id)
 
 
 def iup_setng(params: dict[str, ...]) -> dict[str, ...]:
     return iup_setting(G3Ctx.eng, G3Ctx.md, params).result
 
 
+def iup_setng_li(ele_val_li: list[tuple[EleTy, Any]], is_chat_setng=False) -> dict[str, ...]:
+    """Writes the settings of ele_val_li of the current chat and user with one upsert"""
+    return iup_setting_li(G3Ctx.eng, G3Ctx.md, setng_scope(
+        (G3Ctx.chat_id(), G3Ctx.for_user_id()), is_chat_setng), ele_val_li).result
+
+
 def iup_setting(con: Union[Connection, Engine], meta_data: MetaData, params: dict[str, ...]) -> G3Result:
+    ele_val_li = [(params['ele_ty'], params.get('ele_val'))] if 'ele_ty' in params.keys() else []
+    g3r = iup_setting_li(con, meta_data, params, ele_val_li)
+    return G3Result(g3r.retco, params)
+
+
+def setng_values(params: dict[str, ...], ele_val_li: list[tuple[EleTy, Any]]) -> tuple[str, list[str], dict]:
+    """Table name, key columns and values of the upsert of ele_val_li in the scope (chat_id, user_id) of params.
+    None and 'None' are written as NULL."""
     is_chat, is_user, tbl_name, tg_chat_id, tg_user_id = chat_user_setng_params(params)
     values: dict = {}
     index_elements: list = []
@@ -114,12 +137,19 @@ def iup_setting(con: Union[Connection, Engine], meta_data: MetaData, params: dic
     if is_chat:
         values['tg_chat_id'] = tg_chat_id
         index_elements.append('tg_chat_id')
-    if 'ele_ty' in params.keys():
-        ele_ty: EleTy = params['ele_ty']
-        if 'ele_val' not in params or params['ele_val'] == 'None':
+    for ele_ty, ele_val in ele_val_li:
+        if ele_val is None or ele_val == 'None':
             values[ele_ty.col_name] = None
         else:
-            values[ele_ty.col_name] = params['ele_val']
+            values[ele_ty.col_name] = ele_val
+    return tbl_name, index_elements, values
+
+
+def iup_setting_li(con: Union[Connection, Engine], meta_data: MetaData, params: dict[str, ...],
+                   ele_val_li: list[tuple[EleTy, Any]]) -> G3Result:
+    """Writes the settings of ele_val_li in the scope (chat_id and/or user_id) of params with one upsert.
+    It is always executed: the row may have been changed by another process since this one wrote it."""
+    tbl_name, index_elements, values = setng_values(params, ele_val_li)
     tbl_settings: Table = meta_data.tables[tbl_name]
 
     insert_stmnt: insert = insert(tbl_settings).values(values).on_conflict_do_update(
@@ -128,22 +158,88 @@ def iup_setting(con: Union[Connection, Engine], meta_data: MetaData, params: dic
     )
     logger.debug(f"InsUpd statement: {insert_stmnt}")
     con.execute(insert_stmnt)
-    return G3Result(0, params)
+    setng_cache_invalidate(con, tbl_name, values.get('tg_chat_id', 0), values.get('tg_user_id', 0))
+    return G3Result(0, values)
+
+
+def iup_setting_many(con: Union[Connection, Engine], meta_data: MetaData, params_li: list[dict[str, ...]],
+                     ele_val_li: list[tuple[EleTy, Any]]) -> G3Result:
+    """Writes the settings of ele_val_li in each scope of params_li, e.g. for many chats, in one transaction with
+    one executemany. The scopes must be of the same kind, chat, user or chat-user.
+    Returns the number of scopes written."""
+    if not params_li:
+        return G3Result(0, 0)
+    upsert_li = [setng_values(params, ele_val_li) for params in params_li]
+    tbl_name, index_elements = upsert_li[0][:2]
+    if any(upsert[0] != tbl_name for upsert in upsert_li):
+        raise ValueError(f'Scopes of different settings tables, {tbl_name} expected')
+    tbl_settings: Table = meta_data.tables[tbl_name]
+    insert_stmnt: insert = insert(tbl_settings)
+    insert_stmnt = insert_stmnt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={k: insert_stmnt.excluded[k] for k in upsert_li[0][2].keys()}
+    )
+
+    # noinspection PyShadowingNames
+    def wrapped(con: Connection):
+        con.execute(insert_stmnt, [upsert[2] for upsert in upsert_li])
+        setng_cache_invalidate(con, tbl_name)
+
+    if isinstance(con, Engine):
+        with con.begin() as con:
+            wrapped(con)
+    elif not con.in_transaction():
+        with con.begin():
+            wrapped(con)
+    else:
+        wrapped(con)
+    return G3Result(0, len(upsert_li))
 
 
 def sel_cu_setng_ref_li(con: Connection, meta_data: MetaData, ele_ty: EleTy, ele_val: int) -> list[dict[str, ...]]:
-    refs_li = []
+    return sel_cu_setng_ref_dct(con, meta_data, ele_ty, [ele_val])[ele_val]
+
+
+def sel_cu_setng_ref_dct(con: Union[Connection, Engine], meta_data: MetaData, ele_ty: EleTy,
+                         ele_val_li: list[int]) -> dict[int, list[dict[str, ...]]]:
+    """The chat-user settings referencing each of ele_val_li in the column of ele_ty, one query per IN_CHUNK ids.
+    Served by the index of create_setng_ref_idx."""
+    refs_dct: dict[int, list[dict[str, ...]]] = {ele_val: [] for ele_val in ele_val_li}
+    # the column may hold the id as text
+    ele_val_dct = {str(ele_val): ele_val for ele_val in ele_val_li}
     tbl_settings: Table = meta_data.tables['user_chat_settings']
     tbl_cols = tbl_settings.columns
     colname = ele_ty.col_name
-    sql_sel: Select = select(tbl_cols.tg_chat_id, tbl_cols.tg_user_id)
-    sql_sel = sql_sel.where(tbl_cols[colname] == ele_val)
-    rs: Result = con.execute(sql_sel)
-    row_li = rs.fetchall()
-    for row in row_li:
-        setng = chat_user_setting(row['tg_chat_id'], row['tg_user_id'], ele_ty)
-        refs_li.append(setng)
-    return refs_li
+    for idx in range(0, len(ele_val_li), integrity.IN_CHUNK):
+        sql_sel: Select = select(tbl_cols.tg_chat_id, tbl_cols.tg_user_id, tbl_cols[colname])
+        sql_sel = sql_sel.where(tbl_cols[colname].in_(ele_val_li[idx:idx + integrity.IN_CHUNK]))
+        rs: Result = con.execute(sql_sel)
+        for row in rs.fetchall():
+            setng = chat_user_setting(row['tg_chat_id'], row['tg_user_id'], ele_ty)
+            refs_dct[ele_val_dct[str(row[colname])]].append(setng)
+    return refs_dct
+
+
+def create_setng_ref_idx(eng: Engine, meta_data: MetaData, ele_ty_li: list[EleTy]) -> list[str]:
+    """Indexes the settings columns referencing an entity, i.e. of the EleTy with ent_ty, see sel_cu_setng_ref_dct.
+    Partial indexes, most rows reference nothing. Returns the names of the indexes created."""
+    col_name_set = {ele_ty.col_name for ele_ty in ele_ty_li if ele_ty.ent_ty and ele_ty.col_name}
+    idx_name_li: list[str] = []
+    with eng.begin() as con:
+        exist_set = {row[0] for row in con.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+        for tbl_name in SETNG_TBL_li:
+            if (tbl_settings := meta_data.tables.get(tbl_name)) is None:
+                continue
+            for col_name in sorted(col_name_set):
+                idx_name = f'ix_{tbl_name}_{col_name}'
+                if col_name not in tbl_settings.columns or idx_name in exist_set:
+                    continue
+                con.execute(text(f'CREATE INDEX IF NOT EXISTS {idx_name} ON {tbl_name} ({col_name}) '
+                                 f'WHERE {col_name} IS NOT NULL'))
+                idx_name_li.append(idx_name)
+    if idx_name_li:
+        logger.info(f'{eng.url.database}: created {", ".join(idx_name_li)}')
+    return idx_name_li
 
 
 def ent_to_setng(ch_us_tup: tuple[int, int], ent: Any, ele_ty: EleTy = None) -> G3Result:
@@ -179,11 +275,11 @@ def ent_by_setng(ch_us_tup: tuple[int, int], ele_ty: EleTy, sel_cb: Callable = N
         ent_ty: EntTy = ele_ty.ent_ty
     meta = integrity.meta_by_ent_ty(ent_ty)
     engine = integrity.engine_by_ent_ty(ent_ty)
-    with engine.begin() as con:
+    with db_registry.ro_eng(engine).connect() as con:
 
         params = chat_setting(ch_us_tup[0], ele_ty) if is_chat_setng \
             else chat_user_setting(ch_us_tup[0], ch_us_tup[1], ele_ty)
-        ele_val = read_setting(con, meta, params)
+        ele_val = read_setting_li(con, meta, params, [ele_ty])[0]
         g3r = G3Result.from_ele_val(ele_val)
 
         if g3r.retco != 0:
@@ -199,57 +295,115 @@ def ent_by_setng(ch_us_tup: tuple[int, int], ele_ty: EleTy, sel_cb: Callable = N
 
 
 @ele_ty_converter()
-def read_setng(ele_ty: EleTy, is_chat_setng=False) -> EleVal:
+def read_setng(ele_ty: EleTy, is_chat_setng=False, ctx_tup: tuple[Engine, MetaData, tuple[int, int]] = None) -> EleVal:
+    """ctx_tup: engine, meta data and (chat, user) of the update, by default read from G3Ctx"""
+    eng, md, ch_us_tup = ctx_tup or (G3Ctx.eng, G3Ctx.md, (G3Ctx.chat_id(), G3Ctx.for_user_id()))
+    return read_setng_by(eng, md, ch_us_tup, ele_ty, is_chat_setng)
+
+
+def read_setng_li(ele_ty_li: list[EleTy], is_chat_setng=False) -> list[EleVal]:
+    """The settings of ele_ty_li of the current chat and user, with one statement at most"""
+    return read_setting_li(G3Ctx.eng, G3Ctx.md, setng_scope(
+        (G3Ctx.chat_id(), G3Ctx.for_user_id()), is_chat_setng), ele_ty_li)
+
+
+def setng_scope(ch_us_tup: tuple[int, int], is_chat_setng=False) -> dict[str, ...]:
+    if is_chat_setng:
+        return dict(chat_id=ch_us_tup[0])
+    return dict(chat_id=ch_us_tup[0], user_id=ch_us_tup[1])
+
+
+def read_setng_by(con: Union[Connection, Engine], meta_data: MetaData, ch_us_tup: tuple[int, int], ele_ty: EleTy,
+                  is_chat_setng=False) -> EleVal:
+    """read_setng for the chat and user of ch_us_tup, the members of a tuple setting are read together"""
+    params = setng_scope(ch_us_tup, is_chat_setng)
     if ele_ty.ele_ty_tup:
-        setng_li: list[str] = []
-        for i in ele_ty.ele_ty_tup:
-            if is_chat_setng:
-                setng_dct = c_setng(i)
-            else:
-                setng_dct = cu_setng(i)
-            setng = read_setting(G3Ctx.eng, G3Ctx.md, setng_dct)
-            setng_li.append(setng.val)
-        return EleVal(ele_ty, tuple(setng_li))
+        setng_li = read_setting_li(con, meta_data, params, list(ele_ty.ele_ty_tup))
+        return EleVal(ele_ty, tuple(setng.val for setng in setng_li))
     else:
-        if is_chat_setng:
-            setng_dct = c_setng(ele_ty)
-        else:
-            setng_dct = cu_setng(ele_ty)
-        setng: EleVal = read_setting(G3Ctx.eng, G3Ctx.md, setng_dct)
+        setng: EleVal = read_setting_li(con, meta_data, params, [ele_ty])[0]
         if ele_ty.type == bool:
             setng.val_mp = bool(setng.val)
         return setng
 
 
 def read_setting(con: Union[Connection, Engine], meta_data: MetaData, params: dict[str, ...]) -> EleVal:
-    """
+    """The setting params['ele_ty'] of the chat and/or user of params, see read_setting_li
 
     Returns:
         object:
     """
+    return read_setting_li(con, meta_data, params, [params['ele_ty']])[0]
+
+
+def read_setting_li(con: Union[Connection, Engine], meta_data: MetaData, params: dict[str, ...],
+                    ele_ty_li: list[EleTy]) -> list[EleVal]:
+    """The settings of ele_ty_li of the chat and/or user of params, with one statement at most.
+    Outside a transaction of con the whole settings row is read once and cached in setng_cache.
+    Within, the columns are read and not cached, they may hold changes not committed yet."""
     is_chat, is_user, tbl_name, tg_chat_id, tg_user_id = chat_user_setng_params(params)
+    if isinstance(con, Engine):
+        con = db_registry.ro_eng(con)
 
     tbl_settings: Table = meta_data.tables[tbl_name]
-    tbl_cols = tbl_settings.columns
-    ele_ty: EleTy = params['ele_ty']
-    colname = ele_ty.col_name
-    sql_sel: Select = select(tbl_settings.columns[colname])
+    # KeyError for a column not in the table
+    col_li = [tbl_settings.columns[ele_ty.col_name] for ele_ty in ele_ty_li]
 
-    if is_chat and is_user:
-        sql_sel = sql_sel.where(tbl_cols.tg_chat_id == tg_chat_id, tbl_cols.tg_user_id == tg_user_id)
-    elif is_user:
-        sql_sel = sql_sel.where(tbl_cols.tg_user_id == tg_user_id)
-    elif is_chat:
+    if isinstance(con, Connection) and con.in_transaction():
+        row_dct = sel_setng_row(con, tbl_settings, is_chat, is_user, tg_chat_id, tg_user_id, col_li)
+    else:
+        db = db_registry.db_key(con.engine.url.database)
+        if (row_dct := setng_cache.get_row(db, tbl_name, tg_chat_id, tg_user_id)) is None:
+            gen = setng_cache.gen
+            row_dct = sel_setng_row(con, tbl_settings, is_chat, is_user, tg_chat_id, tg_user_id)
+            setng_cache.put_row(db, tbl_name, tg_chat_id, tg_user_id, row_dct, gen)
+
+    return [EleVal(ele_ty, row_dct[ele_ty.col_name]) if row_dct.get(ele_ty.col_name) else EleVal(ele_ty, '')
+            for ele_ty in ele_ty_li]
+
+
+def sel_setng_row(con: Union[Connection, Engine], tbl_settings: Table, is_chat: bool, is_user: bool,
+                  tg_chat_id: int, tg_user_id: int, col_li: list[Column] = None) -> dict[str, ...]:
+    """The columns of col_li, by default all, of the settings row of the chat and/or user, {} if there is none"""
+    tbl_cols = tbl_settings.columns
+    sql_sel: Select = select(*col_li) if col_li else select(tbl_settings)
+    if is_chat:
         sql_sel = sql_sel.where(tbl_cols.tg_chat_id == tg_chat_id)
+    if is_user:
+        sql_sel = sql_sel.where(tbl_cols.tg_user_id == tg_user_id)
 
     logger.debug(f"Statement: {sql_sel}")
     rs: Result = con.execute(sql_sel)
-    result = rs.first()
+    row = rs.first()
+    return dict(row._mapping) if row else {}
+
 
-    if result and result[colname]:
-        return EleVal(ele_ty, result[colname])
+def setng_cache_invalidate(con: Union[Connection, Engine], tbl_name: str, tg_chat_id: int = None,
+                           tg_user_id: int = None):
+    """Drops the cached row or, if None, the rows of any chat or user.
+    Within a transaction once more at its commit, a reader may cache the old row until then."""
+    db = db_registry.db_key(con.engine.url.database)
+    setng_cache.invalidate(db, tbl_name, tg_chat_id, tg_user_id)
+    if isinstance(con, Connection) and con.in_transaction():
+        # noinspection PyUnusedLocal
+        def on_commit(conn):
+            setng_cache.invalidate(db, tbl_name, tg_chat_id, tg_user_id)
 
-    return EleVal(ele_ty, '')
+        event.listen(con, 'commit', on_commit, once=True)
+
+
+def on_setng_change(db: str, tbl_name: str, key_li: Optional[list[tuple]]):
+    """Drops the settings rows written by another process, see change_log"""
+    if key_li is None:
+        setng_cache.invalidate(db, tbl_name)
+        return
+    for key_tup in key_li:
+        key_dct = dict(zip(SETNG_KEY_COL_dct[tbl_name], key_tup))
+        setng_cache.invalidate(db, tbl_name, key_dct.get('tg_chat_id'), key_dct.get('tg_user_id'))
+
+
+for _tbl_name in SETNG_TBL_li:
+    change_log.subscribe(_tbl_name, on_setng_change)
 
 
 def chat_user_setng_params(params):
@@ -267,3 +421,41 @@ def chat_user_setng_params(params):
     if is_user and is_chat:
         tbl_name = 'user_chat_settings'
     return is_chat, is_user, tbl_name, tg_chat_id, tg_user_id
+
+
+def setng_eng(arg_dct: dict[str, Any]) -> Engine:
+    """The DB of an aio call: the DB of con, the module DB of the entity or, by default, G3Ctx.eng"""
+    if con := arg_dct.get('con'):
+        return con.engine
+    if ent := arg_dct.get('ent'):
+        return integrity.engine_by_ent_ty(EntTy.from_ent(ent))
+    if ent_ty := arg_dct.get('ent_ty') or getattr(arg_dct.get('ele_ty'), 'ent_ty', None):
+        return integrity.engine_by_ent_ty(ent_ty)
+    return G3Ctx.eng
+
+
+class SettingsAio(AioFacade):
+    """settings.aio, the G3Ctx of read_setng, read_setng_li, iup_setng and iup_setng_li is read on the event loop"""
+
+    async def read_setng(self, ele_ty: EleTy, is_chat_setng=False) -> EleVal:
+        # the decorated read_setng, its result as the synchronous one
+        ctx_tup = (G3Ctx.eng, G3Ctx.md, (G3Ctx.chat_id(), G3Ctx.for_user_id()))
+        return await aio_run(G3Ctx.eng, read_setng, ele_ty, is_chat_setng, ctx_tup=ctx_tup)
+
+    async def read_setng_li(self, ele_ty_li: list[EleTy], is_chat_setng=False) -> list[EleVal]:
+        params = setng_scope((G3Ctx.chat_id(), G3Ctx.for_user_id()), is_chat_setng)
+        return await aio_run(G3Ctx.eng, read_setting_li, G3Ctx.eng, G3Ctx.md, params, ele_ty_li)
+
+    async def iup_setng_li(self, ele_val_li: list[tuple[EleTy, Any]], is_chat_setng=False) -> dict[str, ...]:
+        params = setng_scope((G3Ctx.chat_id(), G3Ctx.for_user_id()), is_chat_setng)
+        g3r: G3Result = await aio_run(G3Ctx.eng, iup_setting_li, G3Ctx.eng, G3Ctx.md, params, ele_val_li)
+        return g3r.result
+
+    async def iup_setng(self, params: dict[str, ...]) -> dict[str, ...]:
+        g3r: G3Result = await aio_run(G3Ctx.eng, iup_setting, G3Ctx.eng, G3Ctx.md, params)
+        return g3r.result
+
+
+# await settings.aio.read_setng(...), the params of iup_setng are prepared on the event loop, e.g. by cu_setng.
+# The sel_cb of ent_by_setng reads G3Ctx, e.g. tg_db.sel_ent_ty via bkey_scope
+aio = SettingsAio(sys.modules[__name__], setng_eng, ['ins_init_setng', 'cu_setng', 'c_setng', 'ent_by_setng'])
@@ -2,10 +2,11 @@ import logging
 import sys
 from dataclasses import asdict
 from enum import Enum
-from typing import Optional, Any, Dict, Tuple, Callable
+from functools import cache
+from typing import Optional, Any, Dict, Tuple, Callable, Iterator, NamedTuple
 
-from sqlalchemy import MetaData, create_engine, func, select, and_, update, delete
-from sqlalchemy import Table
+from sqlalchemy import MetaData, select, and_, update, delete
+from sqlalchemy import Table, Column
 from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.engine import Result, Row, CursorResult
@@ -17,28 +18,52 @@ from telegram import Message, Chat, User  # noqa
 
 from constants import env_g3b1_dir
 from subscribe.data.model import G3File
-from elements import ELE_TY_chat_id
-from entities import EntId, ET, EntTy, get_meta_attr
+from elements import ELE_TY_chat_id, EleTy
+from entities import EntId, ET, EntTy, get_meta_attr, LoadPlan
 from g3b1_cfg.tg_cfg import G3Ctx
-from g3b1_data.integrity import orm
+from g3b1_data import db_registry, tg_msg_arc, tg_msg_fts, tg_import, tg_msg_ret, settings, change_log, maint
+from g3b1_data.aio import AioFacade
+from g3b1_data.cache import upsert_cache, ent_cache, last_msg_cache, setng_cache, after_commit
+from g3b1_data.integrity import orm_li, IN_CHUNK, fk_tbl_dct
 from g3b1_data.model import G3Result
-from g3b1_data.tg_db_sqlite import tg_db_create_tables
+from g3b1_data.schema_cache import LazyMetaData
+from g3b1_data.tg_db_ingest import IngestQueue, update_many
+from g3b1_data.tg_db_seq import ExtIdAllocator
+from g3b1_data.tg_db_sqlite import tg_db_create_tables, tg_db_migrate, TG_CHG_TBL_dct
 # create console handler and set level to debug
 from g3b1_log.log import cfg_logger
-from generic_mdl import ele_ty_by_ent_ty
-from py_meta import ent_as_dict, ent_as_dict_sql
+from generic_mdl import ele_ty_by_ent_ty, ent_ty_by_tbl_name, get_ent_ty_li
+from py_meta import ent_as_dict, ent_as_dict_sql, ent_dirty_dct, ent_snapshot
 
 DB_FILE_TG = rf'{env_g3b1_dir}\g3b1_tg.db'
-MetaData_TG = MetaData()
-Engine_TG = create_engine(f"sqlite:///{DB_FILE_TG}")
-MetaData_TG.reflect(bind=Engine_TG)
+DB_KEY_TG = db_registry.db_key(DB_FILE_TG)
+# pooled, the connections are reused by the dispatcher threads and the aio workers
+Engine_TG = db_registry.create_eng(DB_FILE_TG)
+tg_db_migrate(Engine_TG)
+MetaData_TG = LazyMetaData(Engine_TG)
+db_registry.register(Engine_TG, MetaData_TG)
 
 logger = cfg_logger(logging.getLogger(__name__), logging.WARN)
 
 TABLE_TG_USER = "tg_user"
 TABLE_TG_CHAT = "tg_chat"
+TABLE_TG_MESSAGE = "tg_message"
 TABLE_FILE = "sub_file"
 
+# rows per query of iter_msg_rng_by_chat_user
+MSG_CHUNK_SIZE = 500
+# rows per page of search_message
+SEARCH_LIMIT = 20
+
+# Readers of tg_message flush the queue first if it holds rows they read, see IngestQueue.flush_if_pending
+# the callbacks are defined below
+Ingest_TG = IngestQueue(Engine_TG, MetaData_TG, {TABLE_TG_USER: ['ext_id'],
+                                                 TABLE_TG_CHAT: ['ext_id'],
+                                                 TABLE_TG_MESSAGE: ['tg_chat_id', 'ext_id']},
+                        on_written=lambda tbl_name, values_li: on_ingest_written(tbl_name, values_li),
+                        on_dropped=lambda tbl_name, values: on_ingest_dropped(tbl_name, values))
+ExtId_TG = ExtIdAllocator(Engine_TG, MetaData_TG)
+
 
 def fetch_id(con: Connection, rs, tbl_name: str) -> Optional[int]:
     if rs.rowcount != 1:
@@ -53,68 +78,151 @@ def fetch_id(con: Connection, rs, tbl_name: str) -> Optional[int]:
 
 
 def next_negative_ext_id(chat_id: int, user_id: int) -> G3Result[int]:
-    with Engine_TG.connect() as con:
-        tg_table: Table = MetaData_TG.tables["tg_message"]
-        cols = tg_table.columns
-        sql_sel: Select = select(func.min(cols['ext_id']).label('ext_id'))
-        where_clause = ((cols.tg_chat_id == chat_id) & (cols.tg_user_id == user_id))
-        sql_sel = sql_sel.where(where_clause)
-
-        logger.debug(sql_sel)
-        rs: Result = con.execute(sql_sel)
-        result = rs.first()
-
-        if not result:
-            return G3Result(0, -1)
-
-        ext_id = result['ext_id'] - 1
-        if ext_id >= 0:
-            ext_id = -1
-        return G3Result(0, ext_id)
+    """The ext_id of a message the bot creates, unique in the chat whatever the user"""
+    return G3Result(0, ExtId_TG.next_ext_id(chat_id))
 
 
 def sel_message(chat_id: int, message_id: int) -> G3Result[Row]:
-    with Engine_TG.connect() as con:
-        tg_table: Table = MetaData_TG.tables["tg_message"]
-        cols = tg_table.columns
+    """Reads the hot partition and, if not found there, the archive partitions of the chat's ext_id range"""
+    Ingest_TG.flush_if_pending(TABLE_TG_MESSAGE, tg_chat_id=chat_id, ext_id=message_id)
+    tg_table: Table = MetaData_TG.tables["tg_message"]
+
+    def sql_sel_by_tbl(tbl: Table) -> Select:
+        cols = tbl.columns
         sql_sel: Select = select(cols['tg_chat_id'], cols['ext_id'], cols['tg_user_id'],
                                  cols['date'], cols['text'], cols['sub_module'])
         where_clause = (cols.tg_chat_id == chat_id) & (cols.ext_id == message_id)
-        sql_sel = sql_sel.where(where_clause)
+        return sql_sel.where(where_clause)
 
-        logger.debug(sql_sel)
-        rs: Result = con.execute(sql_sel)
-        result = rs.first()
-
-        if not result:
-            return G3Result(4)
+    with db_registry.ro_eng(Engine_TG).connect() as con:
+        result = con.execute(sql_sel_by_tbl(tg_table)).first()
+        if result:
+            return G3Result(0, result)
+        for part in reversed(tg_msg_arc.part_li(con, chat_id, ext_id=message_id)):
+            with tg_msg_arc.attached(con, part.db_file):
+                result = con.execute(sql_sel_by_tbl(tg_msg_arc.arc_tbl(tg_table))).first()
+            if result:
+                return G3Result(0, result)
 
-        return G3Result(0, result)
+    return G3Result(4)
 
 
 def read_latest_message(chat_id: int, user_id: int, is_cmd_explicit=False, g3m_str='', menu_id='') -> G3Result[Row]:
-    with Engine_TG.connect() as con:
-        tg_table: Table = MetaData_TG.tables["tg_message"]
-        cols = tg_table.columns
+    """Reads the hot partition and, if not found there, the archive partitions of the chat, newest first"""
+    Ingest_TG.flush_if_pending(TABLE_TG_MESSAGE, tg_chat_id=chat_id, tg_user_id=user_id)
+    tg_table: Table = MetaData_TG.tables["tg_message"]
+
+    def sql_sel_by_tbl(tbl: Table) -> Select:
+        cols = tbl.columns
         sql_sel: Select = select(cols['tg_chat_id'], cols['ext_id'], cols['tg_user_id'],
                                  cols['fwd_user_id'], cols['fwd_date'],
-                                 func.max(cols['date']).label('date'), cols['text'], cols['menu_id'])
+                                 cols['date'], cols['text'], cols['menu_id'])
         where_clause = ((cols.tg_chat_id == chat_id) & (cols.tg_user_id == user_id) & (
                 cols.g3_cmd_explicit == is_cmd_explicit))
         if g3m_str:
             where_clause = (where_clause & (cols.bot_module == g3m_str))
         if menu_id:
             where_clause = (where_clause & (cols.menu_id == menu_id))
-        sql_sel = sql_sel.where(where_clause)
+        return sql_sel.where(where_clause).order_by(cols['date'].desc(), cols['ext_id'].desc()).limit(1)
 
+    with db_registry.ro_eng(Engine_TG).connect() as con:
+        sql_sel = sql_sel_by_tbl(tg_table)
         logger.debug(sql_sel)
-        rs: Result = con.execute(sql_sel)
-        result = rs.first()
+        result = con.execute(sql_sel).first()
+        if result:
+            return G3Result(0, result)
+        for part in reversed(tg_msg_arc.part_li(con, chat_id)):
+            with tg_msg_arc.attached(con, part.db_file):
+                result = con.execute(sql_sel_by_tbl(tg_msg_arc.arc_tbl(tg_table))).first()
+            if result:
+                return G3Result(0, result)
+
+    return G3Result(4)
+
+
+def search_message(query: str, chat_id: int = None, user_id: int = None,
+                   limit: int = SEARCH_LIMIT, offset: int = 0) -> G3Result[list[Row]]:
+    """Full-text search of the messages of the hot partition, best match first.
+    Rows: tg_chat_id, ext_id, tg_user_id, date, text, snippet, see tg_msg_fts.snippet_html"""
+    if not (fts_query := tg_msg_fts.fts_query(query)):
+        return G3Result(4)
+    col_val = dict(tg_chat_id=chat_id, tg_user_id=user_id)
+    Ingest_TG.flush_if_pending(TABLE_TG_MESSAGE, **{k: v for k, v in col_val.items() if v is not None})
+    with db_registry.ro_eng(Engine_TG).connect() as con:
+        row_li = tg_msg_fts.search(con, fts_query, chat_id, user_id, limit, offset)
+    if not row_li:
+        return G3Result(4)
+    return G3Result(0, row_li)
 
-        if not result:
-            return G3Result(4)
 
-        return G3Result(0, result)
+def fts_backfill() -> int:
+    """Indexes the messages stored before the full-text index existed"""
+    Ingest_TG.flush()
+    return tg_msg_fts.fts_backfill(Engine_TG)
+
+
+def import_chat_history(file: str) -> tg_import.ImportStats:
+    """Imports a chat history exported by Telegram Desktop, resumes an interrupted import of the file"""
+    Ingest_TG.flush()
+    return tg_import.import_file(Engine_TG, MetaData_TG, file)
+
+
+def archive_messages() -> list[tg_msg_arc.ArcStats]:
+    """Moves the messages older than the hot partition to the monthly archive files"""
+    Ingest_TG.flush()
+    return tg_msg_arc.archive_messages(Engine_TG)
+
+
+def purge_messages() -> tg_msg_ret.PurgeStats:
+    """Deletes the messages beyond the retention policies of tg_msg_retention"""
+    Ingest_TG.flush()
+    return tg_msg_ret.purge_messages(Engine_TG)
+
+
+# the messages beyond retention are deleted before the others are archived
+maint.schedule('purge_msg', purge_messages)
+maint.schedule('arc_msg', archive_messages)
+
+
+def enable_incremental_vacuum():
+    """One-off, purge_messages gives the pages freed back to the file system from then on"""
+    Ingest_TG.flush()
+    tg_msg_ret.enable_incremental_vacuum(Engine_TG)
+
+
+def user_values(row: User) -> dict:
+    return dict(ext_id=row.id, username=row.username, first_name=row.first_name,
+                last_name=row.last_name, language_code=row.language_code,
+                is_bot=int(row.is_bot))
+
+
+def chat_values(row: Chat) -> dict:
+    return dict(ext_id=row.id, title=row.title, all_members_are_administrators=row.all_members_are_administrators)
+
+
+def message_values(msg: Message,
+                   g3_cmd_long_str: str = None, is_command_explicit: bool = False,
+                   g3_file: G3File = False,
+                   sub_module='', menu_id='') -> dict:
+    bot_module: str = msg.bot.username.split('_')[1]
+    is_g3_file = 0
+    text = msg.text
+    if g3_file:
+        is_g3_file = 1
+        text = g3_file.file_unique_id
+    if bot_module == 'translate':
+        bot_module = 'trans'
+    values = dict(ext_id=msg.message_id, tg_user_id=msg.from_user.id, tg_chat_id=msg.chat.id,
+                  date=msg.date.strftime('%Y-%m-%d %H:%M:%S'), text=text,
+                  bot_module=bot_module,
+                  g3_cmd=g3_cmd_long_str, g3_cmd_explicit=is_command_explicit,
+                  g3_file=is_g3_file,
+                  sub_module=sub_module, menu_id=menu_id if menu_id else None
+                  )
+    if msg.forward_from:
+        values['fwd_user_id'] = msg.forward_from.id
+        values['fwd_date'] = msg.forward_date.strftime('%Y-%m-%d %H:%M:%S')
+    return values
 
 
 def synchronize_user(row: User, con_: Connection = None):
@@ -122,15 +230,16 @@ def synchronize_user(row: User, con_: Connection = None):
         tg_table: Table = MetaData_TG.tables["tg_user"]
         logger.debug(f"Table: {tg_table}")
         logger.debug(f"Row: {row}")
-        values = dict(ext_id=row.id, username=row.username, first_name=row.first_name,
-                      last_name=row.last_name, language_code=row.language_code,
-                      is_bot=int(row.is_bot))
+        values = user_values(row)
+        if upsert_cache.is_unchanged(DB_KEY_TG, TABLE_TG_USER, (row.id,), values):
+            return
         tg_insert: insert = insert(tg_table).values(values).on_conflict_do_update(
             index_elements=['ext_id'],
             set_=values
         )
         logger.debug(f"Insert statement: {tg_insert}")
         con.execute(tg_insert)
+        after_commit(con, lambda: upsert_cache.remember(DB_KEY_TG, TABLE_TG_USER, (row.id,), values))
         return
 
     if not con_:
@@ -144,13 +253,16 @@ def synchronize_chat(con: Connection, row: Chat):
     tg_table: Table = MetaData_TG.tables["tg_chat"]
     logger.debug(f"Table: {tg_table}")
     logger.debug(f"Row: {row}")
-    values = dict(ext_id=row.id, title=row.title, all_members_are_administrators=row.all_members_are_administrators)
+    values = chat_values(row)
+    if upsert_cache.is_unchanged(DB_KEY_TG, TABLE_TG_CHAT, (row.id,), values):
+        return
     tg_insert: insert = insert(tg_table).values(values).on_conflict_do_update(
         index_elements=['ext_id'],
         set_=values
     )
     logger.debug(f"Insert statement: {tg_insert}")
     con.execute(tg_insert)
+    after_commit(con, lambda: upsert_cache.remember(DB_KEY_TG, TABLE_TG_CHAT, (row.id,), values))
 
 
 def synchronize_message(con: Connection,
@@ -161,31 +273,32 @@ def synchronize_message(con: Connection,
     tg_table: Table = MetaData_TG.tables["tg_message"]
     logger.debug(f"Table: {tg_table}")
     logger.debug(f"Row: {msg}")
-    bot_module: str = msg.bot.username.split('_')[1]
-    is_g3_file = 0
-    text = msg.text
-    if g3_file:
-        is_g3_file = 1
-        text = g3_file.file_unique_id
-    if bot_module == 'translate':
-        bot_module = 'trans'
-    values = dict(ext_id=msg.message_id, tg_user_id=msg.from_user.id, tg_chat_id=msg.chat.id,
-                  date=msg.date.strftime('%Y-%m-%d %H:%M:%S'), text=text,
-                  bot_module=bot_module,
-                  g3_cmd=g3_cmd_long_str, g3_cmd_explicit=is_command_explicit,
-                  g3_file=is_g3_file,
-                  sub_module=sub_module, menu_id=menu_id
-                  )
-    if msg.forward_from:
-        values['fwd_user_id'] = msg.forward_from.id
-        values['fwd_date'] = msg.forward_date.strftime('%Y-%m-%d %H:%M:%S')
+    values = message_values(msg, g3_cmd_long_str, is_command_explicit, g3_file, sub_module, menu_id)
     tg_insert: insert = insert(tg_table).values(values).on_conflict_do_update(
         index_elements=['tg_chat_id', 'ext_id'],
         set_=values
     )
     logger.debug(f"Insert statement: {tg_insert}")
     con.execute(tg_insert)
-    Engine_TG.execute(tg_insert)
+
+
+def ingest_if_changed(tbl_name: str, values: dict):
+    """Queue the upsert of a tg_user or tg_chat row unless the same values have been written before.
+    The values are remembered once written by the flush, see on_ingest_written."""
+    if upsert_cache.is_unchanged(DB_KEY_TG, tbl_name, (values['ext_id'],), values):
+        return
+    Ingest_TG.put(tbl_name, values)
+
+
+def on_ingest_written(tbl_name: str, values_li: list[dict]):
+    if tbl_name in [TABLE_TG_USER, TABLE_TG_CHAT]:
+        for values in values_li:
+            upsert_cache.remember(DB_KEY_TG, tbl_name, (values['ext_id'],), values)
+
+
+def on_ingest_dropped(tbl_name: str, values: dict):
+    if tbl_name in [TABLE_TG_USER, TABLE_TG_CHAT]:
+        upsert_cache.invalidate(DB_KEY_TG, tbl_name, (values['ext_id'],))
 
 
 def synchronize_from_message(
@@ -194,8 +307,18 @@ def synchronize_from_message(
         g3_file: G3File = None,
         sub_module: str = '', menu_id: str = '') \
         -> None:
-    """ Doc
+    """ Upsert user, chat and message.
+    While Ingest_TG is running the rows are queued and written in batches by the ingest thread.
     """
+    if Ingest_TG.is_running():
+        if not message.from_user:
+            logger.error(f'message.from_user empty?')
+        else:
+            ingest_if_changed(TABLE_TG_USER, user_values(message.from_user))
+        ingest_if_changed(TABLE_TG_CHAT, chat_values(message.chat))
+        Ingest_TG.put(TABLE_TG_MESSAGE, message_values(message, g3_cmd_long_str, is_command_explicit, g3_file,
+                                                       sub_module, menu_id))
+        return
     with Engine_TG.connect() as con:
         if not message.from_user:
             logger.error(f'message.from_user empty?')
@@ -218,20 +341,27 @@ def externalize_file_id(bot_bkey: str, id_: int) -> None:
 
 
 def upd_chat_last_msg(chat_id: int, message_id: int):
-    with Engine_TG.connect() as con:
-        tbl = MetaData_TG.tables['tg_chat']
-        stmnt = update(tbl).where(tbl.c.ext_id == chat_id).values({'last_msg_id': message_id})
-        con.execute(stmnt)
+    """Answers sel_chat_last_msg from memory at once, the write to tg_chat is queued if the ingest queue runs"""
+    last_msg_cache.put(chat_id, message_id)
+    values = dict(ext_id=chat_id, last_msg_id=message_id)
+    if Ingest_TG.is_running():
+        Ingest_TG.put_update(TABLE_TG_CHAT, values)
+        return
+    with Engine_TG.begin() as con:
+        update_many(con, MetaData_TG.tables[TABLE_TG_CHAT], [values], ['ext_id'])
 
 
 def sel_chat_last_msg(chat_id: int) -> int:
-    with Engine_TG.connect() as con:
+    if (last_msg_id := last_msg_cache.get(chat_id)) is not None:
+        return last_msg_id
+    with db_registry.ro_eng(Engine_TG).connect() as con:
         tbl = MetaData_TG.tables['tg_chat']
         stmnt = select(tbl.c.last_msg_id).where(tbl.c.ext_id == chat_id)
         rs: CursorResult = con.execute(stmnt)
+        last_msg_id = 0
         if row := rs.first():
-            return row['last_msg_id']
-        return 0
+            last_msg_id = row['last_msg_id'] or 0
+    return last_msg_cache.put_if_absent(chat_id, last_msg_id)
 
 
 def externalize_id(bot_bkey: str, tg_tbl_name: str, id_: int) -> None:
@@ -241,39 +371,71 @@ def externalize_id(bot_bkey: str, tg_tbl_name: str, id_: int) -> None:
     """
     tbl_name = f'ext_{tg_tbl_name}'
     ext_db_file = rf'{env_g3b1_dir}\g3b1_{bot_bkey}.db'
-    ext_meta_data = MetaData()
-    ext_engine = create_engine(f"sqlite:///{ext_db_file}")
-    ext_meta_data.reflect(bind=ext_engine)
+    ext_engine, ext_meta_data = db_registry.eng_md_by_file(ext_db_file)
+    values = dict(id=id_)
+    ext_db_key = db_registry.db_key(ext_db_file)
+    if upsert_cache.is_unchanged(ext_db_key, tbl_name, (id_,), values):
+        return
     with ext_engine.connect() as con:
         ext_table: Table = ext_meta_data.tables[tbl_name]
         logger.debug(f"Table: {ext_table}")
-        values = dict(id=id_)
         ext_insert: insert = insert(ext_table).values(values).on_conflict_do_update(
             index_elements=['id'],
             set_=values
         )
         logger.debug(f"Insert statement: {ext_insert}")
         con.execute(ext_insert)
+    upsert_cache.remember(ext_db_key, tbl_name, (id_,), values)
+
+
+class MsgRec(NamedTuple):
+    tg_chat_id: int
+    ext_id: int
+    tg_user_id: int
+    date: Any
+    text: str
+
+
+def _iter_msg_rng(tbl: Table, from_msg_id, chat_id, user_id, chunk_size: int,
+                  db_file: str = None) -> Iterator[MsgRec]:
+    """Chunks of the hot partition or, with db_file, of the archive partition attached per chunk"""
+    cols = tbl.columns
+    sql_sel: Select = select(cols['tg_chat_id'], cols['ext_id'], cols['tg_user_id'],
+                             cols['date'], cols['text'])
+    sql_sel = sql_sel.where(cols.tg_chat_id == chat_id, cols.tg_user_id == user_id, cols.g3_cmd_explicit == 0). \
+        order_by(cols.ext_id).limit(chunk_size)
+    chunk_sel = sql_sel.where(cols.ext_id >= from_msg_id)
+    while True:
+        logger.debug(chunk_sel)
+        with db_registry.ro_eng(Engine_TG).connect() as con, tg_msg_arc.attached(con, db_file):
+            row_li = con.execute(chunk_sel).fetchall()
+        for row in row_li:
+            yield MsgRec(*row)
+        if len(row_li) < chunk_size:
+            return
+        chunk_sel = sql_sel.where(cols.ext_id > row_li[-1]['ext_id'])
+
+
+def iter_msg_rng_by_chat_user(from_msg_id, chat_id, user_id,
+                              chunk_size: int = MSG_CHUNK_SIZE) -> Iterator[MsgRec]:
+    """Messages of the user in the chat from ext_id from_msg_id on, ordered by ext_id.
+    Reads chunk_size rows per query with keyset pagination on ext_id, each chunk on its own connection,
+    so neither memory nor the read transaction grow with the range.
+    Archive partitions holding messages of the range are merged with the hot partition, which wins for a message
+    in both, see tg_msg_arc.merge_by_ext_id."""
+    Ingest_TG.flush_if_pending(TABLE_TG_MESSAGE, tg_chat_id=chat_id, tg_user_id=user_id)
+    tg_table: Table = MetaData_TG.tables["tg_message"]
+    with db_registry.ro_eng(Engine_TG).connect() as con:
+        part_li = tg_msg_arc.part_li(con, chat_id, ext_id_from=from_msg_id)
+    it_li = [_iter_msg_rng(tg_table, from_msg_id, chat_id, user_id, chunk_size)]
+    it_li += [_iter_msg_rng(tg_msg_arc.arc_tbl(tg_table), from_msg_id, chat_id, user_id, chunk_size, part.db_file)
+              for part in part_li]
+    return tg_msg_arc.merge_by_ext_id(it_li)
 
 
 def sel_msg_rng_by_chat_user(from_msg_id, chat_id, user_id) -> G3Result[list[dict]]:
-    with Engine_TG.connect() as con:
-        tg_table: Table = MetaData_TG.tables["tg_message"]
-        cols = tg_table.columns
-        sql_sel: Select = select(cols['tg_chat_id'], cols['ext_id'], cols['tg_user_id'],
-                                 cols['date'], cols['text'])
-        sql_sel = sql_sel.where(cols.tg_chat_id == chat_id, cols.tg_user_id == user_id,
-                                cols.ext_id >= from_msg_id,
-                                cols.g3_cmd_explicit == False)
-        logger.debug(sql_sel)
-        rs: Result = con.execute(sql_sel)
-        rs = rs.fetchall()
-        msg_dct_li = []
-        for row in rs:
-            d = dict(row)
-            msg_dct_li.append(d)
-
-        return G3Result(0, msg_dct_li)
+    msg_dct_li = [msg_rec._asdict() for msg_rec in iter_msg_rng_by_chat_user(from_msg_id, chat_id, user_id)]
+    return G3Result(0, msg_dct_li)
 
 
 def del_ent_ty(ent_id: EntId[ET], con: Connection = None) -> G3Result:
@@ -285,6 +447,7 @@ def del_ent_ty(ent_id: EntId[ET], con: Connection = None) -> G3Result:
         tbl: Table = md.tables[ent_ty.tbl_name]
         stmnt: delete = delete(tbl).where(tbl.columns.id == ent_id.id)
         con.execute(stmnt)
+        ent_cache_invalidate(ent_ty, ent_id.id, con)
         return G3Result(0)
 
     if not con:
@@ -294,84 +457,285 @@ def del_ent_ty(ent_id: EntId[ET], con: Connection = None) -> G3Result:
         return wrapped(con)
 
 
-def sel_ent_ty(ent_id: EntId[ET], con: Connection = None) -> G3Result[ET]:
+def sel_col_li(tbl: Table, plan: LoadPlan, *req_col_name) -> list[Column]:
+    if not plan.col_li:
+        return list(tbl.columns)
+    col_name_li = ['id', *req_col_name, *plan.col_li]
+    return [tbl.c[col_name] for col_name in dict.fromkeys(col_name_li) if col_name in tbl.c]
+
+
+def bkey_scope(ent_id: EntId[ET], tbl: Table) -> tuple:
+    """The g3_bot_id or chat the bkey of ent_id is unique for"""
+    if ent_id.g3_bot_id:
+        return 'g3_bot_id', ent_id.g3_bot_id
+    elif ELE_TY_chat_id.id_ in tbl.c:
+        return ELE_TY_chat_id.id_, G3Ctx.chat_id()
+    return ()
+
+
+def sel_ent_ty(ent_id: EntId[ET], con: Connection = None, plan: LoadPlan = None) -> G3Result[ET]:
+    """Loads the entity and the relations of plan, by default the whole entity graph.
+    The children of each relation are loaded for all parents with one IN-query.
+    Whole entity graphs read outside a transaction (con is None) are served from and added to ent_cache,
+    the entities returned are copies of the caller's own."""
     ent_ty = ent_id.ent_ty
     from_row_any, md, eng = get_meta_attr(ent_ty)
+    tbl: Table = md.tables[ent_ty.tbl_name]
+    is_bkey = not isinstance(ent_id.id, int)
+    scope = bkey_scope(ent_id, tbl) if is_bkey else ()
+    f_cache = con is None and plan is None
+    if f_cache:
+        gen = ent_cache.gen
+        if is_bkey:
+            ent = ent_cache.get_by_bkey(ent_ty, scope, ent_id.id)
+        else:
+            ent = ent_cache.get(ent_ty, ent_id.id)
+        if ent is not None:
+            return G3Result(0, ent)
+    if plan is None:
+        plan = LoadPlan.full(ent_ty)
 
     # noinspection PyShadowingNames
     def wrapped(con: Connection):
-        tbl: Table = md.tables[ent_ty.tbl_name]
         c = tbl.columns
-        if isinstance(ent_id.id, int):
+        if not is_bkey:
             where = (c['id'] == ent_id.id)
         else:
             bkey_clause = (c['bkey'] == ent_id.id)
-            if ent_id.g3_bot_id:
-                where = and_(
-                    c['g3_bot_id'] == ent_id.g3_bot_id,
-                    bkey_clause
-                )
-            elif ELE_TY_chat_id.id_ in tbl.c:
+            if scope:
                 where = and_(
-                    c[ELE_TY_chat_id.id_] == G3Ctx.chat_id(),
+                    c[scope[0]] == scope[1],
                     bkey_clause
                 )
             else:
                 where = bkey_clause
 
-        stmnt = (select(tbl).
+        stmnt = (select(*sel_col_li(tbl, plan)).
                  where(where))
 
         rs: Result = con.execute(stmnt)
         row: Row = rs.first()
-        # fetch fk entities:
-        repl_dct = orm(con, tbl, row, from_row_any, {})
-        ent: ET = from_row_any(ent_ty, row, repl_dct)
-        for k, v in ent_ty.it_ent_ty_dct.items():
-            it_li = sel_ent_ty_by_par(ent, v, con)
-            setattr(ent, k, it_li)
+        if not row:
+            return G3Result(4)
+        ent: ET = ent_by_row(con, ent_ty, tbl, row, from_row_any, plan)
 
+        if f_cache:
+            ent_cache.put(ent_ty, ent, scope, ent_id.id if is_bkey else None, gen)
         return G3Result(0, ent)
 
     if not con:
-        with eng.connect() as con:
+        with db_registry.ro_eng(eng).connect() as con:
             return wrapped(con)
     else:
         return wrapped(con)
 
 
-def sel_ent_ty_by_par(ent: Any, ent_ty: ET, con: Connection = None) -> list[Any]:
+def ent_by_row(con: Connection, ent_ty: EntTy, tbl: Table, row: Row, from_row_any: Callable,
+               plan: LoadPlan) -> Any:
+    """The entity of row with its fk entities and the relations of plan"""
+    # fetch fk entities:
+    ent_req_dct: dict[tuple[str, int], Any] = {}
+    repl_dct = orm_li(con, tbl, [row], from_row_any, {}, ent_req_dct)[0]
+    ent = from_row_any(ent_ty, row, repl_dct)
+    ent_snapshot(ent)
+    if 'id' in tbl.c:
+        ent_req_dct[(tbl.name, row['id'])] = ent
+    load_plan_rel(con, ent_ty, [ent], plan, ent_req_dct)
+    return ent
+
+
+def sel_ent_ty_by_setng(ch_us_tup: tuple[int, int], ele_ty: EleTy, ent_ty: EntTy = None, is_chat_setng=False,
+                        con: Connection = None, plan: LoadPlan = None) -> G3Result[ET]:
+    """The entity the setting ele_ty of the chat and user refers to, retco 4 if the setting is empty.
+    The settings table is joined to the table of the entity, setting and entity are read with one SELECT.
+    As sel_ent_ty, whole entity graphs read outside a transaction are served from and added to ent_cache, as copies,
+    a setting row cached in setng_cache is not read again."""
+    if not ent_ty:
+        ent_ty = ele_ty.ent_ty
     from_row_any, md, eng = get_meta_attr(ent_ty)
-    ent_ty_par: EntTy = ent.ent_ty
-    ele_ty_par = ele_ty_by_ent_ty(ent_ty_par)
-    id_attr = getattr(ent, 'id')
-    if not id_attr:
-        id_attr = getattr(ent, 'id_')
-    repl_dct = {ele_ty_par.col_name: ent}
+    tbl: Table = md.tables[ent_ty.tbl_name]
+    is_chat, is_user, tbl_name, tg_chat_id, tg_user_id = settings.chat_user_setng_params(
+        settings.setng_scope(ch_us_tup, is_chat_setng))
+    tbl_settings: Table = md.tables[tbl_name]
+    f_cache = con is None and plan is None
+    if f_cache:
+        gen = ent_cache.gen
+        row_dct = setng_cache.get_row(db_registry.db_key(eng.url.database), tbl_name, tg_chat_id, tg_user_id)
+        if row_dct is not None:
+            if not (ent_id := row_dct.get(ele_ty.col_name)):
+                return G3Result(4)
+            if str(ent_id).isnumeric() and (ent := ent_cache.get(ent_ty, int(ent_id))) is not None:
+                return G3Result(0, ent)
+    if plan is None:
+        plan = LoadPlan.full(ent_ty)
 
     # noinspection PyShadowingNames
-    def wrapped(con: Connection, repl_dct: dict) -> list[Any]:
-        tbl: Table = md.tables[ent_ty.tbl_name]
-        c = tbl.columns
-        stmnt = (select(tbl).
-                 where(c[ele_ty_par.col_name] == id_attr))
+    def wrapped(con: Connection):
+        c_setng = tbl_settings.columns
+        stmnt = (select(*sel_col_li(tbl, plan)).
+                 select_from(tbl_settings.join(tbl, tbl.c['id'] == c_setng[ele_ty.col_name])))
+        if is_chat:
+            stmnt = stmnt.where(c_setng.tg_chat_id == tg_chat_id)
+        if is_user:
+            stmnt = stmnt.where(c_setng.tg_user_id == tg_user_id)
+
+        rs: Result = con.execute(stmnt)
+        row: Row = rs.first()
+        if not row:
+            return G3Result(4)
+        ent = ent_by_row(con, ent_ty, tbl, row, from_row_any, plan)
+
+        if f_cache:
+            ent_cache.put(ent_ty, ent, gen=gen)
+        return G3Result(0, ent)
+
+    if not con:
+        with db_registry.ro_eng(eng).connect() as con:
+            return wrapped(con)
+    else:
+        return wrapped(con)
+
+
+@cache
+def graph_ent_ty_set(ent_ty: EntTy) -> frozenset[EntTy]:
+    """Entity types a loaded entity of ent_ty embeds: the children, recursively, and the entities referenced by FK"""
+    ent_ty_set: set[EntTy] = set()
+    ent_ty_li = [ent_ty]
+    while ent_ty_li:
+        et = ent_ty_li.pop()
+        md: MetaData = get_meta_attr(et)[1]
+        for fk_tbl in fk_tbl_dct(md.tables[et.tbl_name], []).values():
+            if ent_ty_ref := ent_ty_by_tbl_name(fk_tbl.name, [et.g3_m_str, 'subscribe']):
+                ent_ty_set.add(ent_ty_ref)
+        for it_ent_ty in et.it_ent_ty_dct.values():
+            if it_ent_ty not in ent_ty_set:
+                ent_ty_set.add(it_ent_ty)
+                ent_ty_li.append(it_ent_ty)
+    return frozenset(ent_ty_set)
+
+
+def ent_cache_invalidate(ent_ty: EntTy, id_: int = None, con: Connection = None):
+    """Drops the entity or, if id_ is None, all entities of ent_ty from ent_cache, and all cached entities which
+    might embed an entity of ent_ty. Within the transaction of con once more at its commit."""
+
+    def invalidate():
+        # a new generation in any case, the readers running do not cache the graphs read before
+        ent_cache.invalidate(ent_ty, id_)
+        for cached_ent_ty in ent_cache.cached_ent_ty_li():
+            if ent_ty in graph_ent_ty_set(cached_ent_ty):
+                ent_cache.invalidate(cached_ent_ty)
+
+    invalidate()
+    if con is not None and con.in_transaction():
+        after_commit(con, invalidate)
+
+
+def on_tg_change(db: str, tbl_name: str, key_li: Optional[list[tuple]]):
+    """Drops the tg_chat and tg_user rows written by another process from the caches, see change_log"""
+    if db != DB_KEY_TG:
+        return
+    if key_li is None:
+        upsert_cache.invalidate(db, tbl_name)
+        if tbl_name == TABLE_TG_CHAT:
+            last_msg_cache.clear()
+        return
+    upsert_cache.invalidate_li(db, tbl_name, [(key_tup[0],) for key_tup in key_li])
+    if tbl_name == TABLE_TG_CHAT:
+        for key_tup in key_li:
+            last_msg_cache.pop(key_tup[0])
+
+
+for _tbl_name in TG_CHG_TBL_dct.keys():
+    change_log.subscribe(_tbl_name, on_tg_change)
+
+
+def watch_tg():
+    """Invalidates the caches of g3b1_tg.db on the writes of other processes, the triggers are created by migration"""
+    change_log.watch(Engine_TG)
+
+
+def watch_module(eng: Engine, g3_m_str: str):
+    """Invalidates the settings and the entities of the module cached on the writes of other processes"""
+    db = db_registry.db_key(eng.url.database)
+    ent_ty_dct = {ent_ty.tbl_name: ent_ty for ent_ty in get_ent_ty_li(g3_m_str) or []
+                  if ent_ty.g3_m_str == g3_m_str}
+
+    def on_ent_change(chg_db: str, tbl_name: str, key_li: Optional[list[tuple]]):
+        if chg_db != db:
+            return
+        if key_li is None:
+            ent_cache_invalidate(ent_ty_dct[tbl_name])
+            return
+        for key_tup in key_li:
+            ent_cache_invalidate(ent_ty_dct[tbl_name], key_tup[0])
+
+    for tbl_name in ent_ty_dct.keys():
+        change_log.subscribe(tbl_name, on_ent_change)
+    change_log.watch(eng, {**settings.SETNG_KEY_COL_dct, **{tbl_name: ['id'] for tbl_name in ent_ty_dct.keys()}})
+
+
+def load_plan_rel(con: Connection, ent_ty: EntTy, ent_li: list[Any], plan: LoadPlan,
+                  ent_req_dct: dict[tuple[str, int], Any]):
+    """Sets the relations of plan on all entities of ent_li, one IN-query per relation and level.
+    ent_req_dct maps (table name, id) to the entities hydrated so far by the request."""
+    if not ent_li or not plan.rel_dct:
+        return
+    par_dct = {EntTy.ent_id(ent): ent for ent in ent_li}
+    for attr, it_plan in plan.rel_dct.items():
+        it_li_dct = sel_it_li_dct(con, ent_ty, par_dct, ent_ty.it_ent_ty_dct[attr], it_plan, ent_req_dct)
+        for id_, it_li in it_li_dct.items():
+            setattr(par_dct[id_], attr, it_li)
+
+
+def sel_it_li_dct(con: Connection, ent_ty_par: EntTy, par_dct: dict[int, Any], ent_ty: EntTy,
+                  plan: LoadPlan, ent_req_dct: dict[tuple[str, int], Any] = None) -> dict[int, list[Any]]:
+    """Child entities of type ent_ty per parent id. par_dct maps the parent id to the parent entity."""
+    from_row_any, md, eng = get_meta_attr(ent_ty)
+    par_col_name = ele_ty_by_ent_ty(ent_ty_par).col_name
+    tbl: Table = md.tables[ent_ty.tbl_name]
+    c = tbl.columns
+    col_li = sel_col_li(tbl, plan, par_col_name)
+    if ent_req_dct is None:
+        ent_req_dct = {}
+    it_li_dct: dict[int, list[Any]] = {id_: [] for id_ in par_dct.keys()}
+    it_ent_li: list[Any] = []
+    id_li = list(par_dct.keys())
+    for idx in range(0, len(id_li), IN_CHUNK):
+        stmnt = select(*col_li).where(c[par_col_name].in_(id_li[idx:idx + IN_CHUNK]))
+        if 'id' in c:
+            stmnt = stmnt.order_by(c['id'])
         cr: CursorResult = con.execute(stmnt)
         row_li: list[Row] = cr.fetchall()
-        res_li: list[Any] = []
-        for row in row_li:
-            repl_dct = orm(con, tbl, row, from_row_any, repl_dct)
+        # the parent column is not resolved, it is replaced by the parent entity below
+        repl_dct_li = orm_li(con, tbl, row_li, from_row_any, {par_col_name: None}, ent_req_dct)
+        for row, repl_dct in zip(row_li, repl_dct_li):
+            par_id = row[par_col_name]
+            repl_dct[par_col_name] = par_dct[par_id]
             ent: ET = from_row_any(ent_ty, row, repl_dct)
-            for k, v in ent_ty.it_ent_ty_dct.items():
-                it_li = sel_ent_ty_by_par(ent, v, con)
-                setattr(ent, k, it_li)
-            res_li.append(ent)
-        return res_li
+            ent_snapshot(ent)
+            if 'id' in c:
+                ent_req_dct[(tbl.name, row['id'])] = ent
+            it_li_dct[par_id].append(ent)
+            it_ent_li.append(ent)
+    load_plan_rel(con, ent_ty, it_ent_li, plan, ent_req_dct)
+    return it_li_dct
+
+
+def sel_ent_ty_by_par(ent: Any, ent_ty: ET, con: Connection = None, plan: LoadPlan = None) -> list[Any]:
+    from_row_any, md, eng = get_meta_attr(ent_ty)
+    if plan is None:
+        plan = LoadPlan.full(ent_ty)
+    par_id = EntTy.ent_id(ent)
+
+    # noinspection PyShadowingNames
+    def wrapped(con: Connection) -> list[Any]:
+        return sel_it_li_dct(con, EntTy.from_ent(ent), {par_id: ent}, ent_ty, plan)[par_id]
 
     if not con:
-        with eng.connect() as con:
-            return wrapped(con, repl_dct)
+        with db_registry.ro_eng(eng).connect() as con:
+            return wrapped(con)
     else:
-        return wrapped(con, repl_dct)
+        return wrapped(con)
 
 
 def sel_ent_ty_li(ent_ty: EntTy) -> list[Row]:
@@ -379,7 +743,7 @@ def sel_ent_ty_li(ent_ty: EntTy) -> list[Row]:
     chat_id = G3Ctx.chat_id()
     user_id = G3Ctx.for_user_id()
     c = tbl.columns
-    with G3Ctx.eng.begin() as con:
+    with db_registry.ro_eng(G3Ctx.eng).connect() as con:
         if 'user_id' in c and 'chat_id' in c:
             stmnt = (select(tbl).
                      where(c['chat_id'] == chat_id, c['user_id'] == user_id))
@@ -396,21 +760,28 @@ def sel_ent_ty_li(ent_ty: EntTy) -> list[Row]:
 
 
 def upd_ent_ty(ent: Any, col_li: list[str] = None) -> Any:
-    val_dct = ent_as_dict_sql(ent, col_li)
+    """Writes the columns of col_li or, by default, the columns changed since the entity has been loaded.
+    Nothing is written if no column changed. Returns the entity itself, it is not reloaded."""
     ent_ty = EntTy.from_ent(ent)
     ent_id = EntTy.ent_id(ent)
     meta_tup: tuple[Callable[..., Any], MetaData, Engine] = get_meta_attr(ent_ty)
+    tbl: Table = meta_tup[1].tables[ent_ty.tbl_name]
+    val_dct = ent_as_dict_sql(ent, col_li) if col_li else ent_dirty_dct(ent)
+    val_dct = {k: v for k, v in val_dct.items() if k in tbl.c}
+    if not val_dct:
+        return ent
     with meta_tup[2].begin() as con:
-        tbl: Table = meta_tup[1].tables[ent_ty.tbl_name]
         stmnt = update(tbl).where(tbl.c.id == ent_id).values(val_dct)
-        # noinspection PyUnusedLocal
         rs: CursorResult = con.execute(stmnt)
-        # todo check update result:
-        ent_upd = sel_ent_ty(EntId(EntTy.from_ent(ent), ent_id), con).result
-        return ent_upd
+        if rs.rowcount != 1:
+            logger.error(f'{tbl.name} id {ent_id}: {rs.rowcount} rows updated')
+    ent_snapshot(ent)
+    ent_cache_invalidate(ent_ty, ent_id)
+    return ent
 
 
 def ins_ent_ty(ent: Any) -> G3Result[Any]:
+    """Inserts the entity and sets its new id. Returns the entity itself, it is not reloaded."""
     if hasattr(ent, 'as_dict'):
         val_dct: dict = ent.as_dict()
     else:
@@ -428,10 +799,33 @@ def ins_ent_ty(ent: Any) -> G3Result[Any]:
             logger.exception(e)
             logger.error('Could not insert Learned, most likely due to UQ violation!')
             return G3Result(4)
-        if not (id_ := fetch_id(con, rs, tbl.name)):
+        if rs.rowcount != 1:
             return G3Result(4)
-        g3r = sel_ent_ty(EntId(EntTy.from_ent(ent), id_), con)
-        return g3r
+        # lastrowid, unless the id is not the rowid of the table
+        id_ = rs.inserted_primary_key[0] if rs.inserted_primary_key else None
+        if not id_ and not (id_ := fetch_id(con, rs, tbl.name)):
+            return G3Result(4)
+    EntTy.set_ent_id(ent, id_)
+    ent_snapshot(ent)
+    ent_cache_invalidate(ent_ty)
+    return G3Result(0, ent)
+
+
+def aio_eng(arg_dct: dict[str, Any]) -> Engine:
+    """The DB of an aio call: the module DB of the entity for the entity functions, otherwise g3b1_tg.db"""
+    if ent_id := arg_dct.get('ent_id'):
+        return get_meta_attr(ent_id.ent_ty)[2]
+    if ent := arg_dct.get('ent'):
+        return get_meta_attr(EntTy.from_ent(ent))[2]
+    return Engine_TG
+
+
+# functions reading G3Ctx, the entity reads via bkey_scope (chat of a bkey) and orm_li (module of the fk tables)
+AIO_CTX_FN_li = ['sel_ent_ty_li', 'ins_ent_ty', 'sel_ent_ty', 'sel_ent_ty_by_par', 'sel_ent_ty_by_setng',
+                 'sel_it_li_dct', 'load_plan_rel', 'ent_by_row', 'bkey_scope']
+
+# await tg_db.aio.read_latest_message(...)
+aio = AioFacade(sys.modules[__name__], aio_eng, AIO_CTX_FN_li)
 
 
 def main() -> None:
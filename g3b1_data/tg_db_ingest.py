@@ -0,0 +1,242 @@
+"""Write-behind queue for the upserts of incoming updates (tg_user, tg_chat, tg_message)"""
+import atexit
+import logging
+import threading
+from dataclasses import dataclass
+from itertools import groupby
+from time import monotonic, perf_counter
+from typing import Callable
+
+from sqlalchemy import MetaData, Table, update, and_, bindparam
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Connection, Engine
+
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.WARN)
+
+FLUSH_MAX_ROWS = 500
+FLUSH_MAX_MS = 200
+
+
+def upsert_many(con: Connection, tbl: Table, row_li: list[dict], index_elements: list[str]) -> None:
+    """INSERT ... ON CONFLICT DO UPDATE for all rows with executemany.
+    Rows are grouped by their key set, executemany requires the same columns for each row."""
+    for col_tup, grp in groupby(sorted(row_li, key=lambda r: tuple(r.keys())), key=lambda r: tuple(r.keys())):
+        stmnt: insert = insert(tbl)
+        set_ = {k: stmnt.excluded[k] for k in col_tup if k not in index_elements}
+        if set_:
+            stmnt = stmnt.on_conflict_do_update(index_elements=index_elements, set_=set_)
+        else:
+            stmnt = stmnt.on_conflict_do_nothing(index_elements=index_elements)
+        con.execute(stmnt, list(grp))
+
+
+def update_many(con: Connection, tbl: Table, row_li: list[dict], index_elements: list[str]) -> None:
+    """UPDATE ... WHERE index_elements for all rows with executemany, rows are grouped by their key set.
+    Rows without a matching row in tbl are ignored."""
+    for col_tup, grp in groupby(sorted(row_li, key=lambda r: tuple(r.keys())), key=lambda r: tuple(r.keys())):
+        col_li = [k for k in col_tup if k not in index_elements]
+        stmnt = update(tbl). \
+            where(and_(*[tbl.c[k] == bindparam(f'key_{k}') for k in index_elements])). \
+            values({k: bindparam(f'val_{k}') for k in col_li})
+        con.execute(stmnt, [{**{f'key_{k}': r[k] for k in index_elements}, **{f'val_{k}': r[k] for k in col_li}}
+                            for r in grp])
+
+
+@dataclass
+class IngestStats:
+    flush_count: int = 0
+    row_count: int = 0
+    err_count: int = 0
+    last_flush_ms: float = 0.0
+    max_flush_ms: float = 0.0
+    total_flush_ms: float = 0.0
+
+    def avg_flush_ms(self) -> float:
+        if not self.flush_count:
+            return 0.0
+        return self.total_flush_ms / self.flush_count
+
+
+class IngestQueue:
+    """Collects upserts from many updates and flushes them in one transaction
+    per max_rows rows or max_ms milliseconds, whatever comes first.
+
+    tbl_key_dct maps the table name to its conflict columns. Its order is the flush order,
+    i.e. parent tables must come before the tables referencing them.
+    Rows with the same key are merged while queued, the latest values win.
+    Updates (put_update) of a table are executed after its upserts and never insert a row.
+
+    on_written(tbl_name, values_li) is called with the upserts committed, on_dropped(tbl_name, values) with each
+    upsert failing in the row by row fallback, e.g. to keep upsert_cache in line with the DB."""
+
+    def __init__(self, eng: Engine, md: MetaData, tbl_key_dct: dict[str, list[str]],
+                 max_rows: int = FLUSH_MAX_ROWS, max_ms: int = FLUSH_MAX_MS,
+                 on_written: Callable[[str, list[dict]], None] = None,
+                 on_dropped: Callable[[str, dict], None] = None) -> None:
+        super().__init__()
+        self.eng = eng
+        self.md = md
+        self.tbl_key_dct = tbl_key_dct
+        self.max_rows = max_rows
+        self.max_ms = max_ms
+        self.on_written = on_written
+        self.on_dropped = on_dropped
+        self.stats = IngestStats()
+        self._row_dct: dict[str, dict[tuple, dict]] = self._new_row_dct()
+        self._upd_dct: dict[str, dict[tuple, dict]] = self._new_row_dct()
+        # the upserts of the flush running, written but not committed yet
+        self._flush_row_dct: dict[str, dict[tuple, dict]] = self._new_row_dct()
+        self._depth = 0
+        self._first_put = 0.0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread: threading.Thread = None
+        self._f_stop = False
+
+    def _new_row_dct(self) -> dict[str, dict[tuple, dict]]:
+        return {tbl_name: {} for tbl_name in self.tbl_key_dct.keys()}
+
+    def is_running(self) -> bool:
+        return self._thread is not None
+
+    def depth(self) -> int:
+        return self._depth
+
+    def start(self):
+        with self._cond:
+            if self._thread:
+                return
+            self._f_stop = False
+            self._thread = threading.Thread(target=self._run, name='tg_db_ingest', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stop the flush thread and write all rows still queued"""
+        with self._cond:
+            thread = self._thread
+            self._thread = None
+            self._f_stop = True
+            self._cond.notify()
+        if thread:
+            thread.join()
+        self.flush()
+        logger.info(self.stats_str())
+
+    def put(self, tbl_name: str, values: dict):
+        self._put(self._row_dct[tbl_name], tbl_name, values)
+
+    def put_update(self, tbl_name: str, values: dict):
+        """Queue an UPDATE of the columns in values of the row with the key in values"""
+        self._put(self._upd_dct[tbl_name], tbl_name, values)
+
+    def _put(self, row_dct: dict[tuple, dict], tbl_name: str, values: dict):
+        key = tuple(values[k] for k in self.tbl_key_dct[tbl_name])
+        with self._cond:
+            if key not in row_dct:
+                if not self._depth:
+                    self._first_put = monotonic()
+                self._depth += 1
+                row_dct[key] = values
+            else:
+                row_dct[key] = {**row_dct[key], **values}
+            if self._depth >= self.max_rows:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._depth and not self._f_stop:
+                    self._cond.wait()
+                deadline = self._first_put + self.max_ms / 1000
+                while not self._f_stop and self._depth < self.max_rows and (remaining := deadline - monotonic()) > 0:
+                    self._cond.wait(remaining)
+                if self._f_stop:
+                    return
+            self.flush()
+
+    def flush(self) -> int:
+        """Writes the queued rows in one transaction. Returns the number of rows written."""
+        with self._flush_lock:
+            with self._cond:
+                row_dct = self._row_dct
+                upd_dct = self._upd_dct
+                depth = self._depth
+                self._row_dct = self._new_row_dct()
+                self._upd_dct = self._new_row_dct()
+                self._depth = 0
+                self._flush_row_dct = row_dct
+            if not depth:
+                return 0
+            start = perf_counter()
+            try:
+                with self.eng.begin() as con:
+                    for tbl_name, key_li in self.tbl_key_dct.items():
+                        tbl: Table = self.md.tables[tbl_name]
+                        if row_dct[tbl_name]:
+                            upsert_many(con, tbl, list(row_dct[tbl_name].values()), key_li)
+                        if upd_dct[tbl_name]:
+                            update_many(con, tbl, list(upd_dct[tbl_name].values()), key_li)
+            except Exception as e:
+                logger.exception(e)
+                self.stats.err_count += 1
+                self._flush_row_by_row(row_dct, upd_dct)
+            else:
+                if self.on_written:
+                    for tbl_name, row_by_key in row_dct.items():
+                        if row_by_key:
+                            self.on_written(tbl_name, list(row_by_key.values()))
+            flush_ms = (perf_counter() - start) * 1000
+            self.stats.flush_count += 1
+            self.stats.row_count += depth
+            self.stats.last_flush_ms = flush_ms
+            self.stats.total_flush_ms += flush_ms
+            if flush_ms > self.stats.max_flush_ms:
+                self.stats.max_flush_ms = flush_ms
+            logger.debug(f'Flushed {depth} rows in {flush_ms:.1f} ms')
+            with self._cond:
+                self._flush_row_dct = self._new_row_dct()
+            return depth
+
+    def flush_if_pending(self, tbl_name: str, **col_val) -> int:
+        """Flushes if an upsert of tbl_name with the values of col_val, e.g. tg_chat_id=..., is queued, or waits
+        for the flush running if it writes one. A reader of these rows calls it, the other updates keep batching.
+        Returns the number of rows written."""
+
+        def is_pending(row_dct: dict[str, dict[tuple, dict]]) -> bool:
+            return any(all(values.get(k) == v for k, v in col_val.items()) for values in row_dct[tbl_name].values())
+
+        with self._cond:
+            f_queued = is_pending(self._row_dct)
+            f_flushing = not f_queued and is_pending(self._flush_row_dct)
+        if f_queued:
+            return self.flush()
+        if f_flushing:
+            with self._flush_lock:
+                pass
+        return 0
+
+    def _flush_row_by_row(self, row_dct: dict[str, dict[tuple, dict]], upd_dct: dict[str, dict[tuple, dict]]):
+        """Fallback if the batch failed: one transaction per row, failing rows are logged and dropped"""
+        for tbl_name, key_li in self.tbl_key_dct.items():
+            tbl: Table = self.md.tables[tbl_name]
+            for write_many, values in [(upsert_many, v) for v in row_dct[tbl_name].values()] + \
+                                      [(update_many, v) for v in upd_dct[tbl_name].values()]:
+                try:
+                    with self.eng.begin() as con:
+                        write_many(con, tbl, [values], key_li)
+                except Exception as e:
+                    logger.error(f'Dropped row for {tbl_name}: {values} - {e}')
+                    if write_many is upsert_many and self.on_dropped:
+                        self.on_dropped(tbl_name, values)
+                    continue
+                if write_many is upsert_many and self.on_written:
+                    self.on_written(tbl_name, [values])
+
+    def stats_str(self) -> str:
+        s = self.stats
+        return f'Ingest queue depth: {self.depth()}, flushes: {s.flush_count}, rows: {s.row_count}, ' \
+               f'errors: {s.err_count}, flush ms last/avg/max: ' \
+               f'{s.last_flush_ms:.1f}/{s.avg_flush_ms():.1f}/{s.max_flush_ms:.1f}'
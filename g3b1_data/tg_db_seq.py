@@ -0,0 +1,73 @@
+"""Allocator for the negative ext_id of messages the bot creates itself (tg_msg_chat_seq)"""
+import logging
+import threading
+
+from sqlalchemy import MetaData, Table, select, update, func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Engine, Connection, CursorResult
+
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.WARN)
+
+BLOCK_SIZE = 16
+
+
+class ExtIdAllocator:
+    """Hands out descending negative ext_id per chat, tg_message is unique on (tg_chat_id, ext_id):
+    the messages of all users of a chat draw from the same sequence.
+
+    The table tg_msg_chat_seq holds the next free id per chat. A process reserves a block of ids
+    with one UPDATE and serves them from memory. Ids of a block not used before the process ends are lost,
+    gaps are fine. The UPDATE takes the write lock of the DB, thus blocks of several processes never overlap."""
+
+    def __init__(self, eng: Engine, md: MetaData, block_size: int = BLOCK_SIZE) -> None:
+        super().__init__()
+        self.eng = eng
+        self.md = md
+        self.block_size = block_size
+        # chat_id -> [next ext_id, last ext_id of the block - 1]
+        self._blk_dct: dict[int, list[int]] = {}
+        # chat_id -> lock, a reservation holds up the same chat only
+        self._key_lock_dct: dict[int, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def next_ext_id(self, chat_id: int) -> int:
+        with self._lock:
+            key_lock = self._key_lock_dct.setdefault(chat_id, threading.Lock())
+        with key_lock:
+            blk = self._blk_dct.get(chat_id)
+            if not blk or blk[0] <= blk[1]:
+                blk = self._reserve(chat_id)
+                self._blk_dct[chat_id] = blk
+            ext_id = blk[0]
+            blk[0] -= 1
+            return ext_id
+
+    def _reserve(self, chat_id: int) -> list[int]:
+        tbl: Table = self.md.tables['tg_msg_chat_seq']
+        c = tbl.columns
+        with self.eng.begin() as con:
+            where = (c.tg_chat_id == chat_id)
+            rs: CursorResult = con.execute(
+                update(tbl).where(where).values(next_ext_id=c.next_ext_id - self.block_size)
+            )
+            if rs.rowcount:
+                stop = con.execute(select(c.next_ext_id).where(where)).scalar()
+                return [stop + self.block_size, stop]
+            start = self._seed(con, chat_id)
+            con.execute(insert(tbl).values(tg_chat_id=chat_id, next_ext_id=start - self.block_size))
+            return [start, start - self.block_size]
+
+    def _seed(self, con: Connection, chat_id: int) -> int:
+        """First id for a chat without a row in tg_msg_chat_seq: below all ext_id of the chat's messages
+        and below the ext_id of the chat's messages archived, see tg_msg_arc"""
+        cols = self.md.tables['tg_message'].columns
+        sql_sel = select(func.min(func.coalesce(func.min(cols.ext_id), 0), 0) - 1). \
+            where(cols.tg_chat_id == chat_id)
+        start = con.execute(sql_sel).scalar()
+        part_cols = self.md.tables['tg_msg_part_chat'].columns
+        sql_sel = select(func.min(part_cols.min_ext_id)).where(part_cols.tg_chat_id == chat_id)
+        if (part_min_ext_id := con.execute(sql_sel).scalar()) is not None:
+            start = min(start, part_min_ext_id - 1)
+        return start
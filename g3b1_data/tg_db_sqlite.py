@@ -10,6 +10,8 @@ from sqlalchemy.pool import Pool
 from telegram import Message, Chat, User  # noqa
 
 from constants import env_g3b1_dir
+from g3b1_data import change_log
+from g3b1_data.migration import migrate
 
 DB_FILE = rf'{env_g3b1_dir}\g3b1_tg.db'
 
@@ -109,6 +111,134 @@ def tg_db_create_tables(cur: sqlite3.Cursor = None) -> None:
     logger.debug("DB message created")
 
 
+# Is the tg_message row indexed in tg_message_fts, either by the triggers or the backfill
+_FTS_IS_INDEXED = "({rowid} > (SELECT hwm_rowid FROM tg_message_fts_state) " \
+                  "OR {rowid} <= (SELECT done_rowid FROM tg_message_fts_state))"
+
+# Tables of g3b1_tg.db logged in g3_change_log and their key columns, see g3b1_data.change_log
+TG_CHG_TBL_dct: dict[str, list[str]] = {'tg_chat': ['ext_id'], 'tg_user': ['ext_id']}
+
+# Versioned migrations of g3b1_tg.db, see g3b1_data.migration
+TG_MIGRATION_li: list[tuple[int, list[str]]] = [
+    (1, [
+        # No menu is stored as NULL, the partial menu index holds the bot's menu messages only
+        "UPDATE tg_message SET menu_id = NULL WHERE menu_id = ''",
+        # read_latest_message, with and without bot_module
+        "CREATE INDEX IF NOT EXISTS ix_tg_message_cu_cmd_mod_date "
+        "ON tg_message (tg_chat_id, tg_user_id, g3_cmd_explicit, bot_module, date)",
+        "CREATE INDEX IF NOT EXISTS ix_tg_message_cu_menu_date "
+        "ON tg_message (tg_chat_id, tg_user_id, menu_id, date) WHERE menu_id IS NOT NULL",
+        # sel_msg_rng_by_chat_user
+        "CREATE INDEX IF NOT EXISTS ix_tg_message_cu_ext_id "
+        "ON tg_message (tg_chat_id, tg_user_id, ext_id)",
+        # sel_message is served by the unique index on (tg_chat_id, ext_id) of the upsert
+        "ANALYZE tg_message"
+    ]),
+    (2, [
+        # Next negative ext_id per (chat, user), see g3b1_data.tg_db_seq
+        "CREATE TABLE IF NOT EXISTS tg_msg_seq ("
+        "tg_chat_id integer NOT NULL, "
+        "tg_user_id integer NOT NULL, "
+        "next_ext_id integer NOT NULL, "
+        "PRIMARY KEY (tg_chat_id, tg_user_id))",
+        "INSERT OR IGNORE INTO tg_msg_seq (tg_chat_id, tg_user_id, next_ext_id) "
+        "SELECT tg_chat_id, tg_user_id, MIN(COALESCE(MIN(ext_id), 0), 0) - 1 FROM tg_message "
+        "WHERE tg_chat_id IS NOT NULL AND tg_user_id IS NOT NULL "
+        "GROUP BY tg_chat_id, tg_user_id"
+    ]),
+    (3, [
+        # Catalog of the tg_message archive partitions, see g3b1_data.tg_msg_arc
+        "CREATE TABLE IF NOT EXISTS tg_msg_part ("
+        "part_key text PRIMARY KEY, "
+        "db_file text NOT NULL, "
+        "date_from text NOT NULL, "
+        "date_to text NOT NULL, "
+        "row_count integer NOT NULL DEFAULT 0)",
+        # ext_id range of each chat per partition, readers attach only the partitions matching their range
+        "CREATE TABLE IF NOT EXISTS tg_msg_part_chat ("
+        "part_key text NOT NULL REFERENCES tg_msg_part (part_key), "
+        "tg_chat_id integer NOT NULL, "
+        "min_ext_id integer NOT NULL, "
+        "max_ext_id integer NOT NULL, "
+        "PRIMARY KEY (tg_chat_id, part_key))"
+    ]),
+    (4, [
+        # Full-text index of tg_message.text, see g3b1_data.tg_msg_fts
+        "CREATE VIRTUAL TABLE IF NOT EXISTS tg_message_fts USING fts5("
+        "text, content='tg_message', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')",
+        # Rows existing before the index, up to hwm_rowid, are indexed by the backfill, done up to done_rowid
+        "CREATE TABLE IF NOT EXISTS tg_message_fts_state ("
+        "id integer PRIMARY KEY CHECK (id = 0), "
+        "done_rowid integer NOT NULL, "
+        "hwm_rowid integer NOT NULL)",
+        "INSERT OR IGNORE INTO tg_message_fts_state (id, done_rowid, hwm_rowid) "
+        "SELECT 0, 0, IFNULL(MAX(rowid), 0) FROM tg_message",
+        # The triggers maintain the rows already indexed, the backfill indexes the others with their current text
+        f"CREATE TRIGGER IF NOT EXISTS tg_message_fts_ai AFTER INSERT ON tg_message "
+        f"WHEN {_FTS_IS_INDEXED.format(rowid='new.rowid')} BEGIN "
+        f"INSERT INTO tg_message_fts (rowid, text) VALUES (new.rowid, new.text); END",
+        f"CREATE TRIGGER IF NOT EXISTS tg_message_fts_ad AFTER DELETE ON tg_message "
+        f"WHEN {_FTS_IS_INDEXED.format(rowid='old.rowid')} BEGIN "
+        f"INSERT INTO tg_message_fts (tg_message_fts, rowid, text) VALUES ('delete', old.rowid, old.text); END",
+        f"CREATE TRIGGER IF NOT EXISTS tg_message_fts_au AFTER UPDATE OF text ON tg_message "
+        f"WHEN {_FTS_IS_INDEXED.format(rowid='old.rowid')} BEGIN "
+        f"INSERT INTO tg_message_fts (tg_message_fts, rowid, text) VALUES ('delete', old.rowid, old.text); "
+        f"INSERT INTO tg_message_fts (rowid, text) VALUES (new.rowid, new.text); END"
+    ]),
+    (5, [
+        # Progress of the chat history imports, see g3b1_data.tg_import
+        "CREATE TABLE IF NOT EXISTS tg_import ("
+        "file text PRIMARY KEY, "
+        "file_size integer NOT NULL, "
+        "tg_chat_id integer, "
+        "msg_count integer NOT NULL DEFAULT 0, "
+        "row_count integer NOT NULL DEFAULT 0, "
+        "done integer NOT NULL DEFAULT 0)"
+    ]),
+    (6, [
+        # Retention policies of tg_message, see g3b1_data.tg_msg_ret
+        "CREATE TABLE IF NOT EXISTS tg_msg_retention ("
+        "bot_module text NOT NULL DEFAULT '', "
+        "tg_chat_id integer NOT NULL DEFAULT 0, "
+        "max_age_days integer, "
+        "max_rows integer, "
+        "keep_cmd integer NOT NULL DEFAULT 1, "
+        "PRIMARY KEY (bot_module, tg_chat_id))"
+    ]),
+    # Change log of tg_chat and tg_user for the caches of the other bot processes, see g3b1_data.change_log
+    (7, change_log.trigger_ddl_li(TG_CHG_TBL_dct)),
+    (8, [
+        # Next negative ext_id per chat, tg_message is unique on (tg_chat_id, ext_id), see g3b1_data.tg_db_seq.
+        # It starts below the ids reserved per (chat, user) so far, the messages and the messages archived.
+        "CREATE TABLE IF NOT EXISTS tg_msg_chat_seq ("
+        "tg_chat_id integer PRIMARY KEY, "
+        "next_ext_id integer NOT NULL)",
+        "INSERT OR IGNORE INTO tg_msg_chat_seq (tg_chat_id, next_ext_id) "
+        "SELECT tg_chat_id, MIN(next_ext_id) FROM ("
+        "SELECT tg_chat_id, MIN(next_ext_id) AS next_ext_id FROM tg_msg_seq GROUP BY tg_chat_id "
+        "UNION ALL SELECT tg_chat_id, MIN(COALESCE(MIN(ext_id), 0), 0) - 1 FROM tg_message "
+        "WHERE tg_chat_id IS NOT NULL GROUP BY tg_chat_id "
+        "UNION ALL SELECT tg_chat_id, MIN(MIN(min_ext_id), 0) - 1 FROM tg_msg_part_chat GROUP BY tg_chat_id) "
+        "GROUP BY tg_chat_id",
+        "DROP TABLE IF EXISTS tg_msg_seq"
+    ]),
+    (9, [
+        # Redundant indexes of version 1: (chat, user, cmd, date) is served by ix_tg_message_cu_cmd_mod_date,
+        # the partial index duplicates ix_tg_message_cu_ext_id
+        "DROP INDEX IF EXISTS ix_tg_message_cu_cmd_date",
+        "DROP INDEX IF EXISTS ix_tg_message_cu_ext_id_no_cmd"
+    ]),
+]
+
+
+def tg_db_migrate(eng: Engine) -> int:
+    with eng.connect() as con:
+        if not con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tg_message'").first():
+            logger.warning(f'{eng.url.database}: table tg_message missing, no migration')
+            return 0
+    return migrate(eng, TG_MIGRATION_li)
+
+
 def main() -> None:
     logger.debug("executing tg_db_sqlite.py main()")
     tg_db_create_tables()
@@ -0,0 +1,192 @@
+"""Import of a chat history exported by Telegram Desktop (JSON) into tg_chat, tg_user and tg_message.
+
+The export is parsed incrementally, memory does not grow with the file. The messages are inserted in
+chunks of IMP_CHUNK_SIZE, one transaction and one executemany per table each. The progress is committed
+with each chunk in tg_import, an interrupted import resumes after the last chunk committed.
+Rows already stored are kept, i.e. the messages the bot stored itself are not overwritten."""
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Iterator, TextIO, Optional
+
+from sqlalchemy import MetaData, Table, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.engine import Connection, Engine
+
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.INFO)
+
+IMP_CHUNK_SIZE = 5000
+READ_SIZE = 1024 * 1024
+
+_RE_MESSAGES = re.compile(r'(?<!\\)"messages"\s*:\s*\[')
+_RE_SEP = re.compile(r'[\s,]*')
+
+# export chat type -> Bot API chat type
+CHAT_TYPE_DCT = {'personal_chat': 'private', 'bot_chat': 'private', 'saved_messages': 'private',
+                 'private_group': 'group', 'private_supergroup': 'supergroup', 'public_supergroup': 'supergroup',
+                 'private_channel': 'channel', 'public_channel': 'channel'}
+
+
+def iter_export(f: TextIO) -> tuple[dict, Iterator[dict]]:
+    """The chat of the export, i.e. the members before "messages", and an iterator over the messages"""
+    buf = ''
+    while not (match := _RE_MESSAGES.search(buf)):
+        if not (chunk := f.read(READ_SIZE)):
+            raise ValueError('No "messages" found in export')
+        buf += chunk
+    chat_dct: dict = json.loads(buf[:match.start()].rstrip().rstrip(',') + '}')
+    return chat_dct, _iter_array(f, buf, match.end())
+
+
+def _iter_array(f: TextIO, buf: str, pos: int) -> Iterator[dict]:
+    """The items of the JSON array starting at buf[pos], buf is refilled from f on demand"""
+    decoder = json.JSONDecoder()
+    while True:
+        pos = _RE_SEP.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            if pos >= len(buf):
+                raise json.JSONDecodeError('End of buffer', buf, pos)
+            item, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if not (chunk := f.read(READ_SIZE)):
+                raise
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+
+
+def chat_ext_id(chat_dct: dict) -> int:
+    """Bot API id of the chat: negative for groups, -100 prefix for supergroups and channels"""
+    chat_type = CHAT_TYPE_DCT.get(chat_dct.get('type'), 'private')
+    if chat_type == 'group':
+        return -int(chat_dct['id'])
+    if chat_type in ['supergroup', 'channel']:
+        return int(f'-100{chat_dct["id"]}')
+    return int(chat_dct['id'])
+
+
+def from_ext_id(from_id: str) -> Optional[int]:
+    """user123 -> 123, channel123 -> -100123"""
+    if not from_id:
+        return None
+    if from_id.startswith('user'):
+        return int(from_id[4:])
+    if from_id.startswith('channel'):
+        return int(f'-100{from_id[7:]}')
+    return None
+
+
+def msg_text(text) -> Optional[str]:
+    """text is a string or a list of strings and entities, e.g. {"type": "bold", "text": "..."}"""
+    if isinstance(text, list):
+        text = ''.join(i if isinstance(i, str) else i.get('text', '') for i in text)
+    return text or None
+
+
+def msg_date(msg_dct: dict) -> str:
+    """UTC as the dates stored by the bot, date is the local time of the exporting client"""
+    if unixtime := msg_dct.get('date_unixtime'):
+        return datetime.fromtimestamp(int(unixtime), timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    return msg_dct['date'].replace('T', ' ')
+
+
+@dataclass
+class ImportStats:
+    file: str
+    msg_count: int = 0
+    row_count: int = 0
+    skip_count: int = 0
+    sec: float = 0.0
+
+    def rows_per_sec(self) -> float:
+        if not self.sec:
+            return 0.0
+        return self.row_count / self.sec
+
+
+def _insert_chunk(con: Connection, md: MetaData, chat_values: dict, user_dct: dict[int, dict],
+                  msg_li: list[dict]) -> int:
+    """INSERT OR IGNORE of the chunk. Returns the number of rows inserted."""
+    row_count = 0
+    for tbl_name, row_li in [('tg_chat', [chat_values]), ('tg_user', list(user_dct.values())),
+                             ('tg_message', msg_li)]:
+        if not row_li:
+            continue
+        tbl: Table = md.tables[tbl_name]
+        row_count += con.execute(insert(tbl).prefix_with('OR IGNORE'), row_li).rowcount
+    return row_count
+
+
+def import_file(eng: Engine, md: MetaData, file: str, chunk_size: int = IMP_CHUNK_SIZE) -> ImportStats:
+    """Imports the export file, resumes a previous import of the same file. A file of another size is a new export."""
+    stats = ImportStats(file)
+    file_size = os.path.getsize(file)
+    tbl_imp: Table = md.tables['tg_import']
+    with eng.connect() as con:
+        imp_row = con.execute(select(tbl_imp).where(tbl_imp.c.file == file)).first()
+    if imp_row and imp_row['file_size'] == file_size:
+        if imp_row['done']:
+            logger.info(f'{file} already imported: {imp_row["msg_count"]} messages')
+            return stats
+        stats.skip_count = imp_row['msg_count']
+    start = perf_counter()
+    with open(file, encoding='utf-8') as f, eng.connect() as con:
+        chat_dct, msg_it = iter_export(f)
+        chat_id = chat_ext_id(chat_dct)
+        chat_values = dict(ext_id=chat_id, title=chat_dct.get('name'),
+                           type=CHAT_TYPE_DCT.get(chat_dct.get('type'), 'private'))
+        with con.begin():
+            con.execute(insert(tbl_imp).values(file=file, file_size=file_size, tg_chat_id=chat_id,
+                                               msg_count=stats.skip_count).
+                        on_conflict_do_update(index_elements=['file'],
+                                              set_=dict(file_size=file_size, tg_chat_id=chat_id,
+                                                        msg_count=stats.skip_count, done=0)))
+        msg_count = 0
+        user_dct: dict[int, dict] = {}
+        msg_li: list[dict] = []
+
+        def flush_chunk():
+            chunk_start = perf_counter()
+            with con.begin():
+                row_count = _insert_chunk(con, md, chat_values, user_dct, msg_li)
+                con.execute(tbl_imp.update().where(tbl_imp.c.file == file).
+                            values(msg_count=msg_count, row_count=tbl_imp.c.row_count + row_count))
+            stats.row_count += row_count
+            chunk_sec = perf_counter() - chunk_start
+            logger.info(f'{file}: {msg_count} messages, {row_count} rows inserted, '
+                        f'{(len(msg_li) + len(user_dct)) / chunk_sec if chunk_sec else 0:.0f} rows/sec')
+            user_dct.clear()
+            msg_li.clear()
+
+        for msg_dct in msg_it:
+            msg_count += 1
+            if msg_count <= stats.skip_count:
+                continue
+            if msg_dct.get('type') != 'message':
+                continue
+            user_id = from_ext_id(msg_dct.get('from_id'))
+            # channels posting in a group become users as well, tg_message.tg_user_id references tg_user
+            if user_id and user_id not in user_dct:
+                user_dct[user_id] = dict(ext_id=user_id, first_name=msg_dct.get('from'), is_bot=0)
+            msg_li.append(dict(ext_id=msg_dct['id'], tg_user_id=user_id, tg_chat_id=chat_id,
+                               date=msg_date(msg_dct), text=msg_text(msg_dct.get('text')),
+                               g3_cmd_explicit=0, g3_file=0))
+            stats.msg_count += 1
+            if len(msg_li) >= chunk_size:
+                flush_chunk()
+        flush_chunk()
+        with con.begin():
+            con.execute(tbl_imp.update().where(tbl_imp.c.file == file).values(msg_count=msg_count, done=1))
+    stats.sec = perf_counter() - start
+    logger.info(f'{file} imported: {stats.msg_count} messages, {stats.row_count} rows inserted, '
+                f'{stats.skip_count} messages skipped, {stats.rows_per_sec():.0f} rows/sec')
+    return stats
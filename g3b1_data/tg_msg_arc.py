@@ -0,0 +1,190 @@
+"""Archive partitions of tg_message, one SQLite file per period of ARC_PERIOD_MONTHS months.
+
+g3b1_tg.db keeps the hot partition, i.e. the messages of the current and the ARC_HOT_PERIODS - 1 previous periods.
+archive_messages moves older messages to g3b1_tg_msg_{part_key}.db. The catalog tables tg_msg_part and
+tg_msg_part_chat of g3b1_tg.db record the partitions and the ext_id range of each chat in them.
+Readers ATTACH a partition as schema ARC_SCHEMA only if the range of the chat there matches their request.
+A message upserted again after it has been archived is in the hot and in an archive partition until the next run,
+readers take it from the hot partition.
+
+tg_db schedules archive_messages with the maintenance jobs of the bot process, see maint."""
+import heapq
+import logging
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import date
+from functools import cache
+from operator import attrgetter
+from time import perf_counter
+from typing import Iterator, Any
+
+from sqlalchemy import MetaData, Table, text
+from sqlalchemy.engine import Connection, Engine, Row
+
+from constants import env_g3b1_dir
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.INFO)
+
+ARC_SCHEMA = 'tg_arc'
+ARC_PERIOD_MONTHS = 1
+ARC_HOT_PERIODS = 2
+ARC_BATCH_SIZE = 1000
+
+# rowid of the next batch to move, stable within the transaction of the batch
+_SQL_BATCH = 'SELECT rowid FROM main.tg_message WHERE date >= :date_from AND date < :date_to ' \
+             'ORDER BY rowid LIMIT :batch_size'
+
+
+def part_key(year: int, month: int, period_months: int = ARC_PERIOD_MONTHS) -> str:
+    """Key of the partition holding the month, the first month of its period, e.g. 202404"""
+    month = (month - 1) // period_months * period_months + 1
+    return f'{year:04d}{month:02d}'
+
+
+def part_date_rng(part_key_: str, period_months: int = ARC_PERIOD_MONTHS) -> tuple[str, str]:
+    """First day of the partition and first day after it, compared as text with tg_message.date"""
+    year, month = int(part_key_[:4]), int(part_key_[4:])
+    month_count = year * 12 + month - 1 + period_months
+    return f'{year:04d}-{month:02d}-01', f'{month_count // 12:04d}-{month_count % 12 + 1:02d}-01'
+
+
+def hot_date_from(today: date = None, period_months: int = ARC_PERIOD_MONTHS,
+                  hot_periods: int = ARC_HOT_PERIODS) -> str:
+    """First day of the hot partition, older messages are archived"""
+    if not today:
+        today = date.today()
+    key = part_key(today.year, today.month, period_months)
+    month_count = int(key[:4]) * 12 + int(key[4:]) - 1 - (hot_periods - 1) * period_months
+    return f'{month_count // 12:04d}-{month_count % 12 + 1:02d}-01'
+
+
+def arc_db_file(part_key_: str) -> str:
+    return rf'{env_g3b1_dir}\g3b1_tg_msg_{part_key_}.db'
+
+
+@contextmanager
+def attached(con: Connection, db_file: str = None):
+    """ATTACH db_file as ARC_SCHEMA for the with block, nothing to attach if db_file is None.
+    Must not be used within a transaction of the connection."""
+    if not db_file:
+        yield con
+        return
+    con.execute(text(f'ATTACH DATABASE :db_file AS {ARC_SCHEMA}'), db_file=db_file)
+    try:
+        yield con
+    finally:
+        con.execute(text(f'DETACH DATABASE {ARC_SCHEMA}'))
+
+
+@cache
+def arc_tbl(tbl: Table) -> Table:
+    """The table tbl of the partition attached as ARC_SCHEMA"""
+    return tbl.to_metadata(MetaData(), schema=ARC_SCHEMA)
+
+
+def part_li(con: Connection, chat_id: int, ext_id_from: int = None, ext_id: int = None) -> list[Row]:
+    """(part_key, db_file) of the partitions holding messages of the chat, ordered by part_key.
+    Only partitions with messages from ext_id_from on or with the message ext_id, if given."""
+    sql = 'SELECT p.part_key, p.db_file FROM tg_msg_part_chat pc JOIN tg_msg_part p ON p.part_key = pc.part_key ' \
+          'WHERE pc.tg_chat_id = :chat_id'
+    if ext_id_from is not None:
+        sql += ' AND pc.max_ext_id >= :ext_id_from'
+    if ext_id is not None:
+        sql += ' AND :ext_id BETWEEN pc.min_ext_id AND pc.max_ext_id'
+    sql += ' ORDER BY p.part_key'
+    return con.execute(text(sql), chat_id=chat_id, ext_id_from=ext_id_from, ext_id=ext_id).fetchall()
+
+
+def merge_by_ext_id(it_li: list[Iterator[Any]]) -> Iterator[Any]:
+    """Merges the iterators of the messages of one chat, each ordered by ext_id, into one ordered by ext_id.
+    A message in several iterators is taken from the first one: pass the hot partition first."""
+    if len(it_li) == 1:
+        return it_li[0]
+    return _uniq_ext_id(heapq.merge(*it_li, key=attrgetter('ext_id')))
+
+
+def _uniq_ext_id(it: Iterator[Any]) -> Iterator[Any]:
+    # heapq.merge keeps the order of it_li for equal keys
+    ext_id = None
+    for rec in it:
+        if rec.ext_id != ext_id:
+            ext_id = rec.ext_id
+            yield rec
+
+
+@dataclass
+class ArcStats:
+    part_key: str
+    row_count: int = 0
+    batch_count: int = 0
+    ms: float = 0.0
+
+
+def _create_part(con: Connection, part_key_: str, date_from: str, date_to: str):
+    """Archive file with the table and its indexes, and its catalog entry"""
+    db_file = arc_db_file(part_key_)
+    with attached(con, db_file):
+        with con.begin():
+            con.execute(text(f'CREATE TABLE IF NOT EXISTS {ARC_SCHEMA}.tg_message AS '
+                             f'SELECT * FROM main.tg_message WHERE 0'))
+            # sel_message, INSERT OR REPLACE of a rerun
+            con.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS {ARC_SCHEMA}.ux_tg_message_c_ext_id '
+                             f'ON tg_message (tg_chat_id, ext_id)'))
+            # sel_msg_rng_by_chat_user
+            con.execute(text(f'CREATE INDEX IF NOT EXISTS {ARC_SCHEMA}.ix_tg_message_cu_ext_id '
+                             f'ON tg_message (tg_chat_id, tg_user_id, ext_id)'))
+    with con.begin():
+        con.execute(text('INSERT OR IGNORE INTO tg_msg_part (part_key, db_file, date_from, date_to) '
+                         'VALUES (:part_key, :db_file, :date_from, :date_to)'),
+                    part_key=part_key_, db_file=db_file, date_from=date_from, date_to=date_to)
+
+
+def _move_batch(con: Connection, part_key_: str, date_from: str, date_to: str, batch_size: int) -> int:
+    """Moves the next batch of messages to the attached partition. Returns the number of messages moved."""
+    param_dct = dict(part_key=part_key_, date_from=date_from, date_to=date_to, batch_size=batch_size)
+    with con.begin():
+        con.execute(text(f'INSERT INTO tg_msg_part_chat (part_key, tg_chat_id, min_ext_id, max_ext_id) '
+                         f'SELECT :part_key, tg_chat_id, MIN(ext_id), MAX(ext_id) FROM main.tg_message '
+                         f'WHERE rowid IN ({_SQL_BATCH}) AND tg_chat_id IS NOT NULL GROUP BY tg_chat_id '
+                         f'ON CONFLICT (tg_chat_id, part_key) DO UPDATE SET '
+                         f'min_ext_id = MIN(min_ext_id, excluded.min_ext_id), '
+                         f'max_ext_id = MAX(max_ext_id, excluded.max_ext_id)'), **param_dct)
+        con.execute(text(f'INSERT OR REPLACE INTO {ARC_SCHEMA}.tg_message '
+                         f'SELECT * FROM main.tg_message WHERE rowid IN ({_SQL_BATCH})'), **param_dct)
+        row_count = con.execute(text(f'DELETE FROM main.tg_message WHERE rowid IN ({_SQL_BATCH})'),
+                                **param_dct).rowcount
+        con.execute(text('UPDATE tg_msg_part SET row_count = row_count + :row_count WHERE part_key = :part_key'),
+                    part_key=part_key_, row_count=row_count)
+        return row_count
+
+
+def archive_messages(eng: Engine, today: date = None, period_months: int = ARC_PERIOD_MONTHS,
+                     hot_periods: int = ARC_HOT_PERIODS, batch_size: int = ARC_BATCH_SIZE) -> list[ArcStats]:
+    """Moves the messages dated before the hot partition to their archive partitions.
+
+    Each batch is moved in a short transaction together with the update of the catalog, writers of the hot
+    partition wait for one batch at most. In WAL mode the transaction is not atomic across the DB files,
+    a crash may leave messages in both. A rerun replaces the archived copy and deletes them from the hot partition.
+    """
+    date_to_hot = hot_date_from(today, period_months, hot_periods)
+    with eng.connect() as con:
+        month_li = [row[0] for row in con.execute(
+            text("SELECT DISTINCT substr(date, 1, 7) FROM tg_message "
+                 "WHERE date < :date_to AND date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]*'"), date_to=date_to_hot)]
+    part_key_li = sorted({part_key(int(month[:4]), int(month[5:7]), period_months) for month in month_li})
+    stats_li: list[ArcStats] = []
+    for key in part_key_li:
+        stats = ArcStats(key)
+        start = perf_counter()
+        date_from, date_to = part_date_rng(key, period_months)
+        with eng.connect() as con:
+            _create_part(con, key, date_from, date_to)
+            with attached(con, arc_db_file(key)):
+                while row_count := _move_batch(con, key, date_from, min(date_to, date_to_hot), batch_size):
+                    stats.row_count += row_count
+                    stats.batch_count += 1
+        stats.ms = (perf_counter() - start) * 1000
+        logger.info(f'Archived {stats.row_count} messages to {key} in {stats.batch_count} batches, {stats.ms:.0f} ms')
+        stats_li.append(stats)
+    return stats_li
@@ -0,0 +1,101 @@
+"""Full-text search of tg_message.text with the FTS5 table tg_message_fts.
+
+The triggers of tg_db_sqlite migration 4 keep the index in sync with tg_message. Messages existing before
+the migration are indexed by fts_backfill in short batches, the bot's writers wait for one batch at most.
+Messages moved to an archive partition are removed from the index."""
+import html
+import logging
+from dataclasses import dataclass
+from time import perf_counter, sleep
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine, Row
+
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.INFO)
+
+FTS_BATCH_SIZE = 2000
+# pause between two batches of the backfill, lets the writers in
+FTS_PAUSE_S = 0.05
+SNIPPET_TOKENS = 12
+# snippet markers of the matched terms, replaced after escaping by snippet_html
+HL_START = '\x02'
+HL_END = '\x03'
+
+
+@dataclass
+class FtsState:
+    done_rowid: int
+    hwm_rowid: int
+
+    def is_complete(self) -> bool:
+        return self.done_rowid >= self.hwm_rowid
+
+
+def fts_state(con: Connection) -> FtsState:
+    row = con.execute(text('SELECT done_rowid, hwm_rowid FROM tg_message_fts_state WHERE id = 0')).first()
+    return FtsState(row['done_rowid'], row['hwm_rowid'])
+
+
+def _backfill_batch(con: Connection, batch_size: int) -> int:
+    """Indexes the next batch of rowid. Returns the number of rowid processed, 0 if the backfill is complete."""
+    with con.begin():
+        # take the write lock first, the triggers must not see a done_rowid between read and update
+        con.execute(text('UPDATE tg_message_fts_state SET done_rowid = done_rowid WHERE id = 0'))
+        state = fts_state(con)
+        if state.is_complete():
+            return 0
+        to_rowid = min(state.done_rowid + batch_size, state.hwm_rowid)
+        con.execute(text('INSERT INTO tg_message_fts (rowid, text) '
+                         'SELECT rowid, text FROM tg_message WHERE rowid > :done_rowid AND rowid <= :to_rowid'),
+                    done_rowid=state.done_rowid, to_rowid=to_rowid)
+        con.execute(text('UPDATE tg_message_fts_state SET done_rowid = :to_rowid WHERE id = 0'), to_rowid=to_rowid)
+        return to_rowid - state.done_rowid
+
+
+def fts_backfill(eng: Engine, batch_size: int = FTS_BATCH_SIZE, pause_s: float = FTS_PAUSE_S) -> int:
+    """Indexes the messages existing before tg_message_fts, resumes where a previous run stopped.
+    Returns the number of rowid processed."""
+    start = perf_counter()
+    rowid_count = 0
+    with eng.connect() as con:
+        while count := _backfill_batch(con, batch_size):
+            rowid_count += count
+            sleep(pause_s)
+        state = fts_state(con)
+    logger.info(f'FTS backfill of {rowid_count} rowid in {(perf_counter() - start) * 1000:.0f} ms, '
+                f'done up to rowid {state.done_rowid} of {state.hwm_rowid}')
+    return rowid_count
+
+
+def fts_query(query: str) -> str:
+    """The user's words as FTS5 query, every word must match. A trailing * matches words with the prefix."""
+    term_li: list[str] = []
+    for word in query.split():
+        f_prefix = word.endswith('*')
+        word = word.rstrip('*')
+        if not word:
+            continue
+        term_li.append('"' + word.replace('"', '""') + '"' + ('*' if f_prefix else ''))
+    return ' '.join(term_li)
+
+
+def search(con: Connection, query: str, chat_id: int = None, user_id: int = None,
+           limit: int = 20, offset: int = 0) -> list[Row]:
+    """Messages matching the FTS5 query, best bm25 rank first, with the snippet of the matched terms"""
+    sql = 'SELECT m.tg_chat_id, m.ext_id, m.tg_user_id, m.date, m.text, ' \
+          'snippet(tg_message_fts, 0, :hl_start, :hl_end, :ellipsis, :snippet_tokens) AS snippet ' \
+          'FROM tg_message_fts JOIN tg_message m ON m.rowid = tg_message_fts.rowid ' \
+          'WHERE tg_message_fts MATCH :query'
+    if chat_id is not None:
+        sql += ' AND m.tg_chat_id = :chat_id'
+    if user_id is not None:
+        sql += ' AND m.tg_user_id = :user_id'
+    sql += ' ORDER BY tg_message_fts.rank LIMIT :limit OFFSET :offset'
+    return con.execute(text(sql), query=query, chat_id=chat_id, user_id=user_id, limit=limit, offset=offset,
+                       hl_start=HL_START, hl_end=HL_END, ellipsis='…', snippet_tokens=SNIPPET_TOKENS).fetchall()
+
+
+def snippet_html(snippet: str) -> str:
+    return html.escape(snippet or '').replace(HL_START, '<b>').replace(HL_END, '</b>')
@@ -0,0 +1,184 @@
+"""Retention of the messages of the hot partition tg_message, configured per bot_module and chat in tg_msg_retention.
+
+A policy limits the age of the messages, the number of messages per chat or both, explicit commands are kept
+unless keep_cmd is 0. bot_module '' stands for any bot module, tg_chat_id 0 for any chat. The messages of a chat
+and bot module fall under the first policy of (bot_module, chat), ('', chat), (bot_module, 0), ('', 0).
+Chats and modules without a policy are kept. Archive partitions, see tg_msg_arc, are not purged.
+
+purge_messages deletes in batches of RET_BATCH_SIZE, one short transaction each, the bot's writers wait for
+one batch at most. If the DB has auto_vacuum INCREMENTAL, the pages freed are given back to the file system.
+tg_db schedules purge_messages with the maintenance jobs of the bot process, see maint."""
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from time import perf_counter, sleep
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from g3b1_log.log import cfg_logger
+
+logger = cfg_logger(logging.getLogger(__name__), logging.INFO)
+
+RET_BATCH_SIZE = 500
+# pause between two batches, lets the writers in
+RET_PAUSE_S = 0.01
+# pages per PRAGMA incremental_vacuum
+RET_VACUUM_PAGES = 1000
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    bot_module: str = ''
+    tg_chat_id: int = 0
+    # None: no limit
+    max_age_days: Optional[int] = None
+    max_rows: Optional[int] = None
+    keep_cmd: bool = True
+
+
+@dataclass
+class PurgeStats:
+    chat_count: int = 0
+    age_row_count: int = 0
+    max_row_count: int = 0
+    batch_count: int = 0
+    page_count: int = 0
+    ms: float = 0.0
+
+    def row_count(self) -> int:
+        return self.age_row_count + self.max_row_count
+
+
+def policy_li(con: Connection) -> list[RetentionPolicy]:
+    rs = con.execute(text('SELECT bot_module, tg_chat_id, max_age_days, max_rows, keep_cmd FROM tg_msg_retention'))
+    return [RetentionPolicy(row['bot_module'], row['tg_chat_id'], row['max_age_days'], row['max_rows'],
+                            bool(row['keep_cmd'])) for row in rs]
+
+
+def set_policy(eng: Engine, policy: RetentionPolicy):
+    with eng.begin() as con:
+        con.execute(text('INSERT OR REPLACE INTO tg_msg_retention '
+                         '(bot_module, tg_chat_id, max_age_days, max_rows, keep_cmd) '
+                         'VALUES (:bot_module, :tg_chat_id, :max_age_days, :max_rows, :keep_cmd)'),
+                    bot_module=policy.bot_module, tg_chat_id=policy.tg_chat_id, max_age_days=policy.max_age_days,
+                    max_rows=policy.max_rows, keep_cmd=int(policy.keep_cmd))
+
+
+def del_policy(eng: Engine, bot_module: str = '', tg_chat_id: int = 0):
+    with eng.begin() as con:
+        con.execute(text('DELETE FROM tg_msg_retention WHERE bot_module = :bot_module AND tg_chat_id = :tg_chat_id'),
+                    bot_module=bot_module, tg_chat_id=tg_chat_id)
+
+
+def chat_policy_dct(pol_li: list[RetentionPolicy], chat_id: int) -> tuple[dict[str, RetentionPolicy],
+                                                                          Optional[RetentionPolicy]]:
+    """The policies of the chat by bot_module and the policy of the other bot modules, None if they are kept"""
+    pol_dct = {(pol.bot_module, pol.tg_chat_id): pol for pol in pol_li}
+    mod_dct = {pol.bot_module: pol for pol in pol_li if pol.tg_chat_id == chat_id and pol.bot_module}
+    if pol := pol_dct.get(('', chat_id)):
+        return mod_dct, pol
+    for pol in pol_li:
+        if pol.tg_chat_id == 0 and pol.bot_module:
+            mod_dct.setdefault(pol.bot_module, pol)
+    return mod_dct, pol_dct.get(('', 0))
+
+
+def _del_batch(con: Connection, sql_where: str, param_dct: dict, batch_size: int) -> int:
+    """Deletes the oldest batch of the messages matching sql_where. Returns the number of messages deleted."""
+    with con.begin():
+        return con.execute(text(f'DELETE FROM tg_message WHERE rowid IN ('
+                                f'SELECT rowid FROM tg_message WHERE {sql_where} '
+                                f'ORDER BY date, ext_id LIMIT :batch_size)'),
+                           batch_size=batch_size, **param_dct).rowcount
+
+
+def _purge(con: Connection, stats: PurgeStats, chat_id: int, pol: RetentionPolicy, mod_li: list[str],
+           now: datetime, batch_size: int, pause_s: float):
+    """Purges the messages of the chat under the policy, of its bot_module or, if '', of the modules not in mod_li"""
+    param_dct: dict = dict(tg_chat_id=chat_id)
+    sql_where = 'tg_chat_id = :tg_chat_id'
+    if pol.bot_module:
+        sql_where += ' AND bot_module = :bot_module'
+        param_dct['bot_module'] = pol.bot_module
+    elif mod_li:
+        sql_where += f' AND IFNULL(bot_module, \'\') NOT IN ({", ".join(f":mod_{i}" for i in range(len(mod_li)))})'
+        param_dct.update({f'mod_{i}': mod for i, mod in enumerate(mod_li)})
+    if pol.keep_cmd:
+        sql_where += ' AND g3_cmd_explicit = 0'
+    if pol.max_age_days is not None:
+        date_to = (now - timedelta(days=pol.max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+        while row_count := _del_batch(con, f'{sql_where} AND date < :date_to', dict(param_dct, date_to=date_to),
+                                      batch_size):
+            stats.age_row_count += row_count
+            stats.batch_count += 1
+            sleep(pause_s)
+    if pol.max_rows is not None:
+        excess = con.execute(text(f'SELECT COUNT(*) FROM tg_message WHERE {sql_where}'),
+                             **param_dct).scalar() - pol.max_rows
+        while excess > 0 and (row_count := _del_batch(con, sql_where, param_dct, min(batch_size, excess))):
+            stats.max_row_count += row_count
+            stats.batch_count += 1
+            excess -= row_count
+            sleep(pause_s)
+
+
+def incremental_vacuum(con: Connection, page_count: int = RET_VACUUM_PAGES, pause_s: float = RET_PAUSE_S) -> int:
+    """Gives the free pages back to the file system, page_count per step. Returns the number of pages freed.
+    Nothing to do unless the DB has auto_vacuum INCREMENTAL, see enable_incremental_vacuum."""
+    if con.execute(text('PRAGMA auto_vacuum')).scalar() != AUTO_VACUUM_INCREMENTAL:
+        return 0
+    freed_count = 0
+    while free_count := con.execute(text('PRAGMA freelist_count')).scalar():
+        # executescript steps the pragma to its end, execute would free a single page
+        con.connection.executescript(f'PRAGMA incremental_vacuum({page_count})')
+        freed_count += free_count - con.execute(text('PRAGMA freelist_count')).scalar()
+        if free_count <= page_count:
+            break
+        sleep(pause_s)
+    return freed_count
+
+
+def enable_incremental_vacuum(eng: Engine):
+    """Sets auto_vacuum INCREMENTAL, the VACUUM required rewrites the DB and locks it until done"""
+    start = perf_counter()
+    with eng.connect() as con:
+        if con.execute(text('PRAGMA auto_vacuum')).scalar() == AUTO_VACUUM_INCREMENTAL:
+            return
+        con.execute(text('PRAGMA auto_vacuum = INCREMENTAL'))
+        con.execute(text('VACUUM'))
+    logger.info(f'{eng.url.database}: auto_vacuum INCREMENTAL in {(perf_counter() - start) * 1000:.0f} ms')
+
+
+def purge_messages(eng: Engine, now: datetime = None, batch_size: int = RET_BATCH_SIZE,
+                   pause_s: float = RET_PAUSE_S) -> PurgeStats:
+    """Deletes the messages beyond the retention policies, then runs the incremental vacuum"""
+    if not now:
+        now = datetime.now(timezone.utc)
+    stats = PurgeStats()
+    start = perf_counter()
+    with eng.connect() as con:
+        pol_li = policy_li(con)
+        if not pol_li:
+            return stats
+        if any(pol.tg_chat_id == 0 for pol in pol_li):
+            chat_id_li = [row[0] for row in
+                          con.execute(text('SELECT DISTINCT tg_chat_id FROM tg_message WHERE tg_chat_id IS NOT NULL'))]
+        else:
+            chat_id_li = sorted({pol.tg_chat_id for pol in pol_li})
+        for chat_id in chat_id_li:
+            mod_dct, pol_other = chat_policy_dct(pol_li, chat_id)
+            for pol in mod_dct.values():
+                _purge(con, stats, chat_id, pol, [], now, batch_size, pause_s)
+            if pol_other:
+                _purge(con, stats, chat_id, pol_other, list(mod_dct.keys()), now, batch_size, pause_s)
+            stats.chat_count += 1
+        stats.page_count = incremental_vacuum(con, pause_s=pause_s)
+    stats.ms = (perf_counter() - start) * 1000
+    logger.info(f'Purged {stats.row_count()} messages of {stats.chat_count} chats, {stats.age_row_count} by age, '
+                f'{stats.max_row_count} by max rows, in {stats.batch_count} batches, {stats.page_count} pages freed, '
+                f'{stats.ms:.0f} ms')
+    return stats
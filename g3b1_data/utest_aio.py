@@ -0,0 +1,93 @@
+import asyncio
+import os
+import tempfile
+import threading
+import types
+import unittest
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
+
+from g3b1_data import aio
+from g3b1_data.aio import AioFacade
+
+
+def sel_one(eng, val: int = 1) -> tuple[str, int]:
+    with eng.connect() as con:
+        return threading.current_thread().name, con.execute(text('SELECT :val'), val=val).scalar()
+
+
+def read_ctx(eng) -> None:
+    pass
+
+
+def _private(eng) -> None:
+    pass
+
+
+class AioTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'a.db')}",
+                                 poolclass=QueuePool, pool_size=2, connect_args={'check_same_thread': False})
+        self.eng_b = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'b.db')}")
+        self.modu = types.ModuleType('modu')
+        for fn in [sel_one, read_ctx, _private]:
+            setattr(self.modu, fn.__name__, fn)
+        self.modu.VALUE = 1
+
+    def tearDown(self) -> None:
+        aio.shutdown()
+        self.eng.dispose()
+        self.eng_b.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_executor(self):
+        ex = aio.executor(self.eng)
+        self.assertIs(ex, aio.executor(self.eng))
+        self.assertIsNot(ex, aio.executor(self.eng_b))
+        # never more workers than pooled connections
+        self.assertEqual(2, ex._max_workers)
+        self.assertEqual(aio.AIO_WORKERS, aio.executor(self.eng_b)._max_workers)
+        aio.shutdown()
+        self.assertIsNot(ex, aio.executor(self.eng))
+
+    def test_facade(self):
+        arg_dct_li = []
+
+        def eng_of(arg_dct: dict) -> object:
+            arg_dct_li.append(dict(arg_dct))
+            return arg_dct['eng']
+
+        facade = AioFacade(self.modu, eng_of, ['read_ctx'])
+        thread_name, val = asyncio.run(facade.sel_one(self.eng, val=5))
+        self.assertEqual(5, val)
+        self.assertTrue(thread_name.startswith('aio_a.db'))
+        self.assertEqual([dict(eng=self.eng, val=5)], arg_dct_li)
+        # the coroutine function is cached
+        self.assertIs(facade.sel_one, facade.sel_one)
+        self.assertTrue(asyncio.run(facade.sel_one(self.eng_b))[0].startswith('aio_b.db'))
+        for name in ['read_ctx', '_private', 'VALUE', 'missing']:
+            with self.assertRaises(AttributeError):
+                getattr(facade, name)
+
+    def test_concurrent(self):
+        """The calls of a DB share its executor, the calls of another DB do not wait for them"""
+        f_release = threading.Event()
+        self.modu.wait = lambda eng: f_release.wait(5)
+        facade = AioFacade(self.modu, lambda arg_dct: arg_dct['eng'])
+
+        async def main():
+            wait_li = [asyncio.ensure_future(facade.wait(self.eng)) for _ in range(2)]
+            await asyncio.sleep(0.05)
+            # both workers of a.db are busy
+            _, val = await asyncio.wait_for(facade.sel_one(self.eng_b, 7), 5)
+            f_release.set()
+            return val, await asyncio.gather(*wait_li)
+
+        self.assertEqual((7, [True, True]), asyncio.run(main()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, text
+
+from g3b1_data.cache import LruCache, UpsertCache, EntCache, SetngCache, after_commit
+from g3b1_data.entities import EntTy
+
+ENT_TY_a = EntTy('trans', 'utest_a', 'A')
+ENT_TY_b = EntTy('trans', 'utest_b', 'B')
+
+
+class LruCacheTestCase(unittest.TestCase):
+
+    def test_evict(self):
+        lru = LruCache(2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        self.assertEqual(1, lru.get('a'))
+        lru.put('c', 3)
+        # b is the least recently used
+        self.assertNotIn('b', lru)
+        self.assertEqual(['a', 'c'], lru.key_li())
+        self.assertEqual(1, lru.hit_count)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(1, lru.miss_count)
+
+    def test_put_if_absent(self):
+        lru = LruCache(10)
+        self.assertEqual(1, lru.put_if_absent('a', 1))
+        self.assertEqual(1, lru.put_if_absent('a', 2))
+
+    def test_pop_if(self):
+        lru = LruCache(10)
+        for k in [('x', 1), ('x', 2), ('y', 1)]:
+            lru.put(k, True)
+        self.assertEqual(2, lru.pop_if(lambda k: k[0] == 'x'))
+        self.assertEqual([('y', 1)], lru.key_li())
+
+
+class UpsertCacheTestCase(unittest.TestCase):
+
+    def test_invalidate(self):
+        cache = UpsertCache()
+        cache.remember('db', 'tg_user', (1,), dict(ext_id=1, username='a'))
+        cache.remember('db', 'tg_user', (2,), dict(ext_id=2, username='b'))
+        self.assertTrue(cache.is_unchanged('db', 'tg_user', (1,), dict(ext_id=1, username='a')))
+        self.assertFalse(cache.is_unchanged('db', 'tg_user', (1,), dict(ext_id=1, username='c')))
+        self.assertEqual(1, cache.invalidate('db', 'tg_user', (1,)))
+        self.assertFalse(cache.is_unchanged('db', 'tg_user', (1,), dict(ext_id=1, username='a')))
+        self.assertEqual(1, cache.invalidate_li('db', 'tg_user', [(2,), (3,)]))
+        self.assertEqual(0, len(cache.lru))
+
+
+class EntCacheTestCase(unittest.TestCase):
+
+    def test_invalidate(self):
+        cache = EntCache()
+        cache.put(ENT_TY_a, SimpleNamespace(id=1))
+        cache.put(ENT_TY_a, SimpleNamespace(id=2))
+        cache.put(ENT_TY_b, SimpleNamespace(id=1))
+        self.assertEqual(1, cache.invalidate(ENT_TY_a, 1))
+        self.assertIsNone(cache.get(ENT_TY_a, 1))
+        self.assertIsNotNone(cache.get(ENT_TY_a, 2))
+        self.assertEqual(1, cache.invalidate(ENT_TY_a))
+        self.assertEqual([ENT_TY_b], cache.cached_ent_ty_li())
+        self.assertEqual(0.5, cache.hit_ratio(ENT_TY_a))
+
+    def test_bkey(self):
+        cache = EntCache()
+        cache.put(ENT_TY_a, SimpleNamespace(id=1, bkey='k'), (7,), 'k')
+        self.assertEqual(1, cache.get_by_bkey(ENT_TY_a, (7,), 'k').id)
+        self.assertIsNone(cache.get_by_bkey(ENT_TY_a, (8,), 'k'))
+        # bkey changed since
+        cache.put(ENT_TY_a, SimpleNamespace(id=1, bkey='l'), (7,), 'l')
+        self.assertIsNone(cache.get_by_bkey(ENT_TY_a, (7,), 'k'))
+        self.assertEqual('l', cache.get_by_bkey(ENT_TY_a, (7,), 'l').bkey)
+        cache.invalidate(ENT_TY_a, 1)
+        self.assertIsNone(cache.get_by_bkey(ENT_TY_a, (7,), 'l'))
+
+    def test_copy(self):
+        cache = EntCache()
+        child = SimpleNamespace(id=5, ent_ty=ENT_TY_b)
+        ent = SimpleNamespace(id=1, name='a', child=child, child_li=[child])
+        cache.put(ENT_TY_a, ent)
+        ent.name = 'b'
+        ent_1 = cache.get(ENT_TY_a, 1)
+        self.assertEqual('a', ent_1.name)
+        ent_1.name = 'c'
+        ent_2 = cache.get(ENT_TY_a, 1)
+        self.assertEqual('a', ent_2.name)
+        self.assertIsNot(ent_1, ent_2)
+        # the graph of a copy keeps its shape, the types are shared
+        self.assertIs(ent_2.child, ent_2.child_li[0])
+        self.assertIs(ENT_TY_b, ent_2.child.ent_ty)
+
+    def test_stale_read(self):
+        cache = EntCache()
+        gen = cache.gen
+        # a write invalidates while the graph is read
+        cache.invalidate(ENT_TY_a, 1)
+        cache.put(ENT_TY_a, SimpleNamespace(id=1), gen=gen)
+        self.assertIsNone(cache.get(ENT_TY_a, 1))
+        cache.put(ENT_TY_a, SimpleNamespace(id=1), gen=cache.gen)
+        self.assertIsNotNone(cache.get(ENT_TY_a, 1))
+
+
+class SetngCacheTestCase(unittest.TestCase):
+
+    def test_invalidate(self):
+        cache = SetngCache()
+        cache.put_row('db', 'chat_setng', 10, 0, {'lc': 'en'}, cache.gen)
+        cache.put_row('db', 'user_setng', 0, 1, {'lc': 'de'}, cache.gen)
+        self.assertEqual({'lc': 'en'}, cache.get_row('db', 'chat_setng', 10, 0))
+        self.assertEqual(1, cache.invalidate('db', 'chat_setng', 10))
+        self.assertIsNone(cache.get_row('db', 'chat_setng', 10, 0))
+        self.assertEqual({'lc': 'de'}, cache.get_row('db', 'user_setng', 0, 1))
+        self.assertEqual(1, cache.invalidate('db'))
+        self.assertEqual(0, len(cache.lru))
+
+    def test_stale_read(self):
+        cache = SetngCache()
+        gen = cache.gen
+        # a write invalidates while the row is read
+        cache.invalidate('db', 'chat_setng', 10)
+        cache.put_row('db', 'chat_setng', 10, 0, {'lc': 'en'}, gen)
+        self.assertIsNone(cache.get_row('db', 'chat_setng', 10, 0))
+
+
+class AfterCommitTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'cache.db')}")
+        self.call_li = []
+
+    def tearDown(self) -> None:
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_no_transaction(self):
+        after_commit(self.eng, lambda: self.call_li.append(1))
+        self.assertEqual([1], self.call_li)
+
+    def test_commit(self):
+        with self.eng.begin() as con:
+            con.execute(text('CREATE TABLE t (a integer)'))
+            after_commit(con, lambda: self.call_li.append(1))
+            self.assertEqual([], self.call_li)
+        self.assertEqual([1], self.call_li)
+
+    def test_rollback(self):
+        with self.eng.connect() as con:
+            trans = con.begin()
+            after_commit(con, lambda: self.call_li.append(1))
+            trans.rollback()
+            # the listeners of the rolled back transaction are gone
+            with con.begin():
+                pass
+        self.assertEqual([], self.call_li)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from typing import Optional
+
+from sqlalchemy import text
+
+from g3b1_data import change_log, db_registry
+
+TBL_NAME = 'utest_chg'
+
+
+class ChangeWatcherTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.tmp_dir.name, 'chg.db')
+        self.eng = db_registry.create_eng(self.db_file)
+        with self.eng.begin() as con:
+            con.execute(text(f'CREATE TABLE {TBL_NAME} (chat_id integer, user_id integer, val text, '
+                             f'PRIMARY KEY (chat_id, user_id))'))
+        self.assertEqual([TBL_NAME], change_log.install(self.eng, {TBL_NAME: ['chat_id', 'user_id']}))
+        change_log.listen_own(self.eng)
+        self.watcher = change_log.ChangeWatcher(self.eng)
+        self.chg_li: list[Optional[list[tuple]]] = []
+        change_log.subscribe(TBL_NAME, self.on_change)
+        # connects, the changes from now on are read by the next poll
+        self.assertEqual(0, self.watcher.poll())
+
+    def tearDown(self) -> None:
+        self.chg_li = None
+        self.watcher.close()
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def on_change(self, db: str, tbl_name: str, key_li: Optional[list[tuple]]):
+        # subscriptions outlive the test case
+        if self.chg_li is not None and db == self.watcher.db:
+            self.chg_li.append(key_li)
+
+    def write_foreign(self, sql: str):
+        """As another process: a connection without the TEMP trigger stamping the pid"""
+        conn = sqlite3.connect(self.db_file)
+        with conn:
+            conn.execute(sql)
+        conn.close()
+
+    def test_skip_own(self):
+        with self.eng.begin() as con:
+            con.execute(text(f"INSERT INTO {TBL_NAME} (chat_id, user_id, val) VALUES (10, 1, 'a')"))
+        self.assertEqual(1, self.watcher.poll())
+        self.assertEqual([], self.chg_li)
+
+    def test_foreign(self):
+        self.write_foreign(f"INSERT INTO {TBL_NAME} (chat_id, user_id, val) VALUES (10, 1, 'a'), (10, 2, 'b')")
+        self.write_foreign(f"UPDATE {TBL_NAME} SET val = 'c' WHERE chat_id = 10 AND user_id = 1")
+        self.assertEqual(3, self.watcher.poll())
+        self.assertEqual([[(10, 1), (10, 2)]], self.chg_li)
+        # nothing committed since
+        self.assertEqual(0, self.watcher.poll())
+
+    def test_own_and_foreign(self):
+        with self.eng.begin() as con:
+            con.execute(text(f"INSERT INTO {TBL_NAME} (chat_id, user_id, val) VALUES (10, 1, 'a')"))
+        self.write_foreign(f"DELETE FROM {TBL_NAME} WHERE chat_id = 10")
+        self.assertEqual(2, self.watcher.poll())
+        self.assertEqual([[(10, 1)]], self.chg_li)
+
+    def test_pruned(self):
+        self.write_foreign(f"INSERT INTO {TBL_NAME} (chat_id, user_id, val) VALUES (10, 1, 'a')")
+        # the rows not read yet have been pruned by another watcher
+        self.write_foreign(f"DELETE FROM {change_log.TBL_CHG_LOG}")
+        self.write_foreign(f"INSERT INTO {TBL_NAME} (chat_id, user_id, val) VALUES (10, 2, 'b')")
+        self.assertEqual(1, self.watcher.poll())
+        self.assertEqual([None], self.chg_li)
+
+
+if __name__ == '__main__':
+    unittest.main()
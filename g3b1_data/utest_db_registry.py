@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from g3b1_data import db_registry, db_profile
+from g3b1_data.db_metrics import pool_stats_li
+
+
+class ProfileTestCase(unittest.TestCase):
+
+    def test_profile_name_of(self):
+        self.assertEqual('wal', db_profile.profile_name_of(r'C:\g3b1\g3b1_tg.db'))
+        self.assertEqual(db_profile.DB_PROFILE, db_profile.profile_name_of('/g3b1/g3b1_cfg.db'))
+        self.assertEqual(db_profile.DB_PROFILE, db_profile.profile_name_of(None))
+        with mock.patch.dict(os.environ, {'g3b1_db_profile_g3b1_tg': 'wal_full', 'g3b1_db_profile_g3b1_cfg': 'wal'}):
+            self.assertEqual('wal_full', db_profile.profile_name_of(r'C:\g3b1\g3b1_tg.db'))
+            self.assertEqual('wal', db_profile.profile_name_of('/g3b1/g3b1_cfg.db'))
+
+
+class RoEngTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng_li = []
+
+    def tearDown(self) -> None:
+        for eng in self.eng_li:
+            eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def create_eng(self, file_name: str, profile: str = None, f_create=True):
+        eng = db_registry.create_eng(os.path.join(self.tmp_dir.name, file_name), profile)
+        self.eng_li.append(eng)
+        if f_create:
+            with eng.begin() as con:
+                con.execute(text('CREATE TABLE t (a integer)'))
+                con.execute(text('INSERT INTO t (a) VALUES (1)'))
+        return eng
+
+    def test_wal(self):
+        eng = self.create_eng('g3b1_tg.db')
+        self.assertEqual('wal', db_profile.profile_of(eng).name)
+        ro = db_registry.ro_eng(eng)
+        self.eng_li.append(ro)
+        self.assertIsNot(eng, ro)
+        self.assertIs(ro, db_registry.ro_eng(eng))
+        with ro.connect() as con:
+            self.assertEqual('wal', con.execute(text('PRAGMA journal_mode')).scalar())
+            self.assertEqual(1, con.execute(text('SELECT a FROM t')).scalar())
+            with self.assertRaises(OperationalError) as cm:
+                con.execute(text('INSERT INTO t (a) VALUES (2)'))
+            self.assertIsInstance(cm.exception.orig, sqlite3.OperationalError)
+        # the read-only pool has stats of its own
+        self.assertIn((ro.url.database, 'ro'), [(stats.db_file, stats.mode) for stats in pool_stats_li()])
+
+    def test_fallback(self):
+        """Not in WAL mode the readers use the read-write engine"""
+        eng = self.create_eng('g3b1_other.db', 'default')
+        self.assertIs(eng, db_registry.ro_eng(eng))
+
+    def test_fallback_no_file(self):
+        eng = self.create_eng('g3b1_new.db', 'wal', f_create=False)
+        self.assertIs(eng, db_registry.ro_eng(eng))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+from sqlalchemy import MetaData, create_engine, text, event, select
+
+from g3b1_data import integrity
+from g3b1_data.py_meta import SNAPSHOT_ATTR
+
+SQL_CREATE_li = [
+    'CREATE TABLE lang (id integer PRIMARY KEY, code text)',
+    'CREATE TABLE word (id integer PRIMARY KEY, text text, lang_id integer REFERENCES lang (id), '
+    'lang_trg_id integer REFERENCES lang (id))'
+]
+
+
+def from_row_any(ent_ty, row, repl_dct: dict):
+    return types.SimpleNamespace(ent_ty=ent_ty, id_=row['id'], code=row['code'])
+
+
+class OrmLiTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'm.db')}")
+        with self.eng.begin() as con:
+            for sql in SQL_CREATE_li:
+                con.execute(text(sql))
+            con.execute(text("INSERT INTO lang (id, code) VALUES (1, 'de'), (2, 'en'), (3, 'fr'), (4, 'it')"))
+            con.execute(text("INSERT INTO word (id, text, lang_id, lang_trg_id) VALUES "
+                             "(1, 'a', 1, 2), (2, 'b', 2, 3), (3, 'c', 4, NULL), (4, 'd', 1, 1)"))
+        self.md = MetaData()
+        self.md.reflect(self.eng)
+        self.sql_li = []
+        event.listen(self.eng, 'before_cursor_execute', self.on_execute)
+        patcher = mock.patch.object(integrity, 'ent_ty_by_tbl_name', lambda tbl_name, g3m_str_li: tbl_name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def on_execute(self, con, cursor, statement, parameters, context, executemany):
+        if 'FROM lang' in statement:
+            self.sql_li.append(statement)
+
+    def sel_word_li(self) -> list:
+        with self.eng.connect() as con:
+            return con.execute(select(self.md.tables['word']).order_by('id')).fetchall()
+
+    def orm_li(self, row_li: list, repl_dct: dict = None, ent_req_dct: dict = None) -> list[dict]:
+        with self.eng.connect() as con:
+            return integrity.orm_li(con, self.md.tables['word'], row_li, from_row_any, repl_dct, ent_req_dct)
+
+    def test_fk_tbl_dct(self):
+        tbl = self.md.tables['word']
+        self.assertEqual({'lang_id': self.md.tables['lang'], 'lang_trg_id': self.md.tables['lang']},
+                         integrity.fk_tbl_dct(tbl, []))
+        self.assertEqual(['lang_trg_id'], list(integrity.fk_tbl_dct(tbl, ['lang_id']).keys()))
+
+    def test_orm_li(self):
+        ent_req_dct = {}
+        repl_dct_li = self.orm_li(self.sel_word_li(), ent_req_dct=ent_req_dct)
+        # one query for the distinct ids of lang
+        self.assertEqual(1, len(self.sql_li))
+        self.assertEqual([('de', 'en'), ('en', 'fr'), ('it', None), ('de', 'de')],
+                         [(repl_dct['lang_id'].code, repl_dct['lang_trg_id'] and repl_dct['lang_trg_id'].code)
+                          for repl_dct in repl_dct_li])
+        # the rows referencing the same id share the entity
+        self.assertIs(repl_dct_li[0]['lang_id'], repl_dct_li[3]['lang_trg_id'])
+        self.assertEqual('lang', repl_dct_li[0]['lang_id'].ent_ty)
+        self.assertEqual('de', getattr(repl_dct_li[0]['lang_id'], SNAPSHOT_ATTR)['code'])
+        self.assertEqual({('lang', 1), ('lang', 2), ('lang', 3), ('lang', 4)}, set(ent_req_dct.keys()))
+        # the entities of the request are reused
+        repl_dct_li_2 = self.orm_li(self.sel_word_li()[:2], ent_req_dct=ent_req_dct)
+        self.assertEqual(1, len(self.sql_li))
+        self.assertIs(repl_dct_li[0]['lang_id'], repl_dct_li_2[0]['lang_id'])
+
+    def test_chunk(self):
+        with mock.patch.object(integrity, 'IN_CHUNK', 2):
+            repl_dct_li = self.orm_li(self.sel_word_li())
+        # 4 ids in chunks of 2
+        self.assertEqual(2, len(self.sql_li))
+        self.assertEqual(['de', 'en', 'it', 'de'], [repl_dct['lang_id'].code for repl_dct in repl_dct_li])
+
+    def test_repl_dct(self):
+        repl_dct_li = self.orm_li(self.sel_word_li()[2:3], dict(lang_id='given'))
+        self.assertEqual([dict(lang_id='given', lang_trg_id=None)], repl_dct_li)
+        # no id to resolve, no query
+        self.assertEqual([], self.sql_li)
+        self.assertEqual([], self.orm_li([]))
+        self.assertEqual([], self.sql_li)
+
+    def test_orm(self):
+        with self.eng.connect() as con:
+            repl_dct = integrity.orm(con, self.md.tables['word'], self.sel_word_li()[1], from_row_any)
+            self.assertEqual(('en', 'fr'), (repl_dct['lang_id'].code, repl_dct['lang_trg_id'].code))
+            self.assertEqual(dict(x=1), integrity.orm(con, self.md.tables['word'], None, from_row_any, dict(x=1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
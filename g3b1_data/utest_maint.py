@@ -0,0 +1,50 @@
+import threading
+import unittest
+from unittest import mock
+
+from g3b1_data import maint
+
+
+class MaintTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.call_li: list[str] = []
+        self.f_run = threading.Event()
+        # only the jobs of the test, not those scheduled at import by other modules
+        patcher = mock.patch.dict(maint._job_dct, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        maint.stop()
+
+    def job_a(self) -> int:
+        self.call_li.append('a')
+        self.f_run.set()
+        return 1
+
+    def job_b(self):
+        self.call_li.append('b')
+        raise ValueError('b')
+
+    def test_run_all(self):
+        maint.schedule('utest_b', self.job_b)
+        maint.schedule('utest_a', self.job_a)
+        result_dct = maint.run_all()
+        # a failing job does not stop the others
+        self.assertEqual(1, result_dct['utest_a'])
+        self.assertIsInstance(result_dct['utest_b'], ValueError)
+        self.assertEqual(['b', 'a'], self.call_li)
+
+    def test_start_stop(self):
+        maint.schedule('utest_a', self.job_a)
+        maint.start(interval_s=60)
+        # the first run is at start
+        self.assertTrue(self.f_run.wait(5))
+        maint.stop()
+        self.assertEqual(['a'], self.call_li)
+        self.assertIsNone(maint._thread)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import atexit
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine, text
+
+from g3b1_data import schema_cache
+from g3b1_data.schema_cache import LazyMetaData
+
+SQL_CREATE_li = [
+    'CREATE TABLE lang (id integer PRIMARY KEY, code text)',
+    'CREATE TABLE word (id integer PRIMARY KEY, text text, lang_id integer REFERENCES lang (id))',
+    'CREATE TABLE other (id integer PRIMARY KEY)'
+]
+
+
+class LazyMetaDataTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'm.db')}")
+        with self.eng.begin() as con:
+            for sql in SQL_CREATE_li:
+                con.execute(text(sql))
+        patcher = mock.patch.object(schema_cache, 'SCHEMA_CACHE_DIR', os.path.join(self.tmp_dir.name, 'cache'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def lazy_md(self) -> LazyMetaData:
+        md = LazyMetaData(self.eng)
+        # the temp dir is gone at exit
+        self.addCleanup(atexit.unregister, md.save)
+        return md
+
+    def tearDown(self) -> None:
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def test_reflect(self):
+        md = self.lazy_md()
+        self.assertNotIn('word', md.tables)
+        self.assertEqual(['id', 'text', 'lang_id'], md.tables['word'].columns.keys())
+        # the referenced table with it
+        self.assertEqual(['lang', 'word'], sorted(dict.keys(md.tables)))
+        self.assertIsNone(md.tables.get('missing'))
+        self.assertEqual(['lang', 'other', 'word'], sorted(md.tables.keys()))
+
+    def test_cache(self):
+        md = self.lazy_md()
+        md.tables.get('word')
+        md.save()
+        self.assertTrue(os.path.exists(schema_cache.cache_file(self.eng.url.database)))
+        md = self.lazy_md()
+        tbl = md.tables['word']
+        self.assertEqual(0, md._reflect_count)
+        # the referenced table is taken from the cache as well and the foreign key resolves
+        self.assertEqual(['lang', 'word'], sorted(dict.keys(md.tables)))
+        self.assertIs(md.tables['lang'], next(iter(tbl.foreign_keys)).column.table)
+        # DDL, the cache is outdated
+        with self.eng.begin() as con:
+            con.execute(text('CREATE TABLE new (id integer)'))
+        self.assertIsNone(schema_cache.load_cache(self.eng.url.database, schema_cache.schema_version(self.eng)))
+
+
+if __name__ == '__main__':
+    unittest.main()
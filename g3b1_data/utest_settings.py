@@ -0,0 +1,170 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import MetaData, create_engine, text, event
+
+from g3b1_data import settings, integrity, db_registry, aio
+from g3b1_data.cache import setng_cache
+from g3b1_data.elements import EleTy, ELE_TY_lc, ELE_TY_lc2, ELE_TY_lc_pair, ELE_TY_send_onyms
+from g3b1_data.entities import EntTy
+
+SQL_CREATE_li = [
+    'CREATE TABLE user_chat_settings (tg_chat_id integer NOT NULL, tg_user_id integer NOT NULL, lc text, lc2 text, '
+    'send_onyms integer, word_id text, PRIMARY KEY (tg_chat_id, tg_user_id))',
+    'CREATE TABLE chat_settings (tg_chat_id integer PRIMARY KEY, lc text, word_id text)',
+    'CREATE TABLE user_settings (tg_user_id integer PRIMARY KEY, lc text)'
+]
+
+ELE_TY_word_id = EleTy(id_='word_id', descr='Word', ent_ty=EntTy('trans', 'word', 'Word'))
+
+
+class SettingsTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'settings.db')}")
+        with self.eng.begin() as con:
+            for sql in SQL_CREATE_li:
+                con.execute(text(sql))
+        self.md = MetaData()
+        self.md.reflect(self.eng)
+        self.sql_li = []
+        event.listen(self.eng, 'before_cursor_execute', self.on_execute)
+
+    def tearDown(self) -> None:
+        setng_cache.invalidate(db_registry.db_key(self.eng.url.database))
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def on_execute(self, con, cursor, statement, parameters, context, executemany):
+        if '_settings' in statement:
+            self.sql_li.append(statement)
+
+    def sel_row_li(self, tbl_name: str) -> list[tuple]:
+        with self.eng.connect() as con:
+            return [tuple(row) for row in con.execute(text(f'SELECT * FROM {tbl_name} ORDER BY 1, 2'))]
+
+    def val_li(self, params: dict, ele_ty_li: list[EleTy], con=None) -> list:
+        return [ele_val.val for ele_val in settings.read_setting_li(con or self.eng, self.md, params, ele_ty_li)]
+
+    def test_row_cache(self):
+        params = settings.setng_scope((10, 1))
+        settings.iup_setting_li(self.eng, self.md, params, [(ELE_TY_lc, 'de'), (ELE_TY_lc2, 'en')])
+        self.sql_li.clear()
+        self.assertEqual(['de', 'en'], self.val_li(params, [ELE_TY_lc, ELE_TY_lc2]))
+        self.assertEqual([''], self.val_li(params, [ELE_TY_send_onyms]))
+        # the whole row is read once
+        self.assertEqual(1, len(self.sql_li))
+        # a missing row is cached as well
+        self.assertEqual([''], self.val_li(settings.setng_scope((20, 1)), [ELE_TY_lc]))
+        self.assertEqual([''], self.val_li(settings.setng_scope((20, 1)), [ELE_TY_lc]))
+        self.assertEqual(2, len(self.sql_li))
+        # a write drops the row
+        settings.iup_setting_li(self.eng, self.md, params, [(ELE_TY_lc, 'fr')])
+        self.assertEqual(['fr', 'en'], self.val_li(params, [ELE_TY_lc, ELE_TY_lc2]))
+        with self.assertRaises(KeyError):
+            self.val_li(settings.setng_scope((10, 1), True), [ELE_TY_lc2])
+
+    def test_row_cache_trans(self):
+        params = settings.setng_scope((10, 1))
+        settings.iup_setting_li(self.eng, self.md, params, [(ELE_TY_lc, 'de')])
+        with self.eng.connect() as con, con.begin():
+            settings.iup_setting_li(con, self.md, params, [(ELE_TY_lc, 'fr')])
+            # within the transaction the change not committed, not cached
+            self.assertEqual(['fr'], self.val_li(params, [ELE_TY_lc], con))
+            self.assertEqual(['de'], self.val_li(params, [ELE_TY_lc]))
+        # invalidated once more at commit
+        self.assertEqual(['fr'], self.val_li(params, [ELE_TY_lc]))
+
+    def test_tuple(self):
+        ch_us_tup = (10, 1)
+        self.assertEqual(('', ''), settings.read_setng_by(self.eng, self.md, ch_us_tup, ELE_TY_lc_pair).val)
+        settings.iup_setting_li(self.eng, self.md, settings.setng_scope(ch_us_tup),
+                                [(ELE_TY_lc, 'de'), (ELE_TY_lc2, 'en'), (ELE_TY_send_onyms, 1)])
+        self.sql_li.clear()
+        with self.eng.connect() as con, con.begin():
+            ele_val = settings.read_setng_by(con, self.md, ch_us_tup, ELE_TY_lc_pair)
+        self.assertEqual(('de', 'en'), ele_val.val)
+        self.assertEqual(ELE_TY_lc_pair, ele_val.ele_ty)
+        # the members with one statement
+        self.assertEqual(1, len(self.sql_li))
+        self.assertTrue(self.sql_li[0].startswith('SELECT user_chat_settings.lc, user_chat_settings.lc2 '))
+        self.assertIs(True, settings.read_setng_by(self.eng, self.md, ch_us_tup, ELE_TY_send_onyms).val_mp)
+
+    def test_iup_setting_li(self):
+        settings.iup_setting_li(self.eng, self.md, settings.setng_scope((10, 1)),
+                                [(ELE_TY_lc, 'de'), (ELE_TY_lc2, 'en')])
+        g3r = settings.iup_setting_li(self.eng, self.md, settings.setng_scope((10, 1)),
+                                      [(ELE_TY_lc, 'None'), (ELE_TY_lc2, 'fr')])
+        self.assertEqual(dict(tg_user_id=1, tg_chat_id=10, lc=None, lc2='fr'), g3r.result)
+        settings.iup_setting_li(self.eng, self.md, settings.setng_scope((10, 1), True), [(ELE_TY_lc, 'it')])
+        settings.iup_setting_li(self.eng, self.md, dict(user_id=1), [(ELE_TY_lc, 'es')])
+        self.assertEqual([(10, 1, None, 'fr', None, None)], self.sel_row_li('user_chat_settings'))
+        self.assertEqual([(10, 'it', None)], self.sel_row_li('chat_settings'))
+        self.assertEqual([(1, 'es')], self.sel_row_li('user_settings'))
+        # one upsert per call
+        self.assertEqual(4, len([sql for sql in self.sql_li if sql.startswith('INSERT')]))
+
+    def test_iup_setting_many(self):
+        settings.iup_setting_li(self.eng, self.md, settings.setng_scope((10, 1)), [(ELE_TY_lc2, 'en')])
+        self.assertEqual(['en'], self.val_li(settings.setng_scope((10, 1)), [ELE_TY_lc2]))
+        self.sql_li.clear()
+        params_li = [settings.setng_scope((chat_id, 1)) for chat_id in [10, 20, 30]]
+        self.assertEqual(3, settings.iup_setting_many(self.eng, self.md, params_li, [(ELE_TY_lc, 'de')]).result)
+        self.assertEqual(1, len(self.sql_li))
+        # the other columns are kept, the cached row is dropped
+        self.assertEqual([(10, 1, 'de', 'en', None, None), (20, 1, 'de', None, None, None),
+                          (30, 1, 'de', None, None, None)], self.sel_row_li('user_chat_settings'))
+        self.assertEqual(['de', 'en'], self.val_li(settings.setng_scope((10, 1)), [ELE_TY_lc, ELE_TY_lc2]))
+        with self.eng.connect() as con, con.begin():
+            settings.iup_setting_many(con, self.md, params_li[:1], [(ELE_TY_lc, None)])
+        self.assertEqual([''], self.val_li(settings.setng_scope((10, 1)), [ELE_TY_lc]))
+
+    def test_iup_setting_many_edge(self):
+        self.assertEqual(0, settings.iup_setting_many(self.eng, self.md, [], [(ELE_TY_lc, 'de')]).result)
+        self.assertEqual([], self.sql_li)
+        with self.assertRaises(ValueError):
+            settings.iup_setting_many(self.eng, self.md, [settings.setng_scope((10, 1)),
+                                                          settings.setng_scope((20, 1), True)], [(ELE_TY_lc, 'de')])
+        self.assertEqual([], self.sel_row_li('user_chat_settings'))
+
+    def test_setng_ref(self):
+        idx_name_li = settings.create_setng_ref_idx(self.eng, self.md, [ELE_TY_word_id, ELE_TY_lc])
+        self.assertEqual(['ix_user_chat_settings_word_id', 'ix_chat_settings_word_id'], idx_name_li)
+        self.assertEqual([], settings.create_setng_ref_idx(self.eng, self.md, [ELE_TY_word_id]))
+        params_li = [settings.setng_scope((chat_id, 1)) for chat_id in [10, 20, 30]]
+        settings.iup_setting_many(self.eng, self.md, params_li[:2], [(ELE_TY_word_id, '5')])
+        settings.iup_setting_many(self.eng, self.md, params_li[2:], [(ELE_TY_word_id, 7)])
+        with self.eng.connect() as con:
+            self.assertIn('USING INDEX ix_user_chat_settings_word_id', ' '.join(str(row[-1]) for row in con.execute(
+                text('EXPLAIN QUERY PLAN SELECT tg_chat_id FROM user_chat_settings WHERE word_id IN (5, 7)'))))
+            self.sql_li.clear()
+            with mock.patch.object(integrity, 'IN_CHUNK', 2):
+                refs_dct = settings.sel_cu_setng_ref_dct(con, self.md, ELE_TY_word_id, [5, 6, 7])
+            # 3 ids in chunks of 2
+            self.assertEqual(2, len(self.sql_li))
+            self.assertEqual({5: [(10, 1), (20, 1)], 6: [], 7: [(30, 1)]},
+                             {ele_val: [(setng['chat_id'], setng['user_id']) for setng in setng_li]
+                              for ele_val, setng_li in refs_dct.items()})
+            self.assertEqual(ELE_TY_word_id, refs_dct[5][0]['ele_ty'])
+            self.assertEqual([], settings.sel_cu_setng_ref_li(con, self.md, ELE_TY_word_id, 8))
+            self.assertEqual({}, settings.sel_cu_setng_ref_dct(con, self.md, ELE_TY_word_id, []))
+
+    def test_aio(self):
+        self.addCleanup(aio.shutdown)
+        params = settings.setng_scope((10, 1))
+        g3r = asyncio.run(settings.aio.iup_setting_li(self.eng, self.md, params, [(ELE_TY_lc, 'de')]))
+        self.assertEqual('de', g3r.result['lc'])
+        self.assertEqual(['de'], [ele_val.val for ele_val in asyncio.run(
+            settings.aio.read_setting_li(self.eng, self.md, params, [ELE_TY_lc]))])
+        # the functions reading G3Ctx have no aio variant
+        for name in ['ins_init_setng', 'cu_setng', 'ent_by_setng']:
+            with self.assertRaises(AttributeError):
+                getattr(settings.aio, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,290 @@
+import os
+import tempfile
+import unittest
+from datetime import date
+from unittest import mock
+
+from sqlalchemy import MetaData, create_engine, text, event
+
+from g3b1_data import tg_db, integrity, settings, db_registry, tg_msg_arc
+from g3b1_data.cache import ent_cache, setng_cache
+from g3b1_data.elements import EleTy
+from g3b1_data.entities import EntTy, EntId, LoadPlan
+from g3b1_data.py_meta import ent_dirty_dct, ent_snapshot
+from g3b1_data.tg_db_sqlite import TG_MIGRATION_li
+
+SQL_CREATE_li = [
+    'CREATE TABLE lang (id integer PRIMARY KEY, code text)',
+    'CREATE TABLE word_grp (id integer PRIMARY KEY, bkey text, descr text, lang_id integer REFERENCES lang (id))',
+    'CREATE TABLE word (id integer PRIMARY KEY, word_grp_id integer REFERENCES word_grp (id), text text, '
+    'lang_id integer REFERENCES lang (id))',
+    'CREATE TABLE user_chat_settings (tg_chat_id integer NOT NULL, tg_user_id integer NOT NULL, '
+    'word_grp_id integer, PRIMARY KEY (tg_chat_id, tg_user_id))',
+    "INSERT INTO lang (id, code) VALUES (1, 'de'), (2, 'en')",
+    "INSERT INTO word_grp (id, bkey, descr, lang_id) VALUES (1, 'g1', 'Group 1', 1), (2, 'g2', 'Group 2', 2), "
+    "(3, 'g3', 'Group 3', NULL)",
+    "INSERT INTO word (id, word_grp_id, text, lang_id) VALUES (1, 1, 'Haus', 1), (2, 1, 'house', 2), "
+    "(3, 2, 'Baum', 1), (4, 1, 'Maus', 1)",
+    "INSERT INTO user_chat_settings (tg_chat_id, tg_user_id, word_grp_id) VALUES (10, 1, 1), (10, 2, NULL)"
+]
+
+SQL_CREATE_MSG = 'CREATE TABLE tg_message (tg_chat_id integer, ext_id integer, tg_user_id integer, date text, ' \
+                 'text text, g3_cmd_explicit integer DEFAULT 0, PRIMARY KEY (tg_chat_id, ext_id))'
+
+ENT_TY_lang = EntTy('utest', 'lang', 'Language')
+ENT_TY_word = EntTy('utest', 'word', 'Word')
+ENT_TY_word_grp = EntTy('utest', 'word_grp', 'Word group', it_ent_ty_dct={'word_li': ENT_TY_word})
+ENT_TY_dct = {ent_ty.tbl_name: ent_ty for ent_ty in [ENT_TY_lang, ENT_TY_word, ENT_TY_word_grp]}
+
+ELE_TY_word_grp_id = EleTy(id_='word_grp_id', descr='Word group', ent_ty=ENT_TY_word_grp)
+
+
+class Ent:
+
+    def __init__(self, ent_ty: EntTy, **kwargs) -> None:
+        super().__init__()
+        self.ent_ty = ent_ty
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+
+def from_row_any(ent_ty: EntTy, row, repl_dct: dict) -> Ent:
+    return Ent(ent_ty, **{**dict(row._mapping), **repl_dct})
+
+
+class TgDbTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'utest.db')}")
+        with self.eng.begin() as con:
+            for sql in SQL_CREATE_li:
+                con.execute(text(sql))
+        self.md = MetaData()
+        self.md.reflect(self.eng)
+        self.sql_li = []
+        event.listen(self.eng, 'before_cursor_execute', self.on_execute)
+        for patcher in [
+            mock.patch.object(tg_db, 'get_meta_attr', lambda ent_ty: (from_row_any, self.md, self.eng)),
+            mock.patch.object(tg_db, 'ent_ty_by_tbl_name', lambda tbl_name, g3m_str_li: ENT_TY_dct.get(tbl_name)),
+            mock.patch.object(integrity, 'ent_ty_by_tbl_name', lambda tbl_name, g3m_str_li: ENT_TY_dct[tbl_name]),
+            mock.patch.object(tg_db, 'ele_ty_by_ent_ty',
+                              lambda ent_ty: EleTy(id_=f'{ent_ty.tbl_name}_id', descr='', ent_ty=ent_ty))
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(tg_db.graph_ent_ty_set.cache_clear)
+
+    def tearDown(self) -> None:
+        for ent_ty in ENT_TY_dct.values():
+            ent_cache.invalidate(ent_ty)
+        setng_cache.invalidate(db_registry.db_key(self.eng.url.database))
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def on_execute(self, con, cursor, statement, parameters, context, executemany):
+        self.sql_li.append((statement, parameters))
+
+    def stmnt_li(self, prefix: str = 'SELECT') -> list[str]:
+        return [sql for sql, params in self.sql_li if sql.startswith(prefix)]
+
+    def test_sel_ent_ty(self):
+        with self.eng.connect() as con:
+            word_grp = tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 1), con).result
+        self.assertEqual(('g1', 'de'), (word_grp.bkey, word_grp.lang_id.code))
+        self.assertEqual([1, 2, 4], [word.id for word in word_grp.word_li])
+        self.assertEqual(['de', 'en', 'de'], [word.lang_id.code for word in word_grp.word_li])
+        # the entities of a request are hydrated once
+        self.assertIs(word_grp.lang_id, word_grp.word_li[0].lang_id)
+        self.assertIs(word_grp, word_grp.word_li[0].word_grp_id)
+        # word_grp, lang, word and lang of the words not loaded yet
+        self.assertEqual(4, len(self.stmnt_li()))
+        with self.eng.connect() as con:
+            self.assertEqual(4, tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 9), con).retco)
+            self.assertEqual(2, tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 'g2'), con).result.id)
+            # no relation
+            word_grp = tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 3), con).result
+            self.assertEqual(([], None), (word_grp.word_li, word_grp.lang_id))
+
+    def test_load_plan(self):
+        self.assertEqual({'word_li': {}}, {k: v.rel_dct for k, v in LoadPlan.full(ENT_TY_word_grp).rel_dct.items()})
+        self.assertEqual({}, LoadPlan.full(ENT_TY_word_grp, 0).rel_dct)
+        with self.eng.connect() as con:
+            word_grp = tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 1), con, LoadPlan(col_li=['bkey'])).result
+        self.assertEqual((1, 'g1'), (word_grp.id, word_grp.bkey))
+        self.assertFalse(hasattr(word_grp, 'descr'))
+        self.assertFalse(hasattr(word_grp, 'word_li'))
+        self.assertEqual(1, len(self.stmnt_li()))
+        plan = LoadPlan({'word_li': LoadPlan(col_li=['text'])}, ['descr'])
+        with self.eng.connect() as con:
+            word_grp = tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 1), con, plan).result
+        self.assertEqual(['Haus', 'house', 'Maus'], [word.text for word in word_grp.word_li])
+        # the parent column is selected, the columns not in col_li are not
+        self.assertIs(word_grp, word_grp.word_li[0].word_grp_id)
+        self.assertFalse(hasattr(word_grp.word_li[0], 'lang_id'))
+        self.assertEqual(['id', 'word_grp_id', 'text'],
+                         [col.name for col in tg_db.sel_col_li(self.md.tables['word'], LoadPlan(col_li=['text']),
+                                                               'word_grp_id')])
+
+    def test_sel_it_li_dct(self):
+        with self.eng.connect() as con:
+            par_dct = {id_: tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, id_), con, LoadPlan()).result for id_ in [1, 2, 3]}
+            self.sql_li.clear()
+            with mock.patch.object(tg_db, 'IN_CHUNK', 2):
+                it_li_dct = tg_db.sel_it_li_dct(con, ENT_TY_word_grp, par_dct, ENT_TY_word, LoadPlan())
+            # 3 parents in chunks of 2
+            self.assertEqual(2, len(self.stmnt_li('SELECT word.')))
+            self.assertEqual({1: [1, 2, 4], 2: [3], 3: []},
+                             {id_: [word.id for word in word_li] for id_, word_li in it_li_dct.items()})
+            self.assertIs(par_dct[2], it_li_dct[2][0].word_grp_id)
+            self.assertEqual({}, tg_db.sel_it_li_dct(con, ENT_TY_word_grp, {}, ENT_TY_word, LoadPlan()))
+            word_li = tg_db.sel_ent_ty_by_par(par_dct[2], ENT_TY_word, con)
+            self.assertEqual([('Baum', 'de')], [(word.text, word.lang_id.code) for word in word_li])
+
+    def test_ent_cache(self):
+        word_grp = tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 1)).result
+        self.sql_li.clear()
+        word_grp_2 = tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 1)).result
+        self.assertEqual([], self.sql_li)
+        # a copy of its own for each caller
+        self.assertIsNot(word_grp, word_grp_2)
+        word_grp_2.descr = 'changed'
+        self.assertEqual('Group 1', tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 1)).result.descr)
+        self.assertEqual(1, tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 'g1')).result.id)
+
+    def test_ent_dirty_dct(self):
+        word = Ent(ENT_TY_word, id=1, text='Haus', lang_id=Ent(ENT_TY_lang, id=1))
+        # no snapshot, all columns
+        self.assertEqual(dict(ent_ty=ENT_TY_word, text='Haus', lang_id=1), ent_dirty_dct(word))
+        ent_snapshot(word)
+        self.assertEqual({}, ent_dirty_dct(word))
+        word.lang_id = Ent(ENT_TY_lang, id=2)
+        word.text = 'house'
+        self.assertEqual(dict(text='house', lang_id=2), ent_dirty_dct(word))
+
+    def test_upd_ent_ty(self):
+        word_grp = tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 1)).result
+        self.sql_li.clear()
+        # nothing changed, nothing written
+        self.assertIs(word_grp, tg_db.upd_ent_ty(word_grp))
+        self.assertEqual([], self.stmnt_li('UPDATE'))
+        word_grp.descr = 'changed'
+        word_grp.lang_id = word_grp.word_li[1].lang_id
+        self.assertIs(word_grp, tg_db.upd_ent_ty(word_grp))
+        # the changed columns only, the entity is not selected again
+        self.assertEqual([('UPDATE word_grp SET descr=?, lang_id=? WHERE word_grp.id = ?', ('changed', 2, 1))],
+                         self.sql_li)
+        self.assertEqual({}, ent_dirty_dct(word_grp))
+        self.sql_li.clear()
+        self.assertIs(word_grp, tg_db.upd_ent_ty(word_grp))
+        self.assertEqual([], self.sql_li)
+        # the columns of col_li, changed or not
+        tg_db.upd_ent_ty(word_grp, ['bkey'])
+        self.assertEqual([('UPDATE word_grp SET bkey=? WHERE word_grp.id = ?', ('g1', 1))], self.sql_li)
+        # the cached entity is dropped
+        self.assertEqual(('changed', 'en'), (tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 1)).result.descr,
+                                             tg_db.sel_ent_ty(EntId(ENT_TY_word_grp, 1)).result.lang_id.code))
+
+    def test_sel_ent_ty_by_setng(self):
+        word_grp = tg_db.sel_ent_ty_by_setng((10, 1), ELE_TY_word_grp_id).result
+        self.assertEqual(('g1', 'de', [1, 2, 4]),
+                         (word_grp.bkey, word_grp.lang_id.code, [word.id for word in word_grp.word_li]))
+        # setting and entity with one statement
+        self.assertEqual(1, len(self.stmnt_li('SELECT word_grp.')))
+        self.assertIn('JOIN word_grp ON word_grp.id = user_chat_settings.word_grp_id', self.stmnt_li()[0])
+        # empty setting, no settings row
+        self.assertEqual(4, tg_db.sel_ent_ty_by_setng((10, 2), ELE_TY_word_grp_id).retco)
+        self.assertEqual(4, tg_db.sel_ent_ty_by_setng((20, 1), ELE_TY_word_grp_id).retco)
+        with self.eng.connect() as con:
+            self.assertEqual(1, tg_db.sel_ent_ty_by_setng((10, 1), ELE_TY_word_grp_id, con=con,
+                                                          plan=LoadPlan()).result.id)
+
+    def test_sel_ent_ty_by_setng_cache(self):
+        params = settings.setng_scope((10, 1))
+        # the settings row cached
+        self.assertEqual('1', str(settings.read_setting_li(self.eng, self.md, params, [ELE_TY_word_grp_id])[0].val))
+        word_grp = tg_db.sel_ent_ty_by_setng((10, 1), ELE_TY_word_grp_id).result
+        self.sql_li.clear()
+        word_grp_2 = tg_db.sel_ent_ty_by_setng((10, 1), ELE_TY_word_grp_id).result
+        # neither the setting nor the entity read again, a copy returned
+        self.assertEqual([], self.sql_li)
+        self.assertEqual(1, word_grp_2.id)
+        self.assertIsNot(word_grp, word_grp_2)
+        # the setting changed
+        settings.iup_setting_li(self.eng, self.md, params, [(ELE_TY_word_grp_id, 2)])
+        self.assertEqual('g2', tg_db.sel_ent_ty_by_setng((10, 1), ELE_TY_word_grp_id).result.bkey)
+        settings.iup_setting_li(self.eng, self.md, params, [(ELE_TY_word_grp_id, None)])
+        settings.read_setting_li(self.eng, self.md, params, [ELE_TY_word_grp_id])
+        self.sql_li.clear()
+        self.assertEqual(4, tg_db.sel_ent_ty_by_setng((10, 1), ELE_TY_word_grp_id).retco)
+        self.assertEqual([], self.sql_li)
+
+
+
+class MsgRngTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'tg.db')}")
+        with self.eng.begin() as con:
+            for sql in [SQL_CREATE_MSG] + dict(TG_MIGRATION_li)[3]:
+                con.execute(text(sql))
+            for ext_id in range(1, 7):
+                con.execute(text("INSERT INTO tg_message (tg_chat_id, ext_id, tg_user_id, date, text, g3_cmd_explicit) "
+                                 "VALUES (10, :ext_id, 1, '2024-01-05 10:00:00', :text, :is_cmd)"),
+                            ext_id=ext_id, text=f'm{ext_id}', is_cmd=int(ext_id == 3))
+            con.execute(text("INSERT INTO tg_message (tg_chat_id, ext_id, tg_user_id, date, text) "
+                             "VALUES (10, 7, 2, '2024-01-05 10:00:00', 'other user')"))
+        md = MetaData()
+        md.reflect(self.eng)
+        self.sel_count = 0
+        event.listen(self.eng, 'before_cursor_execute', self.on_execute)
+        self.ingest = mock.Mock()
+        for patcher in [mock.patch.object(tg_db, 'Engine_TG', self.eng), mock.patch.object(tg_db, 'MetaData_TG', md),
+                        mock.patch.object(tg_db, 'Ingest_TG', self.ingest),
+                        mock.patch.object(tg_msg_arc, 'arc_db_file',
+                                          lambda key: os.path.join(self.tmp_dir.name, f'tg_msg_{key}.db'))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def on_execute(self, con, cursor, statement, parameters, context, executemany):
+        if 'FROM tg_message' in statement or 'FROM tg_arc.tg_message' in statement:
+            self.sel_count += 1
+
+    def ext_id_li(self, from_msg_id: int, chunk_size: int) -> list[int]:
+        return [msg_rec.ext_id for msg_rec in tg_db.iter_msg_rng_by_chat_user(from_msg_id, 10, 1, chunk_size)]
+
+    def test_chunk(self):
+        # the command and the message of the other user are left out
+        self.assertEqual([1, 2, 4, 5, 6], self.ext_id_li(1, 2))
+        self.assertEqual(3, self.sel_count)
+        self.ingest.flush_if_pending.assert_called_with('tg_message', tg_chat_id=10, tg_user_id=1)
+        # a full last chunk, one more query finds the end
+        self.sel_count = 0
+        self.assertEqual([2, 4, 5, 6], self.ext_id_li(2, 2))
+        self.assertEqual(3, self.sel_count)
+        self.sel_count = 0
+        self.assertEqual([4, 5, 6], self.ext_id_li(4, 500))
+        self.assertEqual(1, self.sel_count)
+        self.assertEqual([], self.ext_id_li(7, 2))
+        msg_dct = tg_db.sel_msg_rng_by_chat_user(6, 10, 1).result[0]
+        self.assertEqual(dict(tg_chat_id=10, ext_id=6, tg_user_id=1, date='2024-01-05 10:00:00', text='m6'), msg_dct)
+
+    def test_archive(self):
+        """The messages archived are merged in, a message upserted again is read from the hot partition"""
+        tg_msg_arc.archive_messages(self.eng, date(2024, 4, 15))
+        with self.eng.begin() as con:
+            con.execute(text("INSERT INTO tg_message (tg_chat_id, ext_id, tg_user_id, date, text) "
+                             "VALUES (10, 2, 1, '2024-01-05 10:00:00', 'again'), "
+                             "(10, 8, 1, '2024-04-10 10:00:00', 'm8')"))
+        self.assertEqual([1, 2, 4, 5, 6, 8], self.ext_id_li(1, 2))
+        self.assertEqual(['again', 'm8'], [msg_rec.text for msg_rec in
+                                           tg_db.iter_msg_rng_by_chat_user(2, 10, 1) if msg_rec.ext_id in (2, 8)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import MetaData, Table, Column, Integer, Text, create_engine, select
+
+from g3b1_data.tg_db_ingest import IngestQueue
+
+
+class IngestQueueTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'ingest.db')}")
+        self.md = MetaData()
+        Table('tg_user', self.md,
+              Column('ext_id', Integer, primary_key=True),
+              Column('username', Text),
+              Column('first_name', Text))
+        Table('tg_message', self.md,
+              Column('tg_chat_id', Integer, primary_key=True),
+              Column('ext_id', Integer, primary_key=True),
+              Column('tg_user_id', Integer),
+              Column('text', Text, nullable=False))
+        self.md.create_all(self.eng)
+        self.written_li: list[tuple[str, list[dict]]] = []
+        self.dropped_li: list[tuple[str, dict]] = []
+        self.queue = IngestQueue(self.eng, self.md, {'tg_user': ['ext_id'], 'tg_message': ['tg_chat_id', 'ext_id']},
+                                 on_written=lambda tbl_name, values_li: self.written_li.append((tbl_name, values_li)),
+                                 on_dropped=lambda tbl_name, values: self.dropped_li.append((tbl_name, values)))
+
+    def tearDown(self) -> None:
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def sel_all(self, tbl_name: str) -> list[tuple]:
+        tbl = self.md.tables[tbl_name]
+        with self.eng.connect() as con:
+            return [tuple(row) for row in con.execute(select(tbl).order_by(*tbl.primary_key.columns))]
+
+    def test_merge(self):
+        self.queue.put('tg_user', dict(ext_id=1, username='a'))
+        self.queue.put('tg_user', dict(ext_id=1, first_name='A'))
+        self.queue.put('tg_user', dict(ext_id=2, username='b'))
+        self.assertEqual(2, self.queue.depth())
+        self.assertEqual(2, self.queue.flush())
+        self.assertEqual([(1, 'a', 'A'), (2, 'b', None)], self.sel_all('tg_user'))
+        self.assertEqual(0, self.queue.depth())
+        self.assertEqual(0, self.queue.flush())
+
+    def test_flush(self):
+        self.queue.put('tg_message', dict(tg_chat_id=10, ext_id=1, tg_user_id=1, text='hi'))
+        self.queue.put('tg_user', dict(ext_id=1, username='a'))
+        # an update without a row is ignored, it never inserts
+        self.queue.put_update('tg_user', dict(ext_id=1, username='b'))
+        self.queue.put_update('tg_user', dict(ext_id=2, username='c'))
+        self.assertEqual(4, self.queue.flush())
+        self.assertEqual([(1, 'b', None)], self.sel_all('tg_user'))
+        self.assertEqual([(10, 1, 1, 'hi')], self.sel_all('tg_message'))
+        self.assertEqual(1, self.queue.stats.flush_count)
+        self.assertEqual(4, self.queue.stats.row_count)
+        self.assertEqual(0, self.queue.stats.err_count)
+        self.assertEqual([('tg_user', [dict(ext_id=1, username='a')]),
+                          ('tg_message', [dict(tg_chat_id=10, ext_id=1, tg_user_id=1, text='hi')])],
+                         self.written_li)
+
+    def test_fallback(self):
+        self.queue.put('tg_message', dict(tg_chat_id=10, ext_id=1, tg_user_id=1, text='hi'))
+        # violates NOT NULL, fails the batch and is dropped by the row by row fallback
+        self.queue.put('tg_message', dict(tg_chat_id=10, ext_id=2, tg_user_id=1, text=None))
+        self.assertEqual(2, self.queue.flush())
+        self.assertEqual([(10, 1, 1, 'hi')], self.sel_all('tg_message'))
+        self.assertEqual(1, self.queue.stats.err_count)
+        self.assertEqual([('tg_message', [dict(tg_chat_id=10, ext_id=1, tg_user_id=1, text='hi')])],
+                         self.written_li)
+        self.assertEqual([('tg_message', dict(tg_chat_id=10, ext_id=2, tg_user_id=1, text=None))], self.dropped_li)
+
+    def test_flush_if_pending(self):
+        self.queue.put('tg_message', dict(tg_chat_id=10, ext_id=1, tg_user_id=1, text='hi'))
+        self.assertEqual(0, self.queue.flush_if_pending('tg_message', tg_chat_id=20))
+        self.assertEqual([], self.sel_all('tg_message'))
+        self.assertEqual(1, self.queue.flush_if_pending('tg_message', tg_chat_id=10, tg_user_id=1))
+        self.assertEqual([(10, 1, 1, 'hi')], self.sel_all('tg_message'))
+
+    def test_stop(self):
+        self.queue.start()
+        self.queue.put('tg_user', dict(ext_id=1, username='a'))
+        self.queue.stop()
+        self.assertFalse(self.queue.is_running())
+        self.assertEqual([(1, 'a', None)], self.sel_all('tg_user'))
+
+
+if __name__ == '__main__':
+    unittest.main()
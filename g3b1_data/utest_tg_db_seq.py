@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import MetaData, create_engine, text
+
+from g3b1_data.tg_db_seq import ExtIdAllocator
+from g3b1_data.tg_db_sqlite import TG_MIGRATION_li
+
+SQL_CREATE_li = [
+    'CREATE TABLE tg_message (tg_chat_id integer, ext_id integer, tg_user_id integer, text text, '
+    'PRIMARY KEY (tg_chat_id, ext_id))',
+    'CREATE TABLE tg_msg_part_chat (part_key text NOT NULL, tg_chat_id integer NOT NULL, '
+    'min_ext_id integer NOT NULL, max_ext_id integer NOT NULL, PRIMARY KEY (tg_chat_id, part_key))'
+]
+
+
+class ExtIdAllocatorTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'seq.db')}")
+        self.exec_sql_li(SQL_CREATE_li + dict(TG_MIGRATION_li)[2] + dict(TG_MIGRATION_li)[8])
+        self.md = MetaData()
+        self.md.reflect(self.eng)
+
+    def tearDown(self) -> None:
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def exec_sql_li(self, sql_li: list[str]):
+        with self.eng.begin() as con:
+            for sql in sql_li:
+                con.execute(text(sql))
+
+    def next_ext_id_of_seq(self, chat_id: int) -> int:
+        with self.eng.connect() as con:
+            return con.execute(text('SELECT next_ext_id FROM tg_msg_chat_seq WHERE tg_chat_id = :chat_id'),
+                               chat_id=chat_id).scalar()
+
+    def test_block(self):
+        alloc = ExtIdAllocator(self.eng, self.md, block_size=4)
+        self.assertEqual([-1, -2, -3], [alloc.next_ext_id(10) for _ in range(3)])
+        # one block reserved, the ids are served from memory
+        self.assertEqual(-5, self.next_ext_id_of_seq(10))
+        # another process reserves the next block
+        alloc_2 = ExtIdAllocator(self.eng, self.md, block_size=4)
+        self.assertEqual(-5, alloc_2.next_ext_id(10))
+        self.assertEqual(-4, alloc.next_ext_id(10))
+        self.assertEqual(-9, alloc.next_ext_id(10))
+        self.assertEqual(-13, self.next_ext_id_of_seq(10))
+        # chats count on their own
+        self.assertEqual(-1, alloc.next_ext_id(20))
+
+    def test_seed(self):
+        self.exec_sql_li(["INSERT INTO tg_message (tg_chat_id, ext_id, tg_user_id, text) VALUES "
+                          "(10, 5, 1, 'a'), (10, -7, 1, 'b'), (10, -20, 2, 'c'), (20, 3, 1, 'd')"])
+        alloc = ExtIdAllocator(self.eng, self.md)
+        # below the messages of all users of the chat
+        self.assertEqual(-21, alloc.next_ext_id(10))
+        self.assertEqual(-22, alloc.next_ext_id(10))
+        self.assertEqual(-1, alloc.next_ext_id(20))
+
+    def test_seed_archive(self):
+        self.exec_sql_li(["INSERT INTO tg_message (tg_chat_id, ext_id, tg_user_id, text) VALUES (10, -3, 1, 'a')",
+                          # the messages archived of the chat have left tg_message
+                          "INSERT INTO tg_msg_part_chat (part_key, tg_chat_id, min_ext_id, max_ext_id) VALUES "
+                          "('2021', 10, -50, 100), ('2022', 20, -80, 100)"])
+        alloc = ExtIdAllocator(self.eng, self.md)
+        self.assertEqual(-51, alloc.next_ext_id(10))
+        self.assertEqual(-1, alloc.next_ext_id(30))
+
+    def test_migrate(self):
+        """The sequences per (chat, user) of migration 2 are merged per chat"""
+        self.exec_sql_li(['DROP TABLE tg_msg_chat_seq'] + dict(TG_MIGRATION_li)[2] + [
+            "INSERT INTO tg_msg_seq (tg_chat_id, tg_user_id, next_ext_id) VALUES (10, 1, -17), (10, 2, -33)",
+            "INSERT INTO tg_message (tg_chat_id, ext_id, tg_user_id, text) VALUES (10, -40, 3, 'a'), (20, 9, 1, 'b')",
+            "INSERT INTO tg_msg_part_chat (part_key, tg_chat_id, min_ext_id, max_ext_id) VALUES "
+            "('2021', 30, 5, 100)"
+        ] + dict(TG_MIGRATION_li)[8])
+        with self.eng.connect() as con:
+            self.assertEqual([(10, -41), (20, -1), (30, -1)],
+                             [tuple(row) for row in con.execute(text(
+                                 'SELECT tg_chat_id, next_ext_id FROM tg_msg_chat_seq ORDER BY tg_chat_id'))])
+            self.assertIsNone(con.execute(text(
+                "SELECT name FROM sqlite_master WHERE name = 'tg_msg_seq'")).scalar())
+
+
+if __name__ == '__main__':
+    unittest.main()
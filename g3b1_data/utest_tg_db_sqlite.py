@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, text
+
+from g3b1_data.migration import migrate
+from g3b1_data.tg_db_sqlite import TG_MIGRATION_li, tg_db_migrate
+
+SQL_CREATE_li = [
+    'CREATE TABLE tg_user (ext_id integer PRIMARY_KEY UNIQUE, first_name text)',
+    'CREATE TABLE tg_chat (ext_id integer PRIMARY_KEY UNIQUE, title text)',
+    'CREATE TABLE tg_message (ext_id integer, tg_user_id integer, tg_chat_id integer, date text, text text, '
+    'g3_cmd_explicit integer DEFAULT 0, bot_module text, menu_id text, UNIQUE (tg_chat_id, ext_id))'
+]
+
+
+class MigrateTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'tg.db')}")
+        with self.eng.begin() as con:
+            for sql in SQL_CREATE_li:
+                con.execute(text(sql))
+
+    def tearDown(self) -> None:
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def idx_name_li(self) -> list[str]:
+        with self.eng.connect() as con:
+            return [row[0] for row in con.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'tg_message' "
+                "AND sql IS NOT NULL ORDER BY name"))]
+
+    def query_plan(self, sql: str, **params) -> str:
+        with self.eng.connect() as con:
+            return ' '.join(row[-1] for row in con.execute(text(f'EXPLAIN QUERY PLAN {sql}'), **params))
+
+    def test_index(self):
+        self.assertEqual(TG_MIGRATION_li[-1][0], tg_db_migrate(self.eng))
+        self.assertEqual(['ix_tg_message_cu_cmd_mod_date', 'ix_tg_message_cu_ext_id', 'ix_tg_message_cu_menu_date'],
+                         self.idx_name_li())
+        # read_latest_message without bot_module
+        self.assertIn('USING INDEX ix_tg_message_cu_cmd_mod_date', self.query_plan(
+            'SELECT * FROM tg_message WHERE tg_chat_id = 1 AND tg_user_id = 2 AND g3_cmd_explicit = 0 '
+            'ORDER BY date DESC LIMIT 1'))
+        self.assertIn('USING INDEX ix_tg_message_cu_ext_id', self.query_plan(
+            'SELECT * FROM tg_message WHERE tg_chat_id = 1 AND tg_user_id = 2 AND g3_cmd_explicit = :is_cmd '
+            'AND ext_id > 5 ORDER BY ext_id LIMIT 500', is_cmd=0))
+        # nothing left to migrate
+        self.assertEqual(TG_MIGRATION_li[-1][0], tg_db_migrate(self.eng))
+
+    def test_drop_redundant(self):
+        """The indexes created by version 1 before they have been found redundant are dropped"""
+        with self.eng.begin() as con:
+            con.execute(text('CREATE INDEX ix_tg_message_cu_cmd_date '
+                             'ON tg_message (tg_chat_id, tg_user_id, g3_cmd_explicit, date)'))
+            con.execute(text('CREATE INDEX ix_tg_message_cu_ext_id_no_cmd '
+                             'ON tg_message (tg_chat_id, tg_user_id, ext_id) WHERE g3_cmd_explicit = 0'))
+        self.assertEqual(8, migrate(self.eng, TG_MIGRATION_li[:8]))
+        self.assertEqual(5, len(self.idx_name_li()))
+        tg_db_migrate(self.eng)
+        self.assertEqual(['ix_tg_message_cu_cmd_mod_date', 'ix_tg_message_cu_ext_id', 'ix_tg_message_cu_menu_date'],
+                         self.idx_name_li())
+
+
+if __name__ == '__main__':
+    unittest.main()
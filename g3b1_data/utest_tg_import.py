@@ -0,0 +1,136 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sqlalchemy import MetaData, create_engine, text
+
+from g3b1_data import tg_import
+from g3b1_data.tg_db_sqlite import TG_MIGRATION_li
+
+SQL_CREATE_li = [
+    'CREATE TABLE tg_chat (ext_id integer PRIMARY KEY, title text, type text)',
+    'CREATE TABLE tg_user (ext_id integer PRIMARY KEY, first_name text, is_bot integer)',
+    'CREATE TABLE tg_message (tg_chat_id integer, ext_id integer, tg_user_id integer, date text, text text, '
+    'g3_cmd_explicit integer DEFAULT 0, g3_file integer DEFAULT 0, PRIMARY KEY (tg_chat_id, ext_id))'
+]
+
+
+def export_dct(msg_count: int) -> dict:
+    msg_li = [dict(id=ext_id, type='message', date='2024-01-01T10:00:00', date_unixtime=str(1704103200 + ext_id),
+                   from_id=f'user{ext_id % 2 + 1}', **{'from': f'u{ext_id % 2 + 1}'},
+                   text=[f'msg {ext_id} ', {'type': 'bold', 'text': '"b]"'}])
+              for ext_id in range(1, msg_count + 1)]
+    msg_li.insert(1, dict(id=100, type='service', action='pin_message'))
+    return dict(name='Group', type='private_supergroup', id=42, messages=msg_li)
+
+
+class IterExportTestCase(unittest.TestCase):
+
+    def test_chunk_boundary(self):
+        """Items spanning several reads, separators and the closing bracket at the end of a read"""
+        dump = json.dumps(export_dct(5), indent=1)
+        for read_size in [1, 3, 7, len(dump)]:
+            with mock.patch.object(tg_import, 'READ_SIZE', read_size):
+                chat_dct, msg_it = tg_import.iter_export(io.StringIO(dump))
+                self.assertEqual(('Group', 42), (chat_dct['name'], chat_dct['id']))
+                self.assertEqual([1, 100, 2, 3, 4, 5], [msg_dct['id'] for msg_dct in msg_it])
+
+    def test_empty(self):
+        chat_dct, msg_it = tg_import.iter_export(io.StringIO('{"name": "x", "id": 1, "messages": [ ]}'))
+        self.assertEqual([], list(msg_it))
+        with self.assertRaises(ValueError):
+            tg_import.iter_export(io.StringIO('{"name": "x"}'))
+
+    def test_ext_id(self):
+        self.assertEqual(-1001, tg_import.chat_ext_id(dict(type='private_supergroup', id=1)))
+        self.assertEqual(-1, tg_import.chat_ext_id(dict(type='private_group', id=1)))
+        self.assertEqual(1, tg_import.chat_ext_id(dict(type='personal_chat', id=1)))
+        self.assertEqual(7, tg_import.from_ext_id('user7'))
+        self.assertEqual(-1007, tg_import.from_ext_id('channel7'))
+        self.assertIsNone(tg_import.from_ext_id(None))
+        self.assertEqual('a "b]"', tg_import.msg_text(['a ', {'type': 'bold', 'text': '"b]"'}]))
+        self.assertIsNone(tg_import.msg_text(''))
+
+
+class ImportTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'tg.db')}")
+        with self.eng.begin() as con:
+            for sql in SQL_CREATE_li + dict(TG_MIGRATION_li)[5]:
+                con.execute(text(sql))
+        self.md = MetaData()
+        self.md.reflect(self.eng)
+        self.file = os.path.join(self.tmp_dir.name, 'result.json')
+        with open(self.file, 'w', encoding='utf-8') as f:
+            json.dump(export_dct(7), f)
+
+    def tearDown(self) -> None:
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def sel_msg_li(self) -> list[tuple]:
+        with self.eng.connect() as con:
+            return [tuple(row) for row in con.execute(text(
+                'SELECT tg_chat_id, ext_id, tg_user_id, text FROM tg_message ORDER BY ext_id'))]
+
+    def sel_imp(self) -> tuple:
+        with self.eng.connect() as con:
+            return tuple(con.execute(text('SELECT msg_count, row_count, done FROM tg_import')).first())
+
+    def test_import(self):
+        with self.eng.begin() as con:
+            # stored by the bot, kept
+            con.execute(text("INSERT INTO tg_message (tg_chat_id, ext_id, tg_user_id, text) "
+                             "VALUES (-10042, 3, 2, 'bot')"))
+        stats = tg_import.import_file(self.eng, self.md, self.file, chunk_size=3)
+        self.assertEqual((7, 0), (stats.msg_count, stats.skip_count))
+        msg_li = self.sel_msg_li()
+        self.assertEqual(list(range(1, 8)), [msg[1] for msg in msg_li])
+        self.assertEqual((-10042, 1, 2, 'msg 1 "b]"'), msg_li[0])
+        self.assertEqual('bot', msg_li[2][3])
+        with self.eng.connect() as con:
+            self.assertEqual([(-10042, 'Group', 'supergroup')],
+                             [tuple(row) for row in con.execute(text('SELECT ext_id, title, type FROM tg_chat'))])
+            self.assertEqual([1, 2], [row[0] for row in con.execute(text('SELECT ext_id FROM tg_user ORDER BY 1'))])
+            self.assertEqual('2024-01-01 10:00:01', con.execute(text(
+                'SELECT date FROM tg_message WHERE ext_id = 1')).scalar())
+        # the service message counts, chat and users are inserted once
+        self.assertEqual((8, 9, 1), self.sel_imp())
+        # done
+        self.assertEqual(0, tg_import.import_file(self.eng, self.md, self.file).msg_count)
+
+    def test_resume(self):
+        insert_chunk = tg_import._insert_chunk
+        call_li = []
+
+        def insert_chunk_fail(*args):
+            call_li.append(args)
+            if len(call_li) == 2:
+                raise RuntimeError('interrupted')
+            return insert_chunk(*args)
+
+        with mock.patch.object(tg_import, '_insert_chunk', insert_chunk_fail):
+            with self.assertRaises(RuntimeError):
+                tg_import.import_file(self.eng, self.md, self.file, chunk_size=3)
+        # the first chunk is committed: messages 1, 100, 2, 3
+        self.assertEqual([1, 2, 3], [msg[1] for msg in self.sel_msg_li()])
+        self.assertEqual(4, self.sel_imp()[0])
+        stats = tg_import.import_file(self.eng, self.md, self.file, chunk_size=3)
+        self.assertEqual((4, 4), (stats.msg_count, stats.skip_count))
+        self.assertEqual(list(range(1, 8)), [msg[1] for msg in self.sel_msg_li()])
+        self.assertEqual((8, 1), self.sel_imp()[0::2])
+        # another export of the file is imported again
+        with open(self.file, 'w', encoding='utf-8') as f:
+            json.dump(export_dct(8), f, indent=1)
+        stats = tg_import.import_file(self.eng, self.md, self.file)
+        # message 8 is the only row new
+        self.assertEqual((8, 0, 1), (stats.msg_count, stats.skip_count, stats.row_count))
+
+
+if __name__ == '__main__':
+    unittest.main()
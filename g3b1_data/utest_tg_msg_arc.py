@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+from datetime import date
+from typing import NamedTuple
+from unittest import mock
+
+from sqlalchemy import MetaData, create_engine, text, select
+
+from g3b1_data import tg_msg_arc
+from g3b1_data.tg_db_sqlite import TG_MIGRATION_li
+
+SQL_CREATE_MSG = 'CREATE TABLE tg_message (tg_chat_id integer, ext_id integer, tg_user_id integer, date text, ' \
+                 'text text, g3_cmd_explicit integer DEFAULT 0, PRIMARY KEY (tg_chat_id, ext_id))'
+
+
+class Rec(NamedTuple):
+    ext_id: int
+    src: str
+
+
+class ArchiveTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'tg.db')}")
+        with self.eng.begin() as con:
+            for sql in [SQL_CREATE_MSG] + dict(TG_MIGRATION_li)[3]:
+                con.execute(text(sql))
+        self.md = MetaData()
+        self.md.reflect(self.eng)
+        # the files of the partitions in the temp dir
+        patcher = mock.patch.object(tg_msg_arc, 'arc_db_file',
+                                    lambda key: os.path.join(self.tmp_dir.name, f'tg_msg_{key}.db'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self) -> None:
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def ins_msg(self, *row_li: tuple):
+        with self.eng.begin() as con:
+            for row in row_li:
+                con.execute(text('INSERT OR REPLACE INTO tg_message (tg_chat_id, ext_id, tg_user_id, date, text) '
+                                 'VALUES (:chat_id, :ext_id, 1, :date, :text)'),
+                            chat_id=row[0], ext_id=row[1], date=row[2], text=row[3])
+
+    def sel_ext_id_li(self, db_file: str = None) -> list[int]:
+        tbl = self.md.tables['tg_message']
+        if db_file:
+            tbl = tg_msg_arc.arc_tbl(tbl)
+        with self.eng.connect() as con, tg_msg_arc.attached(con, db_file):
+            return [row[0] for row in con.execute(select(tbl.c.ext_id).order_by(tbl.c.ext_id))]
+
+    def test_part_key(self):
+        self.assertEqual('202404', tg_msg_arc.part_key(2024, 4))
+        self.assertEqual('202404', tg_msg_arc.part_key(2024, 6, 3))
+        self.assertEqual(('2024-12-01', '2025-01-01'), tg_msg_arc.part_date_rng('202412'))
+        self.assertEqual('2024-03-01', tg_msg_arc.hot_date_from(date(2024, 4, 15)))
+
+    def test_archive(self):
+        self.ins_msg((10, 1, '2024-01-05 10:00:00', 'a'), (10, 2, '2024-02-10 10:00:00', 'b'),
+                     (20, 7, '2024-02-11 10:00:00', 'c'), (10, 3, '2024-04-02 10:00:00', 'd'))
+        stats_li = tg_msg_arc.archive_messages(self.eng, date(2024, 4, 15), batch_size=1)
+        self.assertEqual([('202401', 1), ('202402', 2)], [(stats.part_key, stats.row_count) for stats in stats_li])
+        self.assertEqual(2, stats_li[1].batch_count)
+        # the hot partition keeps March and April
+        self.assertEqual([3], self.sel_ext_id_li())
+        self.assertEqual([1], self.sel_ext_id_li(tg_msg_arc.arc_db_file('202401')))
+        self.assertEqual([2, 7], self.sel_ext_id_li(tg_msg_arc.arc_db_file('202402')))
+        with self.eng.connect() as con:
+            self.assertEqual(['202401', '202402'], [part.part_key for part in tg_msg_arc.part_li(con, 10)])
+            self.assertEqual(['202402'], [part.part_key for part in tg_msg_arc.part_li(con, 10, ext_id_from=2)])
+            self.assertEqual(['202401'], [part.part_key for part in tg_msg_arc.part_li(con, 10, ext_id=1)])
+            self.assertEqual([], tg_msg_arc.part_li(con, 10, ext_id_from=3))
+            self.assertEqual([2, 1], [row[0] for row in con.execute(
+                text('SELECT row_count FROM tg_msg_part ORDER BY part_key DESC'))])
+        # nothing left to move
+        self.assertEqual([], tg_msg_arc.archive_messages(self.eng, date(2024, 4, 15)))
+
+    def test_rerun(self):
+        """A message upserted again after archiving is moved again, the archived copy is replaced"""
+        self.ins_msg((10, 1, '2024-01-05 10:00:00', 'a'))
+        tg_msg_arc.archive_messages(self.eng, date(2024, 4, 15))
+        self.ins_msg((10, 1, '2024-01-05 10:00:00', 'b'))
+        tg_msg_arc.archive_messages(self.eng, date(2024, 4, 15))
+        self.assertEqual([], self.sel_ext_id_li())
+        tbl = tg_msg_arc.arc_tbl(self.md.tables['tg_message'])
+        with self.eng.connect() as con, tg_msg_arc.attached(con, tg_msg_arc.arc_db_file('202401')):
+            self.assertEqual([(1, 'b')], [tuple(row) for row in con.execute(select(tbl.c.ext_id, tbl.c.text))])
+
+    def test_attached(self):
+        self.ins_msg((10, 1, '2024-01-05 10:00:00', 'a'))
+        tg_msg_arc.archive_messages(self.eng, date(2024, 4, 15))
+        with self.eng.connect() as con:
+            with tg_msg_arc.attached(con, tg_msg_arc.arc_db_file('202401')):
+                self.assertIn(tg_msg_arc.ARC_SCHEMA, [row[1] for row in con.execute(text('PRAGMA database_list'))])
+            self.assertNotIn(tg_msg_arc.ARC_SCHEMA, [row[1] for row in con.execute(text('PRAGMA database_list'))])
+            # nothing to attach
+            with tg_msg_arc.attached(con) as con_:
+                self.assertIs(con, con_)
+
+    def test_merge(self):
+        hot_li = [Rec(1, 'hot'), Rec(5, 'hot')]
+        arc_li = [Rec(1, 'arc'), Rec(2, 'arc'), Rec(6, 'arc')]
+        self.assertEqual([Rec(1, 'hot'), Rec(2, 'arc'), Rec(5, 'hot'), Rec(6, 'arc')],
+                         list(tg_msg_arc.merge_by_ext_id([iter(hot_li), iter(arc_li)])))
+        self.assertEqual(hot_li, list(tg_msg_arc.merge_by_ext_id([iter(hot_li)])))
+        self.assertEqual([], list(tg_msg_arc.merge_by_ext_id([iter([]), iter([])])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, text
+
+from g3b1_data import tg_msg_fts
+from g3b1_data.tg_db_sqlite import TG_MIGRATION_li
+
+SQL_CREATE_MSG = 'CREATE TABLE tg_message (tg_chat_id integer, ext_id integer, tg_user_id integer, date text, ' \
+                 'text text, PRIMARY KEY (tg_chat_id, ext_id))'
+
+
+class FtsTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'tg.db')}")
+        self.exec_sql_li([SQL_CREATE_MSG])
+
+    def tearDown(self) -> None:
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def exec_sql_li(self, sql_li: list[str]):
+        with self.eng.begin() as con:
+            for sql in sql_li:
+                con.execute(text(sql))
+
+    def ins_msg(self, *row_li: tuple):
+        with self.eng.begin() as con:
+            for row in row_li:
+                con.execute(text('INSERT INTO tg_message (tg_chat_id, ext_id, tg_user_id, date, text) '
+                                 'VALUES (:chat_id, :ext_id, :user_id, \'2024-01-01 10:00:00\', :text)'),
+                            chat_id=row[0], ext_id=row[1], user_id=row[2], text=row[3])
+
+    def search(self, query: str, **kwargs) -> list[int]:
+        with self.eng.connect() as con:
+            return [row['ext_id'] for row in tg_msg_fts.search(con, tg_msg_fts.fts_query(query), **kwargs)]
+
+    def test_fts_query(self):
+        self.assertEqual('"hello" "world"', tg_msg_fts.fts_query('hello  world'))
+        self.assertEqual('"hel"* "say""x"""', tg_msg_fts.fts_query('hel* say"x"'))
+        # nothing to search
+        self.assertEqual('', tg_msg_fts.fts_query(''))
+        self.assertEqual('', tg_msg_fts.fts_query(' * ** '))
+
+    def test_triggers(self):
+        self.exec_sql_li(dict(TG_MIGRATION_li)[4])
+        self.ins_msg((10, 1, 1, 'Hello world'), (10, 2, 2, 'hello café'), (20, 1, 1, 'other hello'))
+        self.assertEqual(3, len(self.search('hello')))
+        self.assertEqual([2], self.search('cafe'))
+        self.assertEqual([1], self.search('hello', chat_id=10, user_id=1))
+        self.assertEqual([], self.search('wor* cafe'))
+        self.assertEqual([2], self.search('hel* café', user_id=2))
+        self.exec_sql_li(["UPDATE tg_message SET text = 'goodbye' WHERE tg_chat_id = 10 AND ext_id = 1",
+                          'DELETE FROM tg_message WHERE tg_chat_id = 20'])
+        self.assertEqual([2], self.search('hello'))
+        self.assertEqual([1], self.search('goodbye'))
+
+    def test_backfill(self):
+        self.ins_msg(*[(10, ext_id, 1, f'word{ext_id} old') for ext_id in range(1, 6)])
+        self.exec_sql_li(dict(TG_MIGRATION_li)[4])
+        with self.eng.connect() as con:
+            self.assertEqual(tg_msg_fts.FtsState(0, 5), tg_msg_fts.fts_state(con))
+        # the rows before the index: the triggers leave them to the backfill
+        self.ins_msg((10, 6, 1, 'new'))
+        self.exec_sql_li(["UPDATE tg_message SET text = 'word1 changed' WHERE ext_id = 1",
+                          'DELETE FROM tg_message WHERE ext_id = 2'])
+        self.assertEqual([], self.search('old'))
+        self.assertEqual([6], self.search('new'))
+        # the batches end on hwm_rowid, the deleted rowid counts
+        self.assertEqual(5, tg_msg_fts.fts_backfill(self.eng, batch_size=2, pause_s=0))
+        self.assertEqual([3, 4, 5], sorted(self.search('old')))
+        self.assertEqual([1], self.search('changed'))
+        self.assertEqual([], self.search('word2'))
+        with self.eng.connect() as con:
+            self.assertTrue(tg_msg_fts.fts_state(con).is_complete())
+        # complete, nothing to do
+        self.assertEqual(0, tg_msg_fts.fts_backfill(self.eng, pause_s=0))
+        # the backfilled rows are maintained by the triggers
+        self.exec_sql_li(['DELETE FROM tg_message WHERE ext_id = 3'])
+        self.assertEqual([4, 5], sorted(self.search('old')))
+        # the index matches the content table, raises otherwise
+        self.exec_sql_li(["INSERT INTO tg_message_fts (tg_message_fts, rank) VALUES ('integrity-check', 1)"])
+
+    def test_snippet_html(self):
+        self.ins_msg((10, 1, 1, 'a <b> c'))
+        self.exec_sql_li(dict(TG_MIGRATION_li)[4])
+        tg_msg_fts.fts_backfill(self.eng, pause_s=0)
+        with self.eng.connect() as con:
+            row = tg_msg_fts.search(con, tg_msg_fts.fts_query('c'))[0]
+        self.assertEqual('a &lt;b&gt; <b>c</b>', tg_msg_fts.snippet_html(row['snippet']))
+        self.assertEqual('', tg_msg_fts.snippet_html(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
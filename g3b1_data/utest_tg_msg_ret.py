@@ -0,0 +1,122 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine, text
+
+from g3b1_data import tg_msg_ret
+from g3b1_data.tg_db_sqlite import TG_MIGRATION_li
+from g3b1_data.tg_msg_ret import RetentionPolicy
+
+SQL_CREATE_MSG = 'CREATE TABLE tg_message (tg_chat_id integer, ext_id integer, tg_user_id integer, date text, ' \
+                 'text text, bot_module text, g3_cmd_explicit integer DEFAULT 0, PRIMARY KEY (tg_chat_id, ext_id))'
+
+NOW = datetime(2024, 4, 15, tzinfo=timezone.utc)
+
+
+class PurgeTestCase(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.eng = create_engine(f"sqlite:///{os.path.join(self.tmp_dir.name, 'tg.db')}")
+        with self.eng.begin() as con:
+            for sql in [SQL_CREATE_MSG] + dict(TG_MIGRATION_li)[6]:
+                con.execute(text(sql))
+
+    def tearDown(self) -> None:
+        self.eng.dispose()
+        self.tmp_dir.cleanup()
+
+    def ins_msg(self, chat_id: int, ext_id: int, day: str, bot_module: str = None, is_cmd=False, txt='x'):
+        with self.eng.begin() as con:
+            con.execute(text('INSERT INTO tg_message (tg_chat_id, ext_id, tg_user_id, date, text, bot_module, '
+                             'g3_cmd_explicit) VALUES (:chat_id, :ext_id, 1, :date, :text, :bot_module, :is_cmd)'),
+                        chat_id=chat_id, ext_id=ext_id, date=f'2024-{day} 10:00:00', text=txt, bot_module=bot_module,
+                        is_cmd=int(is_cmd))
+
+    def sel_ext_id_li(self, chat_id: int) -> list[int]:
+        with self.eng.connect() as con:
+            return [row[0] for row in con.execute(
+                text('SELECT ext_id FROM tg_message WHERE tg_chat_id = :chat_id ORDER BY ext_id'), chat_id=chat_id)]
+
+    def purge(self, batch_size: int = tg_msg_ret.RET_BATCH_SIZE) -> tg_msg_ret.PurgeStats:
+        return tg_msg_ret.purge_messages(self.eng, NOW, batch_size, pause_s=0)
+
+    def test_no_policy(self):
+        self.ins_msg(10, 1, '01-01')
+        self.assertEqual(0, self.purge().row_count())
+        self.assertEqual([1], self.sel_ext_id_li(10))
+
+    def test_max_age(self):
+        for ext_id in range(1, 6):
+            self.ins_msg(10, ext_id, '01-01')
+        self.ins_msg(10, 6, '01-01', is_cmd=True)
+        self.ins_msg(10, 7, '04-10')
+        tg_msg_ret.set_policy(self.eng, RetentionPolicy(max_age_days=30))
+        stats = self.purge(batch_size=2)
+        self.assertEqual(5, stats.age_row_count)
+        self.assertEqual(3, stats.batch_count)
+        self.assertEqual(1, stats.chat_count)
+        # the command and the recent message are kept
+        self.assertEqual([6, 7], self.sel_ext_id_li(10))
+        tg_msg_ret.set_policy(self.eng, RetentionPolicy(max_age_days=30, keep_cmd=False))
+        self.assertEqual(1, self.purge().age_row_count)
+        self.assertEqual([7], self.sel_ext_id_li(10))
+
+    def test_max_rows(self):
+        for ext_id, day in enumerate(['01-05', '01-01', '02-01', '03-01'], 1):
+            self.ins_msg(10, ext_id, day)
+            self.ins_msg(20, ext_id, day)
+        tg_msg_ret.set_policy(self.eng, RetentionPolicy(tg_chat_id=10, max_rows=2))
+        stats = self.purge(batch_size=1)
+        self.assertEqual(2, stats.max_row_count)
+        self.assertEqual(2, stats.batch_count)
+        # the oldest by date are deleted, chat 20 has no policy
+        self.assertEqual([3, 4], self.sel_ext_id_li(10))
+        self.assertEqual([1, 2, 3, 4], self.sel_ext_id_li(20))
+        self.assertEqual(0, self.purge().row_count())
+
+    def test_bot_module(self):
+        self.ins_msg(10, 1, '01-01', 'trans')
+        self.ins_msg(10, 2, '01-01', 'money')
+        self.ins_msg(10, 3, '01-01')
+        self.ins_msg(20, 1, '01-01', 'trans')
+        self.ins_msg(20, 2, '01-01', 'money')
+        tg_msg_ret.set_policy(self.eng, RetentionPolicy('trans', max_age_days=30))
+        # chat 10: the messages of the other modules
+        tg_msg_ret.set_policy(self.eng, RetentionPolicy('', 10, max_age_days=30))
+        self.purge()
+        self.assertEqual([], self.sel_ext_id_li(10))
+        self.assertEqual([2], self.sel_ext_id_li(20))
+
+    def test_chat_policy_dct(self):
+        pol_trans = RetentionPolicy('trans', max_age_days=1)
+        pol_trans_10 = RetentionPolicy('trans', 10, max_age_days=2)
+        pol_all = RetentionPolicy(max_rows=5)
+        pol_10 = RetentionPolicy('', 10, max_rows=3)
+        pol_li = [pol_trans, pol_trans_10, pol_all]
+        self.assertEqual(({'trans': pol_trans_10}, pol_all), tg_msg_ret.chat_policy_dct(pol_li, 10))
+        self.assertEqual(({'trans': pol_trans}, pol_all), tg_msg_ret.chat_policy_dct(pol_li, 20))
+        # the policy of the chat takes precedence over the policies of any chat
+        self.assertEqual(({'trans': pol_trans_10}, pol_10), tg_msg_ret.chat_policy_dct(pol_li + [pol_10], 10))
+        self.assertEqual(({}, None), tg_msg_ret.chat_policy_dct([], 10))
+
+    def test_incremental_vacuum(self):
+        with self.eng.connect() as con:
+            # auto_vacuum NONE: nothing to do
+            self.assertEqual(0, tg_msg_ret.incremental_vacuum(con, pause_s=0))
+        tg_msg_ret.enable_incremental_vacuum(self.eng)
+        for ext_id in range(1, 51):
+            self.ins_msg(10, ext_id, '01-01', txt='x' * 4000)
+        tg_msg_ret.set_policy(self.eng, RetentionPolicy(max_age_days=30))
+        stats = self.purge(batch_size=20)
+        self.assertEqual(50, stats.age_row_count)
+        self.assertGreater(stats.page_count, 40)
+        with self.eng.connect() as con:
+            self.assertEqual(tg_msg_ret.AUTO_VACUUM_INCREMENTAL, con.execute(text('PRAGMA auto_vacuum')).scalar())
+            self.assertEqual(0, con.execute(text('PRAGMA freelist_count')).scalar())
+
+
+if __name__ == '__main__':
+    unittest.main()
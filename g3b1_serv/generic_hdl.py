@@ -139,6 +139,16 @@ def tg_handler():
                 # noinspection PyArgumentList
                 sel_ent_ty = getattr(modu_db, 'sel_ent_ty', tg_db.sel_ent_ty)
                 for g3_arg in ent_ty_arg_li:
+                    if g3_arg.ent_ty.sel_ent_ty:
+                        s_sel_ent_ty = getattr(modu_db, g3_arg.ent_ty.sel_ent_ty)
+                    else:
+                        s_sel_ent_ty = sel_ent_ty
+                    if g3_arg.f_current and s_sel_ent_ty is tg_db.sel_ent_ty:
+                        # setting and entity with one SELECT
+                        ent_r = tg_db.sel_ent_ty_by_setng((G3Ctx.chat_id(), G3Ctx.for_user_id()), g3_arg.ele_ty,
+                                                          g3_arg.ent_ty).result
+                        kwargs.update({g3_arg.arg: ent_r})
+                        continue
                     if g3_arg.f_current:
                         ent_r_id = settings.ent_by_setng((G3Ctx.chat_id(), G3Ctx.for_user_id()), g3_arg.ele_ty,
                                                          ent_ty=g3_arg.ent_ty).result
@@ -149,10 +159,6 @@ def tg_handler():
                     else:
                         ent_r_id = 0
                     if isinstance(ent_r_id, int) and ent_r_id:
-                        if g3_arg.ent_ty.sel_ent_ty:
-                            s_sel_ent_ty = getattr(modu_db, g3_arg.ent_ty.sel_ent_ty)
-                        else:
-                            s_sel_ent_ty = sel_ent_ty
                         ent_r = s_sel_ent_ty(EntId(g3_arg.ent_ty, ent_r_id)).result
                         kwargs.update({g3_arg.arg: ent_r})
                     else:
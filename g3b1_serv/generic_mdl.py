@@ -112,10 +112,19 @@ def get_ent_ty_li(g3_m_str_inp: [str, list[str]]) -> list[EntTy]:
     return ent_ty_li
 
 
+@cache
+def ent_ty_dct_by_tbl_name(g3_m_str_tup: tuple[str, ...]) -> dict[str, EntTy]:
+    ent_ty_li = get_ent_ty_li(list(g3_m_str_tup))
+    # the first entity type of a table wins, as in the list
+    return {ent.tbl_name: ent for ent in reversed(ent_ty_li)}
+
+
 def ent_ty_by_tbl_name(tbl_name: str, g3_m_str) -> "EntTy":
-    for ent in get_ent_ty_li(g3_m_str):
-        if ent.tbl_name == tbl_name:
-            return ent
+    if isinstance(g3_m_str, str):
+        if g3_m_str == 'generic':
+            return
+        g3_m_str = [g3_m_str]
+    return ent_ty_dct_by_tbl_name(tuple(g3_m_str)).get(tbl_name)
 
 
 def ent_ty_by_id(ent_id: str, g3_m_str) -> "EntTy":
@@ -1,7 +1,7 @@
-import codecs
 import importlib
 import json
 import logging
+import re
 import traceback
 from pydoc import html
 from typing import Callable
@@ -13,8 +13,11 @@ from telegram.ext import CallbackContext, Updater, CommandHandler, MessageHandle
 
 from constants import env_g3b1_dir
 from g3b1_cfg.tg_cfg import G3Ctx, init_g3_m, del_g3_m_by_file, init_g3_m_for_scripts, del_g3_m_of_scripts
-from g3b1_cfg.tg_cfg import sel_g3_m
-from g3b1_data import settings
+from g3b1_cfg.tg_cfg import sel_g3_m, eng_cfg, watch_cfg
+from g3b1_data import settings, tg_db, tg_msg_fts, db_registry, aio, change_log, maint
+from g3b1_data.cache import upsert_cache, ent_cache, last_msg_cache, setng_cache
+from g3b1_data.db_metrics import pool_stats_str
+from g3b1_data.db_profile import log_pragma_report
 from g3b1_data.entities import EntTy
 from g3b1_data.model import G3Command, G3Module
 from g3b1_data.tg_db_sqlite import tg_db_create_tables
@@ -24,6 +27,7 @@ from g3b1_log.log import cfg_logger
 from g3b1_serv import utilities, generic_hdl
 from g3b1_serv.generic_hdl import init_g3_ctx
 from g3b1_ui.model import TgUIC
+from generic_mdl import get_ele_ty_li
 from subscribe.data import db
 from subscribe.serv import services as sub_services
 
@@ -108,6 +112,24 @@ def bot(g3_m_str: str, cmd_prefix: str, uname: str) -> None:
     TgUIC.uic.send('Please choose:', reply_markup=reply_markup)
 
 
+def search(upd: Update, ctx: CallbackContext) -> None:
+    """Full-text search in the messages of the chat: /search [p{page}] words
+    Every word must match, a trailing * matches words with the prefix."""
+    init_g3_ctx(upd, ctx)
+    arg_li = list(ctx.args) if ctx.args else []
+    page = 1
+    if arg_li and re.fullmatch(r'p\d+', arg_li[0]):
+        page = max(int(arg_li.pop(0)[1:]), 1)
+    g3r = tg_db.search_message(' '.join(arg_li), chat_id=G3Ctx.chat_id(),
+                               offset=(page - 1) * tg_db.SEARCH_LIMIT)
+    if g3r.retco != 0:
+        TgUIC.uic.no_data()
+        return
+    line_li = [f'<i>{str(row["date"])[:16]}</i> #{row["ext_id"]}: {tg_msg_fts.snippet_html(row["snippet"])}'
+               for row in g3r.result]
+    TgUIC.uic.send('\n'.join(line_li))
+
+
 def query_answer(upd: Update, ctx: CallbackContext) -> None:
     """Parses the CallbackQuery and updates the message text."""
     init_g3_ctx(upd, ctx)
@@ -154,10 +176,20 @@ def start_bot(file: str,
     """Run the bot."""
     G3Ctx.eng = eng
     G3Ctx.md = md
+    db_registry.register(eng, md)
+    db_registry.register(db.eng_SUB, db.md_SUB)
+    log_pragma_report(db_registry.eng_li() + [eng_cfg])
     del_g3_m_by_file(file)
     bot_li: dict[str, dict] = db.bot_all()
     g3_m: G3Module = init_g3_m(file)
     cmd_dct: dict = g3_m.cmd_dct
+    settings.create_setng_ref_idx(eng, md, get_ele_ty_li(g3_m.name) or [])
+    # the caches follow the writes of the other bots
+    tg_db.watch_tg()
+    tg_db.watch_module(eng, g3_m.name)
+    if db.eng_SUB is not eng:
+        tg_db.watch_module(db.eng_SUB, 'subscribe')
+    watch_cfg()
 
     bot_dict: dict = bot_li[g3_m.name]
     bot_token = bot_dict['token']
@@ -186,6 +218,7 @@ def start_bot(file: str,
     dispatcher.add_handler(MessageHandler(
         (Filters.photo | Filters.video) & ~Filters.command, hdl_for_message))
     dispatcher.add_handler(CommandHandler('start', hdl_for_start))
+    dispatcher.add_handler(CommandHandler('search', search))
     command: G3Command
     for key, command in cmd_dct.items():
         logger.debug(f'Add handler for: {command.name} and {command.long_name}')
@@ -200,6 +233,10 @@ def start_bot(file: str,
     dispatcher.add_error_handler(error_handler)
 
     # Start the Bot
+    tg_db.Ingest_TG.start()
+    change_log.start()
+    # retention and archiving, see tg_db
+    maint.start()
     logger.debug("Start polling:")
     updater.start_polling()
 
@@ -210,24 +247,39 @@ def start_bot(file: str,
     inp = ''
     while inp != 'q':
         inp = input()
-        if inp == 'imp_c_hi':
+        if inp == 'ingest':
+            print(tg_db.Ingest_TG.stats_str())
+        elif inp == 'fts_backfill':
+            print(f'{tg_db.fts_backfill()} rowid indexed')
+        elif inp == 'arc_msg':
+            for arc_stats in tg_db.archive_messages():
+                print(arc_stats)
+        elif inp == 'purge_msg':
+            print(tg_db.purge_messages())
+        elif inp == 'vacuum_inc':
+            tg_db.enable_incremental_vacuum()
+        elif inp == 'cache':
+            print(upsert_cache.stats_str())
+            print(ent_cache.stats_str())
+            print(f'Last message cache {last_msg_cache.stats_str()}')
+            print(setng_cache.stats_str())
+            print(change_log.stats_str())
+        elif inp == 'pool':
+            print(pool_stats_str())
+        elif inp == 'imp_c_hi':
             fl = rf'{env_g3b1_dir}\files\tg.json'
             try:
-                with codecs.open(fl, encoding='utf-8') as file:
-                    file_content = file.read()
-                c_hi_d: dict = json.loads(file_content)
-                msg_d_li: list[dict[str, str]] = c_hi_d['messages']
-                txt_li: list[str] = [msg['text'] for msg in msg_d_li]
-                txt_set: set[str] = set()
-                for txt in txt_li:
-                    txt_set.add(str(txt))
-                for txt in txt_set:
-                    print(txt)
-                pass
+                print(tg_db.import_chat_history(fl))
             except Exception as e:
                 logger.exception(e)
                 continue
 
+    updater.stop()
+    # before the ingest queue, the calls still running may queue rows
+    aio.shutdown()
+    maint.stop()
+    change_log.stop()
+    tg_db.Ingest_TG.stop()
     exit()
 
 
@@ -0,0 +1,129 @@
+"""Throughput of the aio facade of g3b1_data.aio with many concurrent asyncio handlers.
+
+On a new DB file of MSG_COUNT messages, each handler reads the latest message of its chat and user and writes
+a message every WRITE_EVERY handlers, as a command handler does:
+  sync: the handlers call the data layer on the event loop, each call blocks all handlers
+  aio/N: the handlers await the calls on the executor of the DB with N workers
+max lag is the longest time the event loop has not been able to run a 1 ms timer.
+
+python -m g3b1_test.bench_aio [handler count]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from sqlalchemy import MetaData, desc, select
+from sqlalchemy.engine import Engine
+
+from g3b1_data import aio, db_registry
+from g3b1_data.aio import AioFacade
+from g3b1_data.tg_db_ingest import upsert_many
+
+HANDLER_COUNT = 2000
+HANDLER_COUNT_li = [1, 10, 100]
+WORKER_COUNT_li = [1, 2, 4]
+MSG_COUNT = 50000
+CHAT_COUNT = 200
+WRITE_EVERY = 10
+
+SQL_CREATE_li = [
+    'CREATE TABLE tg_message (ext_id integer, tg_chat_id integer, tg_user_id integer, date text, text text, '
+    'g3_cmd_explicit integer DEFAULT 0, UNIQUE (tg_chat_id, ext_id))',
+    'CREATE INDEX ix_tg_message_cu_cmd_date ON tg_message (tg_chat_id, tg_user_id, g3_cmd_explicit, date)'
+]
+
+eng: Engine = None
+md: MetaData = None
+
+
+def msg_values(i: int) -> dict:
+    chat_id = i % CHAT_COUNT
+    return dict(ext_id=i, tg_chat_id=chat_id, tg_user_id=chat_id, date=f'2021-08-01 10:{i % 60:02d}:{i % 59:02d}',
+                text=f'message {i} ' * 8)
+
+
+def create_db(db_file: str):
+    global eng, md
+    eng = db_registry.create_eng(db_file)
+    with eng.begin() as con:
+        for sql in SQL_CREATE_li:
+            con.execute(sql)
+    md = MetaData()
+    md.reflect(bind=eng)
+    with eng.begin() as con:
+        upsert_many(con, md.tables['tg_message'], [msg_values(i) for i in range(MSG_COUNT)], ['tg_chat_id', 'ext_id'])
+
+
+def read_latest_message(chat_id: int, user_id: int) -> int:
+    cols = md.tables['tg_message'].columns
+    with eng.connect() as con:
+        return con.execute(select(cols.ext_id).where(cols.tg_chat_id == chat_id, cols.tg_user_id == user_id,
+                                                     cols.g3_cmd_explicit == 0).
+                           order_by(desc(cols.date)).limit(1)).scalar()
+
+
+def ins_message(i: int):
+    with eng.begin() as con:
+        upsert_many(con, md.tables['tg_message'], [msg_values(i)], ['tg_chat_id', 'ext_id'])
+
+
+# the facade of this module, as tg_db.aio
+bench_aio = AioFacade(sys.modules[__name__], lambda arg_dct: eng)
+
+
+async def handle(i: int, f_aio: bool):
+    chat_id = i % CHAT_COUNT
+    if f_aio:
+        await bench_aio.read_latest_message(chat_id, chat_id)
+        if i % WRITE_EVERY == 0:
+            await bench_aio.ins_message(MSG_COUNT + i)
+    else:
+        read_latest_message(chat_id, chat_id)
+        if i % WRITE_EVERY == 0:
+            ins_message(MSG_COUNT + i)
+
+
+async def bench(handler_count: int, concurrency: int, f_aio: bool) -> tuple[float, float]:
+    """Returns handlers/s and the max lag of the event loop in ms"""
+    lag_li: list[float] = []
+    f_done = asyncio.Event()
+
+    async def tick():
+        while not f_done.is_set():
+            tick_start = perf_counter()
+            await asyncio.sleep(0.001)
+            lag_li.append((perf_counter() - tick_start) * 1000 - 1)
+
+    async def handle_all(first: int):
+        for i in range(first, handler_count, concurrency):
+            await handle(i, f_aio)
+
+    ticker = asyncio.create_task(tick())
+    start = perf_counter()
+    await asyncio.gather(*[handle_all(first) for first in range(concurrency)])
+    handler_per_s = handler_count / (perf_counter() - start)
+    f_done.set()
+    await ticker
+    return handler_per_s, max(lag_li, default=0.0)
+
+
+def main():
+    handler_count = int(sys.argv[1]) if len(sys.argv) > 1 else HANDLER_COUNT
+    print(f'{"mode":8} {"concurrent":>10} {"handler/s":>10} {"max lag ms":>11}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        create_db(os.path.join(tmp_dir, 'bench_aio.db'))
+        for concurrency in HANDLER_COUNT_li:
+            handler_per_s, max_lag_ms = asyncio.run(bench(handler_count, concurrency, False))
+            print(f'{"sync":8} {concurrency:10d} {handler_per_s:10.0f} {max_lag_ms:11.1f}')
+            for worker_count in WORKER_COUNT_li:
+                aio.AIO_WORKERS = worker_count
+                handler_per_s, max_lag_ms = asyncio.run(bench(handler_count, concurrency, True))
+                aio.shutdown()
+                print(f'{f"aio/{worker_count}":8} {concurrency:10d} {handler_per_s:10.0f} {max_lag_ms:11.1f}')
+        eng.dispose()
+
+
+if __name__ == '__main__':
+    main()
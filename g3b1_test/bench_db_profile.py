@@ -0,0 +1,127 @@
+"""Compares the connection profiles of g3b1_data.db_profile on the ingestion path of incoming messages.
+
+Per profile and on a new DB file:
+  row: one transaction per message (user, chat, message upserts), the path without the ingest queue
+  queue: the messages put by several threads into an IngestQueue
+  read: latest message reads of a concurrent reader while the queue is flushed, failed reads are locked out
+
+python -m g3b1_test.bench_db_profile [message count]
+"""
+import os
+import sys
+import tempfile
+import threading
+from time import perf_counter
+
+from sqlalchemy import MetaData, desc, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+from g3b1_data import db_registry
+from g3b1_data.db_profile import PROFILE_DCT, apply_profile, pragma_report_str
+from g3b1_data.tg_db_ingest import IngestQueue, upsert_many
+
+MSG_COUNT = 5000
+ROW_COUNT = 500
+THREAD_COUNT = 4
+CHAT_COUNT = 20
+
+TBL_KEY_DCT = {'tg_user': ['ext_id'], 'tg_chat': ['ext_id'], 'tg_message': ['tg_chat_id', 'ext_id']}
+
+SQL_CREATE_li = [
+    'CREATE TABLE tg_user (ext_id integer UNIQUE, first_name text, username text)',
+    'CREATE TABLE tg_chat (ext_id integer UNIQUE, title text, last_msg_id integer)',
+    'CREATE TABLE tg_message (ext_id integer, tg_chat_id integer, tg_user_id integer, date text, text text, '
+    'g3_cmd_explicit integer DEFAULT 0, UNIQUE (tg_chat_id, ext_id))',
+    'CREATE INDEX ix_tg_message_cu_cmd_date ON tg_message (tg_chat_id, tg_user_id, g3_cmd_explicit, date)'
+]
+
+
+def values_tup(i: int) -> tuple[dict, dict, dict]:
+    chat_id = i % CHAT_COUNT
+    return (dict(ext_id=chat_id, first_name=f'user {chat_id}', username=f'u{chat_id}'),
+            dict(ext_id=chat_id, title=f'chat {chat_id}'),
+            dict(ext_id=i, tg_chat_id=chat_id, tg_user_id=chat_id, date=f'2021-08-01 10:{i % 60:02d}:00',
+                 text=f'message {i} ' * 8))
+
+
+def create_db(profile_name: str, db_file: str) -> tuple[Engine, MetaData]:
+    eng = db_registry.create_eng(db_file)
+    apply_profile(eng, profile_name)
+    with eng.begin() as con:
+        for sql in SQL_CREATE_li:
+            con.execute(sql)
+    md = MetaData()
+    md.reflect(bind=eng)
+    return eng, md
+
+
+def bench_row(eng: Engine, md: MetaData, count: int) -> float:
+    start = perf_counter()
+    for i in range(count):
+        with eng.begin() as con:
+            for (tbl_name, key_li), values in zip(TBL_KEY_DCT.items(), values_tup(i)):
+                upsert_many(con, md.tables[tbl_name], [values], key_li)
+    return count / (perf_counter() - start)
+
+
+def bench_queue(eng: Engine, md: MetaData, first: int, count: int) -> tuple[float, int, int, float]:
+    """Returns messages/s, reads done and failed by the concurrent reader and its max read ms"""
+    queue = IngestQueue(eng, md, TBL_KEY_DCT)
+    read_ms_li: list[float] = []
+    err_li: list[OperationalError] = []
+    f_done = threading.Event()
+
+    def read():
+        cols = md.tables['tg_message'].columns
+        while not f_done.is_set():
+            read_start = perf_counter()
+            try:
+                with eng.connect() as con:
+                    con.execute(select(cols.ext_id).where(cols.tg_chat_id == 1, cols.tg_user_id == 1,
+                                                          cols.g3_cmd_explicit == 0).
+                                order_by(desc(cols.date)).limit(1)).first()
+            except OperationalError as e:
+                # database is locked
+                err_li.append(e)
+                continue
+            read_ms_li.append((perf_counter() - read_start) * 1000)
+
+    def put(thread_idx: int):
+        for i in range(first + thread_idx, first + count, THREAD_COUNT):
+            for tbl_name, values in zip(TBL_KEY_DCT.keys(), values_tup(i)):
+                queue.put(tbl_name, values)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    start = perf_counter()
+    queue.start()
+    thread_li = [threading.Thread(target=put, args=(idx,)) for idx in range(THREAD_COUNT)]
+    for thread in thread_li:
+        thread.start()
+    for thread in thread_li:
+        thread.join()
+    queue.stop()
+    msg_per_s = count / (perf_counter() - start)
+    f_done.set()
+    reader.join()
+    return msg_per_s, len(read_ms_li), len(err_li), max(read_ms_li, default=0.0)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else MSG_COUNT
+    row_count = min(ROW_COUNT, count)
+    print(f'{"profile":10} {"row msg/s":>10} {"queue msg/s":>12} {"reads":>7} {"locked":>7} {"max read ms":>12}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for profile_name in PROFILE_DCT.keys():
+            eng, md = create_db(profile_name, os.path.join(tmp_dir, f'bench_{profile_name}.db'))
+            row_per_s = bench_row(eng, md, row_count)
+            queue_per_s, read_count, err_count, max_read_ms = bench_queue(eng, md, row_count, count)
+            print(f'{profile_name:10} {row_per_s:10.0f} {queue_per_s:12.0f} {read_count:7d} {err_count:7d} '
+                  f'{max_read_ms:12.1f}')
+            print(f'  {pragma_report_str(eng)}')
+            eng.dispose()
+
+
+if __name__ == '__main__':
+    main()